@@ -4,8 +4,9 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
 from dotenv import load_dotenv
+from .database import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 migrate = Migrate()
 
@@ -22,35 +23,49 @@ def create_app(config_class=None):
 	# Ensure upload folder exists
 	os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+	from . import database
+	database.init_app(app)
 	db.init_app(app)
 	login_manager.init_app(app)
 	migrate.init_app(app, db)
 
+	from . import events, fragcache, metrics, passwords, refcache, usercache
+	metrics.init_app(app)
+	events.init_app(app)
+	refcache.init_app(app)
+	fragcache.init_app(app)
+	usercache.init_app(app)
+	passwords.init_app(app)
+	from . import processing  # noqa: F401  registers job handlers
+	from . import search  # noqa: F401  registers search index DDL and maintenance hooks
+	from . import activity  # noqa: F401  registers the query activity hook
+
 	# Register blueprints (to be created later)
 	from .auth_routes import auth_bp  # type: ignore
 	from .query_routes import query_bp  # type: ignore
+	from .report_routes import reports_bp
+	from .api_routes import api_bp
 	app.register_blueprint(auth_bp)
 	app.register_blueprint(query_bp)
+	app.register_blueprint(reports_bp)
+	app.register_blueprint(api_bp)
 
 	@app.context_processor
 	def inject_user_tasks():
-		from .models import Query
+		from .counters import pending_count
 		from flask_login import current_user
 		if current_user.is_authenticated:
-			pending_count = 0
-			# Simple pending logic placeholder; refined later
+			# O(1) primary-key read of the materialized counter kept by the workflow routes
 			try:
-				if current_user.role == 'auditor':
-					pending_count = Query.query.filter(Query.status.in_(['employee_submitted','manager_approved','reopened'])).count()
-				elif current_user.role == 'employee':
-					pending_count = Query.query.filter_by(assigned_employee_id=current_user.id, status='assigned').count()
-				elif current_user.role == 'manager':
-					pending_count = Query.query.filter(Query.status=='employee_submitted', Query.manager_id==current_user.id).count()
+				pending = pending_count(current_user.id)
 			except Exception:
-				pending_count = 0
-			return {'pending_tasks': pending_count}
+				pending = 0
+			return {'pending_tasks': pending}
 		return {'pending_tasks': 0}
 
+	from .commands import register_commands
+	register_commands(app)
+
 	return app
 
 def allowed_file(filename):
@@ -0,0 +1,120 @@
+"""Denormalized activity columns on ``query``.
+
+``Query.last_activity_at`` is the newest of the query's creation, audit rows,
+comments and attachments. ``comment_count`` and ``attachment_count`` count
+its comments and attachments, and ``reopen_count`` its 'reopened' audit rows.
+Lists show and sort by them without touching the child tables.
+
+They change in the transaction that changes their sources:
+
+* Comments, attachments and audit rows added through the session: an
+  ``after_flush`` hook issues one UPDATE per affected query.
+* Workflow transitions (core INSERTs of audit rows): ``app/workflow.py`` sets
+  them in its conditional UPDATE.
+
+Rows written any other way (bulk loads, raw SQL) are brought back in step by
+``flask activity verify --repair``.
+"""
+from collections import defaultdict
+
+from sqlalchemy import bindparam, case, event, func, select, update
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import Attachment, AuditTrail, Comment, Query
+
+COUNT_COLUMNS = ('comment_count', 'attachment_count', 'reopen_count')
+COLUMNS = ('last_activity_at',) + COUNT_COLUMNS
+
+
+def _later(a, b):
+    return b if a is None or (b is not None and b > a) else a
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_activity(session, flush_context):
+    deltas = defaultdict(lambda: dict.fromkeys(COUNT_COLUMNS, 0))
+    latest = {}
+    for obj in session.new:
+        if isinstance(obj, Comment):
+            deltas[obj.query_id]['comment_count'] += 1
+            when = obj.created_at
+        elif isinstance(obj, Attachment):
+            deltas[obj.query_id]['attachment_count'] += 1
+            when = obj.uploaded_at
+        elif isinstance(obj, AuditTrail):
+            deltas[obj.query_id]['reopen_count'] += obj.action == 'reopened'
+            when = obj.created_at
+        else:
+            continue
+        latest[obj.query_id] = _later(latest.get(obj.query_id), when)
+    gone = {obj.id for obj in session.deleted if isinstance(obj, Query)}
+    for obj in session.deleted:
+        if isinstance(obj, (Comment, Attachment)) and obj.query_id not in gone:
+            deltas[obj.query_id][f'{obj.__tablename__}_count'] -= 1
+    if not deltas:
+        return
+    q = Query.__table__
+    connection = session.connection()
+    for query_id, counts in deltas.items():
+        values = {c: q.c[c] + n for c, n in counts.items() if n}
+        when = latest.get(query_id)
+        if when is not None:
+            values['last_activity_at'] = case((q.c.last_activity_at < when, when), else_=q.c.last_activity_at)
+        if values:
+            # Activity is not an edit of the query: keep updated_at as it is
+            connection.execute(update(q).where(q.c.id == query_id).values(updated_at=q.c.updated_at, **values))
+
+
+def computed(query_ids):
+    """The activity columns of ``query_ids`` recomputed from the child tables, by query id."""
+    result = {qid: dict(dict.fromkeys(COUNT_COLUMNS, 0), last_activity_at=created)
+              for qid, created in db.session.execute(select(Query.id, Query.created_at).where(Query.id.in_(query_ids)))}
+    # (column counted, or None, query id column, activity time, criteria)
+    sources = (
+        ('comment_count', Comment.query_id, Comment.created_at, ()),
+        ('attachment_count', Attachment.query_id, Attachment.uploaded_at, ()),
+        (None, AuditTrail.query_id, AuditTrail.created_at, ()),
+        ('reopen_count', AuditTrail.query_id, AuditTrail.created_at, (AuditTrail.action == 'reopened',)),
+    )
+    for column, query_id, when, criteria in sources:
+        rows = db.session.execute(select(query_id, func.count(), func.max(when))
+                                  .where(query_id.in_(query_ids), *criteria).group_by(query_id))
+        for qid, count, newest in rows:
+            row = result[qid]
+            if column:
+                row[column] = count
+            row['last_activity_at'] = _later(row['last_activity_at'], newest)
+    return result
+
+
+def verify(repair=False, batch_size=1000):
+    """Compare every query's activity columns with the child tables. Returns ``(rows checked, drifted ids)``.
+
+    With ``repair`` the drifted rows are rewritten, committing once per batch.
+    """
+    q = Query.__table__
+    fix = (update(q).where(q.c.id == bindparam('query_id'))
+           .values(updated_at=q.c.updated_at, **{c: bindparam(f'new_{c}') for c in COLUMNS}))
+    last_id, checked, drifted = 0, 0, []
+    while True:
+        rows = db.session.execute(select(Query.id, *(getattr(Query, c) for c in COLUMNS))
+                                  .where(Query.id > last_id).order_by(Query.id).limit(batch_size)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        actual = computed([r.id for r in rows])
+        fixes = []
+        for r in rows:
+            want = actual[r.id]
+            if want['last_activity_at'] is None:
+                want['last_activity_at'] = r.last_activity_at  # legacy row with no dates at all
+            if any(getattr(r, c) != want[c] for c in COLUMNS):
+                drifted.append(r.id)
+                fixes.append(dict({f'new_{c}': want[c] for c in COLUMNS}, query_id=r.id))
+        if repair and fixes:
+            db.session.execute(fix, fixes)
+            db.session.commit()
+        checked += len(rows)
+    db.session.rollback()  # end the read transaction
+    return checked, drifted
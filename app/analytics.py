@@ -0,0 +1,264 @@
+"""Workflow analytics folded incrementally from the audit trail.
+
+``query_workflow_stats`` holds one row per query: its current status and
+since when, the time spent so far in each tracked status, and how many
+rejection and reopen loops it went through. ``refresh`` folds in audit rows
+past the ``workflow`` watermark in id order and advances the watermark in
+the same transaction. The watermark update is conditional on its old value,
+so two concurrent refreshes cannot fold the same rows twice. Reports
+aggregate the summary table and never read ``audit_trail``.
+
+Refreshes run in the job worker (``analytics.refresh`` jobs) or from
+``flask analytics refresh`` on a schedule, never in a report request. A
+report view only queues a job when settled rows wait past the watermark
+and none is queued yet (``request_refresh``).
+
+Audit rows younger than ``ANALYTICS_SETTLE_SECONDS`` are left for the next
+refresh: ids are assigned at insert but become visible at commit, so a row
+with a lower id can still appear after a higher one has been read. This is a
+heuristic on ``created_at``: a transaction that commits its audit rows more
+than ``ANALYTICS_SETTLE_SECONDS`` after writing them can still land below the
+watermark, and those rows are never folded. Keep the setting above the
+longest write transaction; ``flask analytics refresh --rebuild`` recovers.
+"""
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import case, delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .jobs import enqueue, job_handler
+from .models import AuditTrail, Job, Query, QueryStatus, QueryWorkflowStats, SummaryWatermark, User
+from .refcache import reference_data
+
+WATERMARK = 'workflow'
+
+STATUS_OF_ACTION = {
+    'created': QueryStatus.DRAFT.value,
+    'assigned': QueryStatus.ASSIGNED.value,
+    'employee_submitted': QueryStatus.EMPLOYEE_SUBMITTED.value,
+    'manager_approved': QueryStatus.MANAGER_APPROVED.value,
+    'manager_rejected': QueryStatus.MANAGER_REJECTED.value,
+    'closed': QueryStatus.CLOSED.value,
+    'reopened': QueryStatus.REOPENED.value,
+}
+# Statuses whose dwell time is accumulated, and the summary column holding it
+TRACKED = {
+    QueryStatus.ASSIGNED.value: 'assigned_seconds',
+    QueryStatus.EMPLOYEE_SUBMITTED.value: 'submitted_seconds',
+    QueryStatus.MANAGER_APPROVED.value: 'approved_seconds',
+}
+DIMENSIONS = {
+    'category': QueryWorkflowStats.category_id,
+    'employee': QueryWorkflowStats.employee_id,
+    'manager': QueryWorkflowStats.manager_id,
+}
+
+
+# Folding
+
+def watermark():
+    return db.session.execute(
+        select(SummaryWatermark.last_id).where(SummaryWatermark.name == WATERMARK)).scalar() or 0
+
+
+def _ensure_watermark():
+    if db.session.get(SummaryWatermark, WATERMARK) is None:
+        try:
+            db.session.execute(insert(SummaryWatermark).values(name=WATERMARK, last_id=0))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+
+
+def _advance(old_id, new_id):
+    table = SummaryWatermark.__table__
+    result = db.session.execute(update(table).where(table.c.name == WATERMARK, table.c.last_id == old_id)
+                                .values(last_id=new_id, updated_at=datetime.utcnow()))
+    return result.rowcount == 1
+
+
+def fold(stats, action, when, target_user_id=None):
+    """Apply one status-changing audit event to a summary row."""
+    if stats.status in TRACKED and when > stats.status_since:
+        column = TRACKED[stats.status]
+        setattr(stats, column, getattr(stats, column) + (when - stats.status_since).total_seconds())
+    if action == 'assigned' and target_user_id:
+        stats.employee_id = target_user_id
+    elif action == 'employee_submitted' and target_user_id:
+        stats.manager_id = target_user_id
+    elif action == 'manager_rejected':
+        stats.rejections += 1
+    elif action == 'reopened':
+        stats.reopens += 1
+    elif action == 'closed' and stats.created_at:
+        stats.cycle_seconds = (when - stats.created_at).total_seconds()
+    stats.status, stats.status_since = STATUS_OF_ACTION[action], when
+
+
+def _load_stats(query_ids, first_seen):
+    stats = {s.query_id: s for s in db.session.execute(
+        select(QueryWorkflowStats).where(QueryWorkflowStats.query_id.in_(query_ids))).scalars()}
+    missing = set(query_ids) - stats.keys()
+    if missing:
+        for q in db.session.execute(select(Query.id, Query.category_id, Query.created_at, Query.assigned_employee_id,
+                                           Query.manager_id).where(Query.id.in_(missing))):
+            created = q.created_at or first_seen[q.id]
+            row = QueryWorkflowStats(query_id=q.id, category_id=q.category_id, employee_id=q.assigned_employee_id,
+                                     manager_id=q.manager_id, status=QueryStatus.DRAFT.value, status_since=created,
+                                     created_at=created, assigned_seconds=0, submitted_seconds=0,
+                                     approved_seconds=0, rejections=0, reopens=0)
+            db.session.add(row)
+            stats[q.id] = row
+    return stats
+
+
+def _fold_batch(events):
+    relevant = [e for e in events if e.action in STATUS_OF_ACTION]
+    first_seen = {}
+    for e in relevant:
+        first_seen.setdefault(e.query_id, e.created_at)
+    stats = _load_stats(list(first_seen), first_seen)
+    for e in relevant:
+        if e.query_id in stats:
+            fold(stats[e.query_id], e.action, e.created_at or stats[e.query_id].status_since, e.target_user_id)
+
+
+def refresh(max_rows=None, batch_size=1000):
+    """Fold audit rows past the watermark into the summary. Returns the number of audit rows consumed."""
+    _ensure_watermark()
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['ANALYTICS_SETTLE_SECONDS'])
+    total = 0
+    while max_rows is None or total < max_rows:
+        last_id = watermark()
+        limit = batch_size if max_rows is None else min(batch_size, max_rows - total)
+        events = db.session.execute(
+            select(AuditTrail.id, AuditTrail.query_id, AuditTrail.action, AuditTrail.target_user_id,
+                   AuditTrail.created_at)
+            .where(AuditTrail.id > last_id).order_by(AuditTrail.id).limit(limit)).all()
+        settled = []
+        for e in events:
+            if e.created_at and e.created_at > cutoff:
+                break
+            settled.append(e)
+        if not settled:
+            break
+        try:
+            _fold_batch(settled)
+            db.session.flush()
+            advanced = _advance(last_id, settled[-1].id)
+        except IntegrityError:
+            # A concurrent refresh inserted the same new summary rows first
+            advanced = False
+        if not advanced:
+            # Another refresh folded these rows first
+            db.session.rollback()
+            break
+        db.session.commit()
+        total += len(settled)
+        if len(settled) < limit:
+            break
+    return total
+
+
+@job_handler('analytics.refresh')
+def _refresh_job(job, payload):
+    refresh()
+
+
+def lagging():
+    """Whether settled audit rows wait past the watermark."""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config['ANALYTICS_SETTLE_SECONDS'])
+    oldest = db.session.execute(select(AuditTrail.created_at).where(AuditTrail.id > watermark())
+                                .order_by(AuditTrail.id).limit(1)).first()
+    return oldest is not None and (oldest.created_at is None or oldest.created_at <= cutoff)
+
+
+def request_refresh():
+    """Queue an ``analytics.refresh`` job if the summary lags and none is pending. Returns the job or None."""
+    if not lagging():
+        return None
+    pending = db.session.execute(select(Job.id).where(Job.kind == 'analytics.refresh',
+                                                      Job.status.in_(('queued', 'running'))).limit(1)).first()
+    if pending is not None:
+        return None
+    job = enqueue('analytics.refresh', max_attempts=1)
+    db.session.commit()
+    return job
+
+
+def rebuild(batch_size=1000):
+    """Empty the summary and fold the whole audit trail again."""
+    db.session.execute(delete(QueryWorkflowStats))
+    db.session.execute(update(SummaryWatermark).where(SummaryWatermark.name == WATERMARK).values(last_id=0))
+    db.session.commit()
+    return refresh(batch_size=batch_size)
+
+
+# Reports
+
+def _hours(seconds):
+    return round(seconds / 3600, 2) if seconds is not None else None
+
+
+def _labels(by, keys):
+    keys = [k for k in keys if k is not None]
+    if by == 'category':
+        names = {c.id: c.name for c in reference_data().categories}
+    elif keys:
+        names = {u.id: u.full_name or u.username for u in db.session.execute(
+            select(User.id, User.full_name, User.username).where(User.id.in_(keys)))}
+    else:
+        names = {}
+    return names
+
+
+def workflow_report(by='category'):
+    """Dwell times and loop counts per category, employee or manager."""
+    s = QueryWorkflowStats
+    key = DIMENSIONS[by]
+    rows = db.session.execute(
+        select(key.label('key'), func.count().label('queries'),
+               *[func.avg(func.nullif(getattr(s, column), 0)).label(status) for status, column in TRACKED.items()],
+               func.sum(s.rejections).label('rejections'), func.sum(s.reopens).label('reopens'),
+               func.avg(s.cycle_seconds).label('cycle'))
+        .group_by(key)).all()
+    names = _labels(by, [r.key for r in rows])
+    report = []
+    for r in rows:
+        report.append({
+            'id': r.key,
+            'name': names.get(r.key, 'Unassigned' if r.key is None else f'#{r.key}'),
+            'queries': r.queries,
+            'avg_hours_in': {status: _hours(getattr(r, status)) for status in TRACKED},
+            'rejections': r.rejections or 0,
+            'reopens': r.reopens or 0,
+            'loops_per_query': round(((r.rejections or 0) + (r.reopens or 0)) / r.queries, 2),
+            'avg_cycle_hours': _hours(r.cycle),
+        })
+    report.sort(key=lambda item: (-item['queries'], item['name']))
+    return report
+
+
+def aging(now=None):
+    """How long queries currently sitting in each tracked status have waited."""
+    s = QueryWorkflowStats
+    now = now or datetime.utcnow()
+    day, week = now - timedelta(days=1), now - timedelta(days=7)
+    rows = db.session.execute(
+        select(s.status, func.count().label('queries'),
+               func.sum(case((s.status_since >= day, 1), else_=0)).label('under_1d'),
+               func.sum(case(((s.status_since < day) & (s.status_since >= week), 1), else_=0)).label('from_1d_to_7d'),
+               func.sum(case((s.status_since < week, 1), else_=0)).label('over_7d'),
+               func.min(s.status_since).label('oldest'))
+        .where(s.status.in_(TRACKED)).group_by(s.status)).all()
+    by_status = {r.status: r for r in rows}
+    return [{
+        'status': status,
+        'queries': by_status[status].queries if status in by_status else 0,
+        'under_1d': by_status[status].under_1d if status in by_status else 0,
+        'from_1d_to_7d': by_status[status].from_1d_to_7d if status in by_status else 0,
+        'over_7d': by_status[status].over_7d if status in by_status else 0,
+        'oldest_hours': _hours((now - by_status[status].oldest).total_seconds()) if status in by_status else None,
+    } for status in TRACKED]
@@ -0,0 +1,241 @@
+"""JSON API for integrations (``/api/v1``).
+
+Lists use the same keyset cursors as the HTML views. ``fields=a,b`` trims
+each item to the named fields; ``embed=auditor,category,...`` adds small
+objects next to their id fields, loaded with one batched query per page. Every
+response carries a weak ETag computed from ``updated_at`` values and the
+newest child ids, checked before the body is built, so a poll that finds
+nothing new costs one indexed aggregate query and an empty 304.
+"""
+import hashlib
+from datetime import datetime
+from flask import Blueprint, jsonify, request, current_app, Response
+from flask_login import current_user
+from sqlalchemy import false, func, select
+from . import db
+from .database import read_only
+from .models import Query, Comment, AuditTrail, User, QueryStatus, query_scope_for
+from .pagination import keyset_page
+from .refcache import reference_data
+from .audit_format import audit_views
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+QUERY_FIELDS = ('id', 'status', 'category_id', 'subcategory_id', 'template_id', 'custom_text', 'auditor_id',
+                'assigned_employee_id', 'manager_id', 'created_at', 'updated_at', 'last_activity_at', 'comment_count',
+                'attachment_count', 'reopen_count')
+# sort= value -> keyset columns, all served by the query table (see app/activity.py)
+QUERY_SORTS = {
+    'updated_at': (Query.updated_at, Query.id),
+    'last_activity_at': (Query.last_activity_at, Query.id),
+    'comment_count': (Query.comment_count, Query.id),
+    'attachment_count': (Query.attachment_count, Query.id),
+}
+COMMENT_FIELDS = ('id', 'query_id', 'user_id', 'content', 'created_at')
+AUDIT_FIELDS = ('id', 'query_id', 'action', 'user_id', 'target_user_id', 'created_at')  # plus the rendered 'message'
+# embed name -> (id field it expands, kind of object)
+QUERY_EMBEDS = {
+    'category': ('category_id', 'category'),
+    'auditor': ('auditor_id', 'user'),
+    'assigned_employee': ('assigned_employee_id', 'user'),
+    'manager': ('manager_id', 'user'),
+}
+COMMENT_EMBEDS = {'user': ('user_id', 'user')}
+AUDIT_EMBEDS = {'user': ('user_id', 'user'), 'target_user': ('target_user_id', 'user')}
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@api_bp.errorhandler(APIError)
+def _api_error(exc):
+    return jsonify({'error': exc.message}), exc.status
+
+
+@api_bp.errorhandler(404)
+def _not_found(exc):
+    return jsonify({'error': 'not found'}), 404
+
+
+@api_bp.before_request
+def _require_login():
+    if not current_user.is_authenticated:
+        return jsonify({'error': 'authentication required'}), 401
+
+
+# Request parsing
+
+def _csv_arg(name, allowed):
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    values = [v.strip() for v in raw.split(',') if v.strip()]
+    unknown = [v for v in values if v not in allowed]
+    if unknown:
+        raise APIError(400, f"unknown {name}: {', '.join(unknown)}")
+    return values
+
+
+def _limit():
+    try:
+        limit = int(request.args.get('limit', current_app.config['API_PAGE_SIZE']))
+    except ValueError:
+        raise APIError(400, 'limit must be an integer')
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+# Serialization
+
+def _value(v):
+    return v.isoformat() if isinstance(v, datetime) else v
+
+
+def _serialize(obj, fields, only=None):
+    # The id is always included so clients can follow up on an item
+    return {f: _value(getattr(obj, f)) for f in fields if only is None or f in only or f == 'id'}
+
+
+def _embed(items, rows, embeds, available):
+    """Add the objects named by ``embeds`` to ``items``, loading all users of the page at once."""
+    if not embeds or not items:
+        return items
+    user_ids = {getattr(r, available[e][0]) for r in rows for e in embeds if available[e][1] == 'user'} - {None}
+    users = {}
+    if user_ids:
+        users = {u.id: {'id': u.id, 'username': u.username, 'full_name': u.full_name, 'role': u.role}
+                 for u in db.session.execute(select(User.id, User.username, User.full_name, User.role)
+                                             .where(User.id.in_(user_ids)))}
+    categories = {}
+    if any(available[e][1] == 'category' for e in embeds):
+        categories = {c.id: {'id': c.id, 'name': c.name} for c in reference_data().categories}
+    lookup = {'user': users, 'category': categories}
+    for item, row in zip(items, rows):
+        for e in embeds:
+            field, kind = available[e]
+            item[e] = lookup[kind].get(getattr(row, field))
+    return items
+
+
+def _etag(*parts):
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:20]
+
+
+def _conditional(etag, build):
+    """304 if the client already has ``etag``; otherwise the JSON from ``build()``."""
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(build())
+    resp.set_etag(etag, weak=True)
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp
+
+
+def _page_etag(*state):
+    # Everything that shapes the response body besides the data itself
+    return _etag(current_user.id, sorted(request.args.items(multi=True)), *state)
+
+
+# Routes
+
+@api_bp.route('/queries')
+@read_only
+def list_queries():
+    fields = _csv_arg('fields', QUERY_FIELDS)
+    embeds = _csv_arg('embed', QUERY_EMBEDS)
+    limit = _limit()
+    sort = request.args.get('sort', 'updated_at')
+    if sort not in QUERY_SORTS:
+        raise APIError(400, f'unknown sort: {sort}')
+    scope = query_scope_for(current_user)
+    criteria = [scope if scope is not None else false()]
+    status = request.args.get('status')
+    if status:
+        if status not in {s.value for s in QueryStatus}:
+            raise APIError(400, f'unknown status: {status}')
+        criteria.append(Query.status == status)
+    since = request.args.get('updated_since')
+    if since:
+        try:
+            criteria.append(Query.updated_at > datetime.fromisoformat(since))
+        except ValueError:
+            raise APIError(400, 'updated_since must be an ISO 8601 datetime')
+    # Any edit bumps updated_at, any comment, upload or audit row last_activity_at,
+    # and any move on/off the desk changes the count
+    latest, active, count = db.session.execute(
+        select(func.max(Query.updated_at), func.max(Query.last_activity_at), func.count()).where(*criteria)).one()
+
+    def build():
+        qry = Query.query.filter(*criteria)
+        rows, next_cursor = keyset_page(qry, list(QUERY_SORTS[sort]), request.args.get('cursor'), limit=limit)
+        items = [_serialize(q, QUERY_FIELDS, fields) for q in rows]
+        return {'data': _embed(items, rows, embeds, QUERY_EMBEDS), 'next_cursor': next_cursor}
+    return _conditional(_page_etag(_value(latest), _value(active), count), build)
+
+
+@api_bp.route('/queries/<int:query_id>')
+@read_only
+def get_query(query_id):
+    fields = _csv_arg('fields', QUERY_FIELDS)
+    embeds = _csv_arg('embed', QUERY_EMBEDS)
+    updated_at, active = _query_stamps(query_id)
+
+    def build():
+        q = db.session.get(Query, query_id)
+        return {'data': _embed([_serialize(q, QUERY_FIELDS, fields)], [q], embeds, QUERY_EMBEDS)[0]}
+    return _conditional(_page_etag(_value(updated_at), _value(active)), build)
+
+
+def _query_stamps(query_id):
+    """``(updated_at, last_activity_at)`` of a query; 404 if it does not exist or is not on the user's desk."""
+    scope = query_scope_for(current_user)
+    row = db.session.execute(select(Query.updated_at, Query.last_activity_at)
+                             .where(Query.id == query_id, scope if scope is not None else false())).first()
+    if row is None:
+        raise APIError(404, 'not found')
+    return row.updated_at, row.last_activity_at
+
+
+def _child_collection(query_id, model, serialize, fields_all, embeddable):
+    fields = _csv_arg('fields', fields_all)
+    embeds = _csv_arg('embed', embeddable)
+    limit = _limit()
+    updated_at, _ = _query_stamps(query_id)
+    # Children are append-only, so the newest id pins the collection's content
+    newest = db.session.execute(select(func.max(model.id)).where(model.query_id == query_id)).scalar()
+
+    def build():
+        qry = db.session.query(model).filter_by(query_id=query_id)
+        rows, next_cursor = keyset_page(qry, [model.id], request.args.get('cursor'), limit=limit)
+        items = serialize(rows, fields)
+        return {'data': _embed(items, rows, embeds, embeddable), 'next_cursor': next_cursor}
+    return _conditional(_page_etag(_value(updated_at), newest), build)
+
+
+def _comment_items(rows, fields):
+    return [_serialize(c, COMMENT_FIELDS, fields) for c in rows]
+
+
+def _audit_items(rows, fields):
+    items = [_serialize(e, AUDIT_FIELDS, fields) for e in rows]
+    if fields is None or 'message' in fields:
+        for item, view in zip(items, audit_views(rows)):
+            item['message'] = view.message
+    return items
+
+
+@api_bp.route('/queries/<int:query_id>/comments')
+@read_only
+def list_comments(query_id):
+    return _child_collection(query_id, Comment, _comment_items, COMMENT_FIELDS, COMMENT_EMBEDS)
+
+
+@api_bp.route('/queries/<int:query_id>/audit_trail')
+@read_only
+def list_audit_trail(query_id):
+    return _child_collection(query_id, AuditTrail, _audit_items, AUDIT_FIELDS + ('message',), AUDIT_EMBEDS)
@@ -0,0 +1,65 @@
+"""Render audit events for display.
+
+Audit rows store an action code, actor and target ids and typed ``params``;
+names are resolved when the rows are shown, with one batched user lookup per
+page. Rows written before this scheme keep their stored ``detail`` text.
+"""
+from collections import namedtuple
+
+from .models import User
+
+MESSAGES = {
+    'created': 'Query created by auditor {actor}',
+    'assigned': 'Assigned to employee {target}',
+    'employee_submitted': 'Submitted to manager {target}',
+    'manager_approved': 'Manager {actor} approved submission',
+    'manager_rejected': 'Manager {actor} rejected submission',
+    'closed': 'Auditor {actor} closed query',
+    'reopened': 'Auditor {actor} reopened query',
+    'file_upload': 'File {file} uploaded by {actor}',
+    'comment': 'Comment added by {actor}',
+}
+
+UserLabel = namedtuple('UserLabel', 'id name')
+AuditView = namedtuple('AuditView', 'id query_id created_at action message actor target')
+
+
+class _Params(dict):
+    def __missing__(self, key):
+        return '?'
+
+
+def user_label(user_id, name):
+    if user_id is None:
+        return '(ID unknown)'
+    return f'(ID {user_id}) {name}' if name else f'(ID {user_id})'
+
+
+def describe(action, params, detail, actor, target):
+    """Display text for one event; ``actor``/``target`` are already-rendered labels."""
+    template = MESSAGES.get(action)
+    if template is None or (params is None and detail):
+        return detail or action
+    return template.format_map(_Params(params or {}, actor=actor, target=target))
+
+
+def load_user_labels(entries):
+    ids = {e.user_id for e in entries if e.user_id} | {e.target_user_id for e in entries if e.target_user_id}
+    if not ids:
+        return {}
+    return {u.id: UserLabel(u.id, u.full_name or u.username)
+            for u in User.query.with_entities(User.id, User.full_name, User.username).filter(User.id.in_(ids))}
+
+
+def audit_views(entries):
+    """Wrap ``AuditTrail`` rows with their rendered message and user labels."""
+    users = load_user_labels(entries)
+    views = []
+    for e in entries:
+        actor = users.get(e.user_id)
+        target = users.get(e.target_user_id)
+        message = describe(e.action, e.params, e.detail,
+                           user_label(e.user_id, actor.name if actor else None),
+                           user_label(e.target_user_id, target.name if target else None))
+        views.append(AuditView(e.id, e.query_id, e.created_at, e.action, message, actor, target))
+    return views
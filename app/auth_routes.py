@@ -1,8 +1,9 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash
 from flask_login import login_user, logout_user, login_required, current_user
-from werkzeug.security import check_password_hash, generate_password_hash
+from sqlalchemy import update
 from . import db
 from .models import User
+from .passwords import HasherBusy, dummy_hash, hash_password, needs_rehash, verify_password
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -12,7 +13,18 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password_hash, password):
+        try:
+            # Unknown usernames are checked against a dummy hash so they take as long as wrong passwords
+            valid = verify_password(user.password_hash if user else dummy_hash(), password or '')
+        except HasherBusy:
+            flash('Too many sign-ins right now, please try again in a moment.', 'warning')
+            return render_template('login.html'), 503
+        if user and valid:
+            if needs_rehash(user.password_hash):
+                # Upgrade to the configured parameters; a plain UPDATE leaves auth_version (and other sessions) alone
+                db.session.execute(update(User).where(User.id == user.id, User.password_hash == user.password_hash)
+                                   .values(password_hash=hash_password(password)))
+                db.session.commit()
             login_user(user)
             return redirect(url_for('query.dashboard'))
         flash('Invalid credentials', 'danger')
@@ -32,15 +44,24 @@ def change_password():
         old_password = request.form.get('old_password')
         new_password = request.form.get('new_password')
         confirm_password = request.form.get('confirm_password')
-        if not check_password_hash(current_user.password_hash, old_password):
+        # current_user is a cached snapshot without the password hash
+        user = db.session.get(User, current_user.id)
+        try:
+            valid = verify_password(user.password_hash, old_password or '')
+        except HasherBusy:
+            flash('The server is busy, please try again in a moment.', 'warning')
+            return render_template('change_password.html'), 503
+        if not valid:
             flash('Current password is incorrect.', 'danger')
         elif new_password != confirm_password:
             flash('New passwords do not match.', 'danger')
         elif len(new_password) < 6:
             flash('New password must be at least 6 characters.', 'danger')
         else:
-            current_user.password_hash = generate_password_hash(new_password)
+            user.password_hash = hash_password(new_password)
             db.session.commit()
+            # The edit bumped auth_version; re-issue this session so only the others are signed out
+            login_user(user)
             flash('Password changed successfully.', 'success')
             return redirect(url_for('query.dashboard'))
     return render_template('change_password.html')
@@ -63,7 +84,7 @@ def create_user():
         elif User.query.filter_by(username=username).first():
             flash('Username already exists.', 'danger')
         else:
-            user = User(username=username, full_name=full_name, email=email, role=role, password_hash=generate_password_hash(password))
+            user = User(username=username, full_name=full_name, email=email, role=role, password_hash=hash_password(password))
             db.session.add(user)
             db.session.commit()
             flash(f'User {username} created successfully.', 'success')
@@ -0,0 +1,162 @@
+"""Chunked, resumable backfills.
+
+A backfill walks one table in primary-key order, ``chunk_size`` rows at a
+time. For every chunk it preloads whatever related rows it needs in one
+batched query, processes the rows, and commits the changes together with its
+checkpoint, so a crash loses at most one chunk and a re-run resumes where it
+stopped. Large tables can be split into primary-key ranges processed by
+separate worker processes, each with its own checkpoint.
+
+Define a backfill by subclassing ``Backfill`` and decorating it with
+``@register``; run it with ``flask backfill run <name>``.
+"""
+import multiprocessing
+from datetime import datetime
+from importlib import import_module
+
+from sqlalchemy import func, select
+
+from . import db
+from .models import AuditTrail, BackfillCheckpoint, Query, User
+from .search import reindex_queries
+
+REGISTRY = {}
+
+
+def register(cls):
+    REGISTRY[cls.name] = cls
+    return cls
+
+
+class Backfill:
+    name = None
+    model = None
+    chunk_size = 1000
+
+    def criteria(self):
+        """Extra WHERE criteria limiting the rows visited."""
+        return []
+
+    def preload(self, rows):
+        """Load related data for a chunk in bulk; the result is passed to ``process``."""
+        return None
+
+    def process(self, rows, context):
+        """Modify ``rows`` in place; return the number of rows changed."""
+        raise NotImplementedError
+
+
+def _checkpoint(name):
+    ckpt = db.session.get(BackfillCheckpoint, name)
+    if ckpt is None:
+        ckpt = BackfillCheckpoint(name=name, last_id=0, rows_seen=0, rows_changed=0)
+        db.session.add(ckpt)
+    return ckpt
+
+
+def run_backfill(backfill, start_id=0, end_id=None, checkpoint_name=None, restart=False, log=None):
+    """Run ``backfill`` over ids in ``(start_id, end_id]``. Returns the final checkpoint values."""
+    name = checkpoint_name or backfill.name
+    model = backfill.model
+    ckpt = _checkpoint(name)
+    if restart or ckpt.end_id != end_id:
+        ckpt.last_id, ckpt.rows_seen, ckpt.rows_changed, ckpt.finished_at = start_id, 0, 0, None
+        ckpt.end_id = end_id
+    last_id = max(ckpt.last_id, start_id)
+    db.session.commit()
+    while True:
+        stmt = select(model).where(model.id > last_id, *backfill.criteria()).order_by(model.id).limit(backfill.chunk_size)
+        if end_id is not None:
+            stmt = stmt.where(model.id <= end_id)
+        rows = db.session.execute(stmt).scalars().all()
+        if not rows:
+            break
+        changed = backfill.process(rows, backfill.preload(rows)) or 0
+        last_id = rows[-1].id
+        ckpt = _checkpoint(name)
+        ckpt.last_id = last_id
+        ckpt.rows_seen += len(rows)
+        ckpt.rows_changed += changed
+        db.session.commit()
+        if log:
+            log(f'{name}: up to id {last_id}, {ckpt.rows_seen} rows seen, {ckpt.rows_changed} changed')
+        # Keep the identity map from growing with the table
+        db.session.expunge_all()
+    ckpt = _checkpoint(name)
+    ckpt.finished_at = datetime.utcnow()
+    db.session.commit()
+    return {'last_id': ckpt.last_id, 'rows_seen': ckpt.rows_seen, 'rows_changed': ckpt.rows_changed}
+
+
+def id_slices(backfill, workers):
+    """Split the table's id range into ``workers`` contiguous ``(start, end]`` slices."""
+    lo, hi = db.session.execute(select(func.min(backfill.model.id), func.max(backfill.model.id))).one()
+    if lo is None:
+        return []
+    step = max((hi - lo + 1) // workers, 1)
+    bounds = [lo - 1 + step * i for i in range(workers)] + [hi]
+    return [(bounds[i], bounds[i + 1]) for i in range(workers) if bounds[i] < bounds[i + 1]]
+
+
+def _run_slice(config_path, name, start_id, end_id, chunk_size, restart):
+    from . import create_app
+    module, _, cls = config_path.rpartition('.')
+    app = create_app(getattr(import_module(module), cls))
+    with app.app_context():
+        backfill = REGISTRY[name]()
+        backfill.chunk_size = chunk_size
+        return run_backfill(backfill, start_id, end_id, checkpoint_name=f'{name}:{start_id}-{end_id}', restart=restart)
+
+
+def run_parallel(name, workers, config_path, chunk_size=None, restart=False):
+    """Run backfill ``name`` in ``workers`` processes over disjoint id ranges."""
+    backfill = REGISTRY[name]()
+    slices = id_slices(backfill, workers)
+    db.session.remove()
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(len(slices) or 1) as pool:
+        results = pool.starmap(_run_slice, [(config_path, name, start, end, chunk_size or backfill.chunk_size, restart)
+                                            for start, end in slices])
+    return {'rows_seen': sum(r['rows_seen'] for r in results),
+            'rows_changed': sum(r['rows_changed'] for r in results)}
+
+
+# Registered backfills
+
+@register
+class RetrofitAuditNames(Backfill):
+    """Append actor names to AuditTrail.detail values recorded before names were included."""
+    name = 'retrofit-audit-names'
+    model = AuditTrail
+    KEY_WORDS = ['Assigned to employee', 'Submitted to manager', 'Manager approved submission', 'Manager rejected submission', 'Auditor closed query', 'Auditor reopened query', 'File', 'Comment added']
+
+    def criteria(self):
+        return [AuditTrail.user_id.isnot(None)]
+
+    def needs_update(self, detail):
+        # If detail already has a closing parenthesis after ID or contains fullname, skip
+        return not (')' in detail and 'ID' in detail) and any(k in detail for k in self.KEY_WORDS)
+
+    def preload(self, rows):
+        ids = {r.user_id for r in rows if self.needs_update(r.detail or '')}
+        return {u.id: u for u in User.query.filter(User.id.in_(ids))} if ids else {}
+
+    def process(self, rows, users):
+        changed = 0
+        for entry in rows:
+            user = users.get(entry.user_id)
+            if user and self.needs_update(entry.detail or ''):
+                entry.detail = f"{entry.detail} by (ID {user.id}) {user.full_name or user.username}".strip()
+                changed += 1
+        return changed
+
+
+@register
+class RebuildSearchIndex(Backfill):
+    """Rewrite the search documents of every query, its comments and its attachments."""
+    name = 'search-index'
+    model = Query
+    chunk_size = 500
+
+    def process(self, rows, context):
+        return reindex_queries(rows)
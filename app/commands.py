@@ -0,0 +1,152 @@
+"""Flask CLI commands (``flask --app wsgi.py <group> <command>``)."""
+import click
+from flask.cli import AppGroup
+
+counters_cli = AppGroup('counters', help='Pending-task counter maintenance.')
+
+
+@counters_cli.command('reconcile')
+def reconcile_counters_command():
+    """Rebuild all pending-task counters from the query table."""
+    from .counters import reconcile_counters
+    rows = reconcile_counters()
+    click.echo(f'Rebuilt pending-task counters for {rows} users.')
+
+
+attachments_cli = AppGroup('attachments', help='Attachment store maintenance.')
+
+
+@attachments_cli.command('migrate-storage')
+@click.option('--batch-size', default=500, show_default=True)
+def migrate_storage_command(batch_size):
+    """Move legacy flat-folder uploads into the content-addressed store."""
+    from .storage import migrate_legacy_files
+    migrated, missing = migrate_legacy_files(batch_size=batch_size, log=click.echo)
+    click.echo(f'Done: {migrated} attachments migrated, {missing} legacy files missing.')
+
+
+@attachments_cli.command('gc')
+@click.option('--orphan-age', default=3600, show_default=True,
+              help='Seconds before a file with no stored_blob row (a rolled-back upload) is swept.')
+def gc_command(orphan_age):
+    """Delete stored files no attachment references any more."""
+    from .storage import collect_garbage
+    click.echo(f'Removed {collect_garbage(orphan_age=orphan_age)} unreferenced files.')
+
+
+jobs_cli = AppGroup('jobs', help='Background job worker.')
+
+
+@jobs_cli.command('worker')
+@click.option('--threads', default=2, show_default=True, help='Concurrent job threads.')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds to sleep when the queue is empty.')
+@click.option('--once', is_flag=True, help='Exit once no runnable jobs are left.')
+def worker_command(threads, poll_interval, once):
+    """Run queued background jobs."""
+    from flask import current_app
+    from .jobs import run_worker
+    run_worker(current_app._get_current_object(), threads=threads, poll_interval=poll_interval, once=once)
+
+
+@jobs_cli.command('status')
+def jobs_status_command():
+    """Show job counts by status."""
+    from .jobs import status_counts
+    for status, count in sorted(status_counts().items()):
+        click.echo(f'{status:10} {count}')
+
+
+audit_cli = AppGroup('audit', help='Audit trail tools.')
+
+
+@audit_cli.command('export')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv', show_default=True)
+@click.option('--from', 'date_from', type=click.DateTime(formats=['%Y-%m-%d']), help='First day (inclusive).')
+@click.option('--to', 'date_to', type=click.DateTime(formats=['%Y-%m-%d']), help='Last day (inclusive).')
+@click.option('--gzip', is_flag=True, help='Compress the output with gzip.')
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Output file (default stdout).')
+def audit_export_command(fmt, date_from, date_to, gzip, output):
+    """Stream audit trail rows with actor and target names."""
+    from .export import export_audit_trail
+    for chunk in export_audit_trail(fmt, date_from, date_to, gzip=gzip):
+        output.write(chunk)
+
+
+backfill_cli = AppGroup('backfill', help='Chunked, resumable data backfills.')
+
+
+@backfill_cli.command('list')
+def backfill_list_command():
+    """List registered backfills and their checkpoints."""
+    from .backfill import REGISTRY
+    from .models import BackfillCheckpoint
+    for name in sorted(REGISTRY):
+        click.echo(name)
+        for ckpt in BackfillCheckpoint.query.filter(
+                (BackfillCheckpoint.name == name) | BackfillCheckpoint.name.like(f'{name}:%')).order_by(BackfillCheckpoint.name):
+            state = 'finished' if ckpt.finished_at else 'in progress'
+            click.echo(f'  {ckpt.name}: last id {ckpt.last_id}, {ckpt.rows_seen} seen, {ckpt.rows_changed} changed ({state})')
+
+
+@backfill_cli.command('run')
+@click.argument('name')
+@click.option('--chunk-size', type=int, help='Rows per chunk/commit (default: the backfill\'s own).')
+@click.option('--workers', default=1, show_default=True, help='Worker processes over disjoint id ranges.')
+@click.option('--restart', is_flag=True, help='Ignore saved checkpoints and start from the first id.')
+@click.option('--config', 'config_path', default='config.Config', show_default=True,
+              help='Config class the worker processes load.')
+def backfill_run_command(name, chunk_size, workers, restart, config_path):
+    """Run backfill NAME, resuming from its checkpoint."""
+    from .backfill import REGISTRY, run_backfill, run_parallel
+    if name not in REGISTRY:
+        raise click.BadParameter(f'unknown backfill {name!r}; see `flask backfill list`', param_hint='NAME')
+    if workers > 1:
+        result = run_parallel(name, workers, config_path, chunk_size=chunk_size, restart=restart)
+    else:
+        backfill = REGISTRY[name]()
+        if chunk_size:
+            backfill.chunk_size = chunk_size
+        result = run_backfill(backfill, restart=restart, log=click.echo)
+    click.echo(f"{name}: {result['rows_seen']} rows seen, {result['rows_changed']} changed.")
+
+
+analytics_cli = AppGroup('analytics', help='Workflow analytics summary.')
+
+
+@analytics_cli.command('refresh')
+@click.option('--batch-size', default=1000, show_default=True, help='Audit rows folded in per commit.')
+@click.option('--rebuild', is_flag=True, help='Empty the summary and fold the whole audit trail again.')
+def analytics_refresh_command(batch_size, rebuild):
+    """Fold new audit trail rows into the workflow summary."""
+    from .analytics import rebuild as rebuild_summary, refresh
+    rows = rebuild_summary(batch_size) if rebuild else refresh(batch_size=batch_size)
+    click.echo(f'Folded {rows} audit rows into the workflow summary.')
+
+
+activity_cli = AppGroup('activity', help='Denormalized query activity columns.')
+
+
+@activity_cli.command('verify')
+@click.option('--repair', is_flag=True, help='Rewrite the columns of queries that drifted.')
+@click.option('--batch-size', default=1000, show_default=True, help='Queries checked per batch (and commit).')
+def activity_verify_command(repair, batch_size):
+    """Check last activity and comment/attachment/reopen counts against the child tables."""
+    from .activity import verify
+    checked, drifted = verify(repair=repair, batch_size=batch_size)
+    if drifted:
+        shown = ', '.join(f'#{qid}' for qid in drifted[:20]) + (' ...' if len(drifted) > 20 else '')
+        click.echo(f"{len(drifted)} of {checked} queries {'repaired' if repair else 'drifted'}: {shown}")
+    else:
+        click.echo(f'All {checked} queries are in step.')
+    if drifted and not repair:
+        raise SystemExit(1)
+
+
+def register_commands(app):
+    app.cli.add_command(counters_cli)
+    app.cli.add_command(attachments_cli)
+    app.cli.add_command(jobs_cli)
+    app.cli.add_command(audit_cli)
+    app.cli.add_command(backfill_cli)
+    app.cli.add_command(analytics_cli)
+    app.cli.add_command(activity_cli)
@@ -0,0 +1,98 @@
+"""Materialized per-user pending-task counters.
+
+Every workflow transition calls ``update_pending_counters`` with the set of
+users the query was pending for before the change; the counters of users that
+gained or lost the query are adjusted in the caller's transaction. The navbar
+badge then reads a single ``user_task_counter`` row by primary key, and open
+pages hear of the new value through ``app/events.py``.
+"""
+from sqlalchemy import func, insert, select, union_all, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from . import db, events
+from .models import Query, QueryStatus, UserTaskCounter
+
+AUDITOR_PENDING = (QueryStatus.EMPLOYEE_SUBMITTED.value, QueryStatus.MANAGER_APPROVED.value, QueryStatus.REOPENED.value)
+EMPLOYEE_PENDING = (QueryStatus.ASSIGNED.value,)
+MANAGER_PENDING = (QueryStatus.EMPLOYEE_SUBMITTED.value,)
+# Dialects with INSERT ... ON CONFLICT; others fall back to UPDATE, then INSERT
+UPSERT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def pending_owners(status, auditor_id=None, assigned_employee_id=None, manager_id=None):
+    """Return the ids of users for whom a query in this state is a pending task."""
+    owners = set()
+    if auditor_id and status in AUDITOR_PENDING:
+        owners.add(int(auditor_id))
+    if assigned_employee_id and status in EMPLOYEE_PENDING:
+        owners.add(int(assigned_employee_id))
+    if manager_id and status in MANAGER_PENDING:
+        owners.add(int(manager_id))
+    return owners
+
+
+def pending_owners_of(q):
+    return pending_owners(q.status, q.auditor_id, q.assigned_employee_id, q.manager_id)
+
+
+def update_pending_counters(before, q):
+    """Adjust counters after ``q`` changed; ``before`` is ``pending_owners_of(q)`` taken earlier."""
+    after = pending_owners_of(q)
+    deltas = {uid: -1 for uid in before - after}
+    deltas.update({uid: 1 for uid in after - before})
+    adjust_counters(deltas)
+    return deltas
+
+
+def _upsert_counter(user_id, delta):
+    """Add ``delta`` to the user's counter, creating the row if needed, in one statement.
+
+    Two transactions may create the first row for a user at the same time; an
+    UPDATE-then-INSERT would fail the loser's request with a duplicate key.
+    """
+    dialect_insert = UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if dialect_insert is None:
+        result = db.session.execute(
+            update(UserTaskCounter)
+            .where(UserTaskCounter.user_id == user_id)
+            .values(pending=UserTaskCounter.pending + delta)
+        )
+        if result.rowcount == 0:
+            db.session.execute(insert(UserTaskCounter).values(user_id=user_id, pending=max(delta, 0)))
+        return
+    stmt = dialect_insert(UserTaskCounter).values(user_id=user_id, pending=max(delta, 0))
+    db.session.execute(stmt.on_conflict_do_update(index_elements=[UserTaskCounter.user_id],
+                                                  set_={'pending': UserTaskCounter.pending + delta}))
+
+
+def adjust_counters(deltas):
+    for user_id, delta in deltas.items():
+        if delta:
+            _upsert_counter(user_id, delta)
+    events.counters_changed(uid for uid, delta in deltas.items() if delta)
+
+
+def pending_count(user_id):
+    counter = db.session.get(UserTaskCounter, user_id)
+    return counter.pending if counter else 0
+
+
+def _pending_source():
+    q = Query.__table__
+    owners = union_all(
+        select(q.c.auditor_id.label('user_id')).where(q.c.status.in_(AUDITOR_PENDING)),
+        select(q.c.assigned_employee_id.label('user_id')).where(q.c.status.in_(EMPLOYEE_PENDING)),
+        select(q.c.manager_id.label('user_id')).where(q.c.status.in_(MANAGER_PENDING)),
+    ).subquery()
+    return (select(owners.c.user_id, func.count().label('pending'))
+            .where(owners.c.user_id.isnot(None))
+            .group_by(owners.c.user_id))
+
+
+def reconcile_counters():
+    """Rebuild every counter from the ``query`` table. Returns the number of rows written."""
+    db.session.execute(delete(UserTaskCounter))
+    result = db.session.execute(
+        insert(UserTaskCounter).from_select(['user_id', 'pending'], _pending_source())
+    )
+    db.session.commit()
+    return result.rowcount
@@ -0,0 +1,112 @@
+"""Read-replica routing and connection pool settings.
+
+With ``DATABASE_REPLICA_URL`` set, views decorated with ``@read_only`` run
+their SELECTs on the replica. Flushes, INSERT/UPDATE/DELETE, ``SELECT ... FOR
+UPDATE`` and raw SQL always go to the primary, and so does everything in
+other views. Work inside a read-only view that has to see the primary (such
+as the analytics refresh) runs in ``with primary():``.
+
+A replica lags behind. So a user sees their own changes, every successful
+non-GET request that could have changed something sets the ``db_primary_until``
+cookie. For ``DATABASE_REPLICA_STICKY_SECONDS`` afterwards, that browser's
+read-only views read the primary too.
+
+Pools are per process. Each gunicorn worker (and each ``flask jobs worker``)
+opens up to ``DB_POOL_SIZE + DB_MAX_OVERFLOW`` connections to each database.
+Size them so that this times the number of processes stays below the
+server's ``max_connections``. SQLite keeps SQLAlchemy's own pool defaults.
+"""
+import functools
+import time
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+
+STICKY_COOKIE = 'db_primary_until'
+
+
+def _use_replica():
+    return has_request_context() and g.get('_db_replica', False)
+
+
+def _plain_select(clause):
+    return getattr(clause, 'is_select', False) and getattr(clause, '_for_update_arg', None) is None
+
+
+class RoutingSession(Session):
+    """``db.session`` class; sends plain SELECTs of ``@read_only`` views to the replica engine."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and _use_replica() and _plain_select(clause):
+            return replica_engine()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def replica_engine():
+    """The replica's engine, or None. It is not a Flask-SQLAlchemy bind: tables and migrations belong to the primary."""
+    return current_app.extensions.get('db_replica')
+
+
+def _sticky():
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def read_only(view):
+    """Read this view's data from the replica, unless the user changed something moments ago."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g._db_replica = replica_engine() is not None and not _sticky()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def primary():
+    """Route the enclosed statements to the primary, even inside a ``@read_only`` view."""
+    if not has_request_context():
+        yield
+        return
+    previous = g.get('_db_replica', False)
+    g._db_replica = False
+    try:
+        yield
+    finally:
+        g._db_replica = previous
+
+
+def _mark_writes(response):
+    if request.method in ('GET', 'HEAD', 'OPTIONS') or response.status_code >= 400 or replica_engine() is None:
+        return response
+    seconds = current_app.config['DATABASE_REPLICA_STICKY_SECONDS']
+    response.set_cookie(STICKY_COOKIE, f'{time.time() + seconds:.3f}', max_age=int(seconds) + 1, httponly=True,
+                        samesite='Lax', secure=current_app.config.get('SESSION_COOKIE_SECURE', False))
+    return response
+
+
+def pool_options(config, url):
+    """Engine pool options for ``url`` from the ``DB_POOL_*`` settings; none for SQLite."""
+    if url.startswith('sqlite'):
+        return {}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+
+def init_app(app):
+    """Call before ``db.init_app``: fills in the primary's pool options and creates the replica engine."""
+    cfg = app.config
+    cfg['SQLALCHEMY_ENGINE_OPTIONS'] = {**pool_options(cfg, cfg['SQLALCHEMY_DATABASE_URI']),
+                                        **cfg.get('SQLALCHEMY_ENGINE_OPTIONS', {})}
+    replica_url = cfg['DATABASE_REPLICA_URL']
+    if replica_url:
+        app.extensions['db_replica'] = sa.create_engine(replica_url, **pool_options(cfg, replica_url))
+        app.after_request(_mark_writes)
@@ -0,0 +1,274 @@
+"""Live task notifications over Server-Sent Events (``/events``).
+
+Each signed-in page keeps one ``EventSource`` open. Two kinds of events go
+to a user:
+
+* ``pending``: ``{"count": n}`` when their pending-task counter changed.
+* ``query``: ``{"id", "action", "status"}`` when a query they are the
+  auditor, employee or manager of got an audit event.
+
+Transitions queue events in ``session.info`` (counter changes via
+``app/counters.py``, audit rows via a flush hook; bulk transitions call
+``query_changed`` directly). At commit the new counter values are read in
+the same transaction and the events published:
+
+* PostgreSQL: ``pg_notify`` before the commit, so only committed changes
+  are announced. One listener thread per process (``LISTEN``) fans them out
+  to that process's streams, whichever worker made the change.
+* SQLite and tests: handed to this process's streams after the commit.
+
+A stream holds no database connection while idle and ends after
+``EVENTS_STREAM_SECONDS``; the browser reconnects on its own. Run the
+streams on gevent workers so idle connections cost a greenlet rather than a
+worker thread (see the README). Off unless ``EVENTS_ENABLED=1``: on plain sync
+workers every open page would hold a worker for the life of its stream.
+"""
+import json
+import queue
+import select
+import threading
+import time
+from collections import defaultdict
+
+from flask import Blueprint, Response, abort, current_app, has_app_context, stream_with_context
+from flask_login import current_user, login_required
+from sqlalchemy import event, func
+from sqlalchemy import select as sql_select
+from sqlalchemy.orm import Session
+
+from . import db
+from .models import AuditTrail, UserTaskCounter
+
+NOTIFY_PAYLOAD_LIMIT = 7000  # bytes; PostgreSQL rejects payloads of 8000 or more
+
+events_bp = Blueprint('events', __name__)
+
+
+# Brokers
+
+class LocalBroker:
+    """Streams of this process, by user id."""
+
+    def __init__(self, queue_size=100):
+        self._lock = threading.Lock()
+        self._streams = defaultdict(set)
+        self.queue_size = queue_size
+
+    def subscribe(self, user_id):
+        stream = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._streams[user_id].add(stream)
+        return stream
+
+    def unsubscribe(self, user_id, stream):
+        with self._lock:
+            streams = self._streams.get(user_id)
+            if streams is not None:
+                streams.discard(stream)
+                if not streams:
+                    del self._streams[user_id]
+
+    def dispatch(self, messages):
+        for message in messages:
+            with self._lock:
+                streams = list(self._streams.get(message['user'], ()))
+            for stream in streams:
+                try:
+                    stream.put_nowait(message)
+                except queue.Full:
+                    pass  # a stalled client; it resyncs from the next pending event or on reconnect
+
+    def before_commit(self, connection, messages):
+        pass
+
+    def after_commit(self, messages):
+        self.dispatch(messages)
+
+
+class PostgresBroker(LocalBroker):
+    """Publishes with NOTIFY in the committing transaction; a LISTEN thread dispatches to local streams."""
+
+    def __init__(self, engine, channel, queue_size=100, logger=None):
+        super().__init__(queue_size)
+        self.engine = engine
+        self.channel = channel
+        self.logger = logger
+        self._listener = None
+        self._started = threading.Lock()
+
+    def before_commit(self, connection, messages):
+        for payload in _payloads(messages):
+            connection.execute(sql_select(func.pg_notify(self.channel, payload)))
+
+    def after_commit(self, messages):
+        pass  # delivered by the listener, to this process like to every other
+
+    def subscribe(self, user_id):
+        with self._started:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='events-listen', daemon=True)
+                self._listener.start()
+        return super().subscribe(user_id)
+
+    def _listen(self):
+        while True:
+            conn = None
+            try:
+                conn = self.engine.raw_connection()
+                dbapi = conn.driver_connection
+                dbapi.autocommit = True
+                dbapi.cursor().execute(f'LISTEN "{self.channel}"')
+                while True:
+                    if select.select([dbapi], [], [], 60) == ([], [], []):
+                        continue
+                    dbapi.poll()
+                    while dbapi.notifies:
+                        self.dispatch(json.loads(dbapi.notifies.pop(0).payload))
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Event listener lost its connection; reconnecting')
+                if conn is not None:
+                    conn.invalidate()
+                time.sleep(1)
+
+
+def _payloads(messages):
+    """JSON arrays of ``messages``, each under the NOTIFY payload limit."""
+    batch, size = [], 2
+    for message in messages:
+        encoded = json.dumps(message, separators=(',', ':'))
+        if batch and size + len(encoded) + 1 > NOTIFY_PAYLOAD_LIMIT:
+            yield '[' + ','.join(batch) + ']'
+            batch, size = [], 2
+        batch.append(encoded)
+        size += len(encoded) + 1
+    if batch:
+        yield '[' + ','.join(batch) + ']'
+
+
+def broker():
+    return current_app.extensions.get('events') if has_app_context() else None
+
+
+# Queuing events with the transaction
+
+def _queued(session):
+    return session.info.setdefault('events', {'users': set(), 'queries': []})
+
+
+def _user_ids(values):
+    # Routes assign form values to the id columns, so they can still be strings here
+    return {int(u) for u in values if u}
+
+
+def counters_changed(user_ids):
+    """Announce the new pending counts of ``user_ids`` when the transaction commits."""
+    if broker() is not None:
+        _queued(db.session)['users'].update(user_ids)
+
+
+def query_changed(query_id, action, status, user_ids):
+    """Announce an event on query ``query_id`` to ``user_ids`` when the transaction commits."""
+    if broker() is not None:
+        _queued(db.session)['queries'].append((query_id, action, status, _user_ids(user_ids)))
+
+
+@event.listens_for(Session, 'after_flush')
+def _audit_events(session, flush_context):
+    if broker() is None:
+        return
+    for entry in session.new:
+        if isinstance(entry, AuditTrail) and entry.query is not None:
+            q = entry.query
+            _queued(session)['queries'].append(
+                (q.id, entry.action, q.status, _user_ids((q.auditor_id, q.assigned_employee_id, q.manager_id))))
+
+
+@event.listens_for(Session, 'before_commit')
+def _publish(session):
+    b = broker()
+    if b is None:
+        return
+    if session.new or session.dirty or session.deleted:
+        session.flush()  # audit rows added since the last flush queue their events here
+    pending = session.info.pop('events', None)
+    if pending is None:
+        return
+    # Several audit rows on one query in one transaction: each user hears of its last one
+    latest = {(u, qid): (action, status) for qid, action, status, users in pending['queries'] for u in users}
+    messages = [{'user': u, 'event': 'query', 'data': {'id': qid, 'action': action, 'status': status}}
+                for (u, qid), (action, status) in latest.items()]
+    if pending['users']:
+        counts = dict(session.execute(sql_select(UserTaskCounter.user_id, UserTaskCounter.pending)
+                                      .where(UserTaskCounter.user_id.in_(pending['users']))).all())
+        messages += [{'user': u, 'event': 'pending', 'data': {'count': counts.get(u, 0)}}
+                     for u in pending['users']]
+    if messages:
+        b.before_commit(session.connection(), messages)
+        session.info['events_ready'] = messages
+
+
+@event.listens_for(Session, 'after_commit')
+def _deliver(session):
+    messages = session.info.pop('events_ready', None)
+    b = broker()
+    if messages and b is not None:
+        b.after_commit(messages)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop('events', None)
+    session.info.pop('events_ready', None)
+
+
+# Stream
+
+def _format(name, data):
+    return f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+
+@events_bp.route('/events')
+@login_required
+def stream():
+    b = broker() or abort(404)
+    cfg = current_app.config
+    heartbeat, lifetime = cfg['EVENTS_HEARTBEAT_SECONDS'], cfg['EVENTS_STREAM_SECONDS']
+    user_id = current_user.id
+
+    @stream_with_context
+    def generate():
+        subscription = b.subscribe(user_id)
+        try:
+            # Subscribed first, so no change can slip in between this read and the first event
+            counter = db.session.get(UserTaskCounter, user_id)
+            count = counter.pending if counter else 0
+            db.session.remove()  # idle streams hold no connection
+            yield f'retry: {cfg["EVENTS_RETRY_MS"]}\n' + _format('pending', {'count': count})
+            deadline = time.monotonic() + lifetime
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    message = subscription.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield ': keepalive\n\n'  # keeps proxies from timing out the idle connection
+                    continue
+                yield _format(message['event'], message['data'])
+        finally:
+            b.unsubscribe(user_id, subscription)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def init_app(app):
+    if not app.config['EVENTS_ENABLED']:
+        return
+    with app.app_context():
+        engine = db.engine
+    backend = app.config['EVENTS_BACKEND'] or ('postgres' if engine.dialect.name == 'postgresql' else 'local')
+    if backend == 'postgres':
+        app.extensions['events'] = PostgresBroker(engine, app.config['EVENTS_CHANNEL'],
+                                                  app.config['EVENTS_QUEUE_SIZE'], app.logger)
+    else:
+        app.extensions['events'] = LocalBroker(app.config['EVENTS_QUEUE_SIZE'])
+    app.register_blueprint(events_bp)
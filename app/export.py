@@ -0,0 +1,100 @@
+"""Streaming audit-trail export.
+
+Rows are read through a server-side cursor (``stream_results``) in
+``yield_per`` batches, joined with actor and target names, formatted as CSV or
+JSON Lines into ~64 KiB text chunks and optionally gzip-compressed on the fly,
+so memory stays flat however many rows are exported.
+"""
+import csv
+import io
+import json
+import zlib
+from datetime import timedelta
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
+from . import db
+from .audit_format import describe, user_label
+from .models import AuditTrail, User
+
+COLUMNS = ['id', 'query_id', 'created_at', 'action', 'detail', 'actor_id', 'actor_name', 'target_id', 'target_name']
+# Positions in the rows yielded by audit_rows()
+PARAMS, ACTOR_ID, ACTOR_NAME, TARGET_ID, TARGET_NAME = 5, 6, 7, 8, 9
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+FLUSH_SIZE = 64 * 1024
+
+
+def audit_rows(date_from=None, date_to=None, batch_size=2000):
+    """Yield export rows in (created_at, id) order; ``date_to`` is inclusive (whole day).
+
+    ``detail`` is rendered from the structured event with the joined names.
+    """
+    actor = aliased(User)
+    target = aliased(User)
+    stmt = (
+        select(AuditTrail.id, AuditTrail.query_id, AuditTrail.created_at, AuditTrail.action, AuditTrail.detail,
+               AuditTrail.params, AuditTrail.user_id, func.coalesce(actor.full_name, actor.username),
+               AuditTrail.target_user_id, func.coalesce(target.full_name, target.username))
+        .outerjoin(actor, actor.id == AuditTrail.user_id)
+        .outerjoin(target, target.id == AuditTrail.target_user_id)
+        .order_by(AuditTrail.created_at, AuditTrail.id)
+    )
+    if date_from:
+        stmt = stmt.where(AuditTrail.created_at >= date_from)
+    if date_to:
+        stmt = stmt.where(AuditTrail.created_at < date_to + timedelta(days=1))
+    result = db.session.execute(stmt.execution_options(stream_results=True, yield_per=batch_size))
+    try:
+        for partition in result.partitions():
+            for row in partition:
+                detail = describe(row[3], row[PARAMS], row[4], user_label(row[ACTOR_ID], row[ACTOR_NAME]),
+                                  user_label(row[TARGET_ID], row[TARGET_NAME]))
+                yield (*row[:4], detail, *row[ACTOR_ID:])
+    finally:
+        result.close()
+
+
+def _csv_chunks(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for row in rows:
+        writer.writerow([row[0], row[1], row[2].isoformat() if row[2] else '', *row[3:]])
+        if buf.tell() >= FLUSH_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+def _jsonl_chunks(rows):
+    parts = []
+    size = 0
+    for row in rows:
+        record = dict(zip(COLUMNS, row))
+        record['created_at'] = row[2].isoformat() if row[2] else None
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        parts.append(line)
+        size += len(line)
+        if size >= FLUSH_SIZE:
+            yield ''.join(parts)
+            parts, size = [], 0
+    yield ''.join(parts)
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def export_audit_trail(fmt='csv', date_from=None, date_to=None, gzip=False):
+    """Return an iterator of ``bytes`` chunks for the requested export."""
+    rows = audit_rows(date_from, date_to)
+    text_chunks = _csv_chunks(rows) if fmt == 'csv' else _jsonl_chunks(rows)
+    chunks = (c.encode('utf-8') for c in text_chunks if c)
+    return gzip_chunks(chunks) if gzip else chunks
@@ -0,0 +1,169 @@
+"""Cache of rendered page fragments that only change when their data does.
+
+A fragment has a name (``comments:42``) and a version: a string that
+changes whenever its content would, such as the newest comment id of the
+query. Each backend keeps one entry per name, holding the version it was
+rendered for. So a new version replaces the old one, and stale versions do
+not pile up. Versions also include a hash of the fragment templates, so a
+deploy with changed templates re-renders everything.
+
+Backends (``FRAGMENT_CACHE``):
+
+* ``memory``: an LRU per process, capped at ``FRAGMENT_CACHE_MAX_BYTES``.
+* ``file``: one file per fragment under ``FRAGMENT_CACHE_PATH``, shared by
+  the gunicorn workers of a host.
+* ``sqlite``: a table in the SQLite file ``FRAGMENT_CACHE_PATH``, likewise shared.
+* ``''``: no cache; every fragment is rendered.
+"""
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+from markupsafe import Markup
+
+FRAGMENT_TEMPLATES = ('_attachment_list.html', '_comment_entries.html', '_audit_entries.html')
+
+
+class MemoryBackend:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # name -> (version, html), least recently used first
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cost(name, version, html):
+        # UTF-8 bytes, as FRAGMENT_CACHE_MAX_BYTES says; names and texts are often not ASCII
+        return len(name.encode()) + len(version.encode()) + len(html.encode())
+
+    def get(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+            return entry
+
+    def set(self, name, version, html):
+        cost = self._cost(name, version, html)
+        if cost > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(name, None)
+            if old is not None:
+                self.size -= self._cost(name, *old)
+            self._entries[name] = (version, html)
+            self.size += cost
+            while self.size > self.max_bytes:
+                evicted, entry = self._entries.popitem(last=False)
+                self.size -= self._cost(evicted, *entry)
+
+
+class FileBackend:
+    """``<version>\\n<html>`` per file; writes go through a temporary file and a rename."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name.replace(':', '-') + '.html')
+
+    def get(self, name):
+        try:
+            with open(self._path(name), encoding='utf-8') as fh:
+                version, _, html = fh.read().partition('\n')
+        except (FileNotFoundError, UnicodeDecodeError):
+            return None
+        return version, html
+
+    def set(self, name, version, html):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            fh.write(f'{version}\n{html}')
+        os.replace(tmp, self._path(name))
+
+
+class SqliteBackend:
+    """A ``fragment`` table in a separate SQLite file; one connection per thread."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS fragment (name TEXT PRIMARY KEY, version TEXT NOT NULL, '
+                         'html TEXT NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')  # readers do not wait for a writing worker
+            self._local.conn = conn
+        return conn
+
+    def get(self, name):
+        return self._connection().execute('SELECT version, html FROM fragment WHERE name = ?', (name,)).fetchone()
+
+    def set(self, name, version, html):
+        conn = self._connection()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO fragment (name, version, html) VALUES (?, ?, ?)',
+                             (name, version, html))
+        except sqlite3.OperationalError:
+            pass  # busy: the next view stores it
+
+
+class FragmentCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self._salt = None
+
+    def salt(self):
+        """Hash of the fragment templates and the settings they depend on."""
+        if self._salt is None:
+            env = current_app.jinja_env
+            cfg = current_app.config
+            # The database too: ids only identify content within one database
+            digest = hashlib.sha1(f"{cfg['SQLALCHEMY_DATABASE_URI']}|{cfg['DETAIL_PAGE_SIZE']}".encode())
+            for name in FRAGMENT_TEMPLATES:
+                digest.update(env.loader.get_source(env, name)[0].encode())
+            self._salt = digest.hexdigest()[:12]
+        return self._salt
+
+    def fetch(self, name, version, render):
+        version = f'{self.salt()}:{version}'
+        entry = self.backend.get(name)
+        if entry is not None and entry[0] == version:
+            return Markup(entry[1])
+        html = render()
+        self.backend.set(name, version, str(html))
+        return Markup(html)
+
+
+def fragment(name, version, render):
+    """The cached rendering of fragment ``name`` at ``version``, or ``render()`` (stored for next time)."""
+    cache = current_app.extensions.get('fragments')
+    if cache is None:
+        return Markup(render())
+    return cache.fetch(name, version, render)
+
+
+def init_app(app):
+    kind = app.config['FRAGMENT_CACHE']
+    path = app.config['FRAGMENT_CACHE_PATH']
+    if kind == 'memory':
+        backend = MemoryBackend(app.config['FRAGMENT_CACHE_MAX_BYTES'])
+    elif kind == 'file':
+        backend = FileBackend(path or os.path.join(tempfile.gettempdir(), 'ia-fragments'))
+    elif kind == 'sqlite':
+        backend = SqliteBackend(path or os.path.join(tempfile.gettempdir(), 'ia-fragments.sqlite3'))
+    elif not kind:
+        return
+    else:
+        raise ValueError(f'Unknown FRAGMENT_CACHE backend: {kind}')
+    app.extensions['fragments'] = FragmentCache(backend)
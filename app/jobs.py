@@ -0,0 +1,146 @@
+"""Database-backed background jobs.
+
+Work is queued as ``job`` rows in the caller's transaction, so a job exists
+exactly when the change that needs it was committed. ``flask jobs worker``
+runs a pool of threads that claim jobs with a conditional UPDATE (no external
+broker, no row locks held while working), execute the registered handler and
+retry failures with exponential backoff up to ``max_attempts``.
+"""
+import json
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func, select, update
+
+from . import db
+from .models import Job
+
+HANDLERS = {}
+
+
+def job_handler(kind):
+    """Register ``fn(job, payload)`` as the handler for jobs of ``kind``."""
+    def decorator(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+
+def enqueue(kind, payload=None, attachment=None, max_attempts=None, delay=0):
+    job = Job(kind=kind, payload=json.dumps(payload or {}), attachment=attachment,
+              max_attempts=max_attempts or current_app.config['JOB_MAX_ATTEMPTS'],
+              run_after=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(job)
+    return job
+
+
+def claim_next(worker_id, batch=10):
+    """Mark the oldest runnable job as running for ``worker_id`` and return it."""
+    now = datetime.utcnow()
+    candidates = db.session.execute(
+        select(Job.id).where(Job.status == 'queued', Job.run_after <= now).order_by(Job.id).limit(batch)
+    ).scalars().all()
+    for job_id in candidates:
+        claimed = db.session.execute(
+            update(Job).where(Job.id == job_id, Job.status == 'queued')
+            .values(status='running', locked_by=worker_id, locked_at=now, attempts=Job.attempts + 1)
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+    db.session.rollback()
+    return None
+
+
+def execute(job):
+    job_id = job.id
+    try:
+        handler = HANDLERS.get(job.kind)
+        if handler is None:
+            raise LookupError(f'no handler registered for job kind {job.kind!r}')
+        handler(job, json.loads(job.payload or '{}'))
+        job.status = 'done'
+        job.last_error = None
+        job.locked_by = None
+        db.session.commit()
+        return True
+    except Exception:
+        error = traceback.format_exc()
+        db.session.rollback()
+        current_app.logger.warning('Job %s failed (attempt %s): %s', job_id, job.attempts, error.strip().splitlines()[-1])
+        job = db.session.get(Job, job_id)
+        job.last_error = error[-4000:]
+        job.locked_by = None
+        if job.attempts >= job.max_attempts:
+            job.status = 'failed'
+            if job.attachment is not None:
+                job.attachment.processing_status = 'failed'
+        else:
+            job.status = 'queued'
+            backoff = current_app.config['JOB_RETRY_BASE_SECONDS'] * 2 ** (job.attempts - 1)
+            job.run_after = datetime.utcnow() + timedelta(seconds=backoff)
+        db.session.commit()
+        return False
+
+
+def requeue_stale(timeout):
+    """Return jobs whose worker died mid-run to the queue. Returns the count."""
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    count = db.session.execute(
+        update(Job).where(Job.status == 'running', Job.locked_at < cutoff)
+        .values(status='queued', locked_by=None)
+    ).rowcount
+    db.session.commit()
+    return count
+
+
+def run_pending(worker_id='inline'):
+    """Run every runnable job in this thread; returns how many were executed."""
+    count = 0
+    while True:
+        job = claim_next(worker_id)
+        if job is None:
+            return count
+        execute(job)
+        count += 1
+
+
+def run_worker(app, threads=1, poll_interval=1.0, once=False):
+    """Run ``threads`` polling loops until interrupted (or the queue drains with ``once``)."""
+    stop = threading.Event()
+    base_id = f'{socket.gethostname()}:{os.getpid()}'
+
+    def loop(n):
+        with app.app_context():
+            while not stop.is_set():
+                job = claim_next(f'{base_id}:{n}')
+                if job is None:
+                    if once:
+                        break
+                    db.session.remove()
+                    stop.wait(poll_interval)
+                    continue
+                execute(job)
+            db.session.remove()
+
+    with app.app_context():
+        requeue_stale(app.config['JOB_LOCK_TIMEOUT'])
+    workers = [threading.Thread(target=loop, args=(n,), name=f'job-worker-{n}', daemon=True) for n in range(threads)]
+    for t in workers:
+        t.start()
+    try:
+        while any(t.is_alive() for t in workers):
+            for t in workers:
+                t.join(timeout=0.5)
+    except KeyboardInterrupt:
+        stop.set()
+        for t in workers:
+            t.join()
+
+
+def status_counts():
+    return dict(db.session.execute(select(Job.status, func.count()).group_by(Job.status)).all())
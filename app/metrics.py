@@ -0,0 +1,281 @@
+"""Per-request instrumentation and a Prometheus ``/metrics`` endpoint.
+
+For every request this records wall time, the time spent in SQL (engine
+cursor events) and in templates (render signals), the number of SQL
+statements and the uploaded bytes. Observations are aggregated into
+histograms per endpoint.
+
+Requests slower than ``METRICS_SLOW_REQUEST_SECONDS`` are logged with that
+breakdown. So are requests that run one statement at least
+``METRICS_N_PLUS_ONE_THRESHOLD`` times, the signature of an N+1 query.
+
+Streamed responses (exports, ``attachments.zip``, ``/events``) are recorded
+when the server closes them, so their time and SQL include the body. File
+downloads are recorded when their headers are ready: the server sends the
+file without calling the response's close callbacks.
+
+``/metrics`` answers ``Authorization: Bearer <METRICS_TOKEN>`` and signed-in
+admins; everyone else gets 403.
+
+Each process keeps its own totals. With ``METRICS_DIR`` set, a process writes
+them to ``metrics-<pid>.json`` at most every ``METRICS_FLUSH_SECONDS``, and
+``/metrics`` sums the files of all gunicorn workers. Empty the directory when
+the server (re)starts.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, request, template_rendered, \
+    before_render_template
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (1024, 10240, 102400, 1048576, 5242880, 10485760, 52428800)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Request wall time.', DURATION_BUCKETS),
+    'http_request_sql_duration_seconds': ('Time spent executing SQL per request.', DURATION_BUCKETS),
+    'http_request_template_duration_seconds': ('Time spent rendering templates per request.', DURATION_BUCKETS),
+    'http_request_sql_statements': ('SQL statements executed per request.', COUNT_BUCKETS),
+    'http_request_upload_bytes': ('Request body size of uploads.', BYTES_BUCKETS),
+}
+COUNTERS = {
+    'http_requests_total': 'Requests by endpoint, method and status.',
+    'http_slow_requests_total': 'Requests slower than METRICS_SLOW_REQUEST_SECONDS.',
+    'http_n_plus_one_total': 'Requests that repeated one SQL statement past METRICS_N_PLUS_ONE_THRESHOLD.',
+}
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+class Registry:
+    """Histogram and counter totals of this process, keyed by metric name and label pairs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = defaultdict(dict)  # name -> {labels: [bucket counts..., sum, count]}
+        self.counters = defaultdict(Counter)  # name -> {labels: value}
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        with self._lock:
+            series = self.histograms[name].setdefault(labels, [0] * len(buckets) + [0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self.counters[name][labels] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'histograms': {n: [[list(k), v] for k, v in s.items()] for n, s in self.histograms.items()},
+                'counters': {n: [[list(k), v] for k, v in s.items()] for n, s in self.counters.items()},
+            }
+
+
+def merge(snapshots):
+    histograms, counters = defaultdict(dict), defaultdict(Counter)
+    for snap in snapshots:
+        for name, series in snap.get('histograms', {}).items():
+            for labels, values in series:
+                key = tuple(tuple(pair) for pair in labels)
+                total = histograms[name].get(key)
+                histograms[name][key] = values if total is None else [a + b for a, b in zip(total, values)]
+        for name, series in snap.get('counters', {}).items():
+            for labels, value in series:
+                counters[name][tuple(tuple(pair) for pair in labels)] += value
+    return histograms, counters
+
+
+def _label_text(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def render(histograms, counters):
+    """Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for labels, values in sorted(histograms.get(name, {}).items()):
+            for bound, count in zip(buckets, values):
+                lines.append(f'{name}_bucket{_label_text(labels, [("le", bound)])} {count}')
+            lines.append(f'{name}_bucket{_label_text(labels, [("le", "+Inf")])} {values[-1]}')
+            lines.append(f'{name}_sum{_label_text(labels)} {values[-2]}')
+            lines.append(f'{name}_count{_label_text(labels)} {values[-1]}')
+    for name, help_text in COUNTERS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for labels, value in sorted(counters.get(name, {}).items()):
+            lines.append(f'{name}{_label_text(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+# Per-process storage
+
+class MetricsStore:
+    def __init__(self, directory, flush_interval):
+        self.registry = Registry()
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._flushed_at = 0.0
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f'metrics-{os.getpid()}.json')
+
+    def flush(self, force=False):
+        if not self.directory or (not force and time.monotonic() - self._flushed_at < self.flush_interval):
+            return
+        self._flushed_at = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.registry.snapshot(), fh)
+        os.replace(tmp, self.path)
+
+    def collect(self):
+        if not self.directory:
+            return merge([self.registry.snapshot()])
+        self.flush(force=True)
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name.startswith('metrics-') and name.endswith('.json'):
+                try:
+                    with open(os.path.join(self.directory, name)) as fh:
+                        snapshots.append(json.load(fh))
+                except (OSError, ValueError):
+                    continue  # replaced or removed while reading
+        return merge(snapshots)
+
+
+# Request hooks
+
+class RequestStats:
+    __slots__ = ('start', 'sql_count', 'sql_time', 'template_time', 'template_starts', 'statements')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_starts = []
+        self.statements = Counter()
+
+
+def _stats():
+    return g.get('_request_stats') if has_request_context() else None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _stats() is not None:
+        conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _stats()
+    starts = conn.info.get('metrics_query_start')
+    if stats is None or not starts:
+        return
+    stats.sql_time += time.perf_counter() - starts.pop()
+    stats.sql_count += 1
+    stats.statements[statement] += 1
+
+
+def _before_render(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats.template_starts.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats.template_starts:
+        stats.template_time += time.perf_counter() - stats.template_starts.pop()
+
+
+def _start_request():
+    # Also clears the stats a streamed response left behind for its close callback
+    g._request_stats = RequestStats() if request.endpoint != 'metrics.metrics' else None
+
+
+def _finish_request(response):
+    stats = g.get('_request_stats')
+    if stats is None:
+        return response
+    app = current_app._get_current_object()
+    endpoint = (('endpoint', request.endpoint or 'unmatched'),)
+    upload = request.content_length if request.method in ('POST', 'PUT', 'PATCH') else None
+    where = (request.method, request.path)
+    status = response.status_code
+    if response.is_streamed and not response.direct_passthrough:
+        # The body is generated after this hook (and still counts SQL); record once the server is done with it.
+        # send_file's passthrough bodies are handed to the server without the close callbacks; they run no SQL.
+        response.call_on_close(lambda: _record(app, stats, endpoint, where, upload, status))
+    else:
+        g._request_stats = None
+        _record(app, stats, endpoint, where, upload, status)
+    return response
+
+
+def _record(app, stats, endpoint, where, upload, status):
+    cfg = app.config
+    store = app.extensions['metrics']
+    registry = store.registry
+    elapsed = time.perf_counter() - stats.start
+    method, path = where
+    route = endpoint + (('method', method),)
+    registry.observe('http_request_duration_seconds', route, elapsed)
+    registry.observe('http_request_sql_duration_seconds', route, stats.sql_time)
+    registry.observe('http_request_template_duration_seconds', route, stats.template_time)
+    registry.observe('http_request_sql_statements', route, stats.sql_count)
+    if upload:
+        registry.observe('http_request_upload_bytes', endpoint, upload)
+    registry.inc('http_requests_total', route + (('status', status),))
+    if elapsed >= cfg['METRICS_SLOW_REQUEST_SECONDS']:
+        registry.inc('http_slow_requests_total', endpoint)
+        app.logger.warning(
+            'Slow request %s %s (%s): %.3fs, SQL %.3fs in %d statements, templates %.3fs',
+            method, path, endpoint[0][1], elapsed, stats.sql_time, stats.sql_count, stats.template_time)
+    statement, repeats = stats.statements.most_common(1)[0] if stats.statements else (None, 0)
+    if repeats >= cfg['METRICS_N_PLUS_ONE_THRESHOLD']:
+        registry.inc('http_n_plus_one_total', endpoint)
+        app.logger.warning('Possible N+1 in %s %s (%s): statement run %d times: %s',
+                           method, path, endpoint[0][1], repeats, ' '.join(statement.split())[:300])
+    store.flush()
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if not (token and request.headers.get('Authorization') == f'Bearer {token}') and \
+            not (current_user.is_authenticated and current_user.role == 'admin'):
+        abort(403)
+    histograms, counters = current_app.extensions['metrics'].collect()
+    return Response(render(histograms, counters), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    app.extensions['metrics'] = MetricsStore(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'])
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    template_rendered.connect(_rendered, app)
+    before_render_template.connect(_before_render, app)
+    app.register_blueprint(metrics_bp)
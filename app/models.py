@@ -1,7 +1,11 @@
 from datetime import datetime
 from enum import Enum
 from flask_login import UserMixin
-from . import db, login_manager
+from . import db
+
+def _created_at(context):
+    # The same instant as created_at, not a second utcnow() a few microseconds later
+    return context.get_current_parameters().get('created_at') or datetime.utcnow()
 
 class QueryStatus(Enum):
     DRAFT = 'draft'
@@ -19,14 +23,14 @@ class User(db.Model, UserMixin):
     role = db.Column(db.String(30), nullable=False)  # auditor, employee, manager
     full_name = db.Column(db.String(120))
     email = db.Column(db.String(120))
+    auth_version = db.Column(db.Integer, nullable=False, default=0)  # bumped on every edit; see app/usercache.py
+
+    def get_id(self):
+        return f'{self.id}:{self.auth_version or 0}'
 
     def __repr__(self):
         return f"<User {self.username} ({self.role})>"
 
-@login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
-
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), unique=True, nullable=False)
@@ -55,6 +59,12 @@ class Query(db.Model):
     manager_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=0)  # bumped by every transition; see app/workflow.py
+    # Denormalized from the child tables for list views; kept in step by app/activity.py
+    last_activity_at = db.Column(db.DateTime, nullable=False, default=_created_at)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
+    attachment_count = db.Column(db.Integer, nullable=False, default=0)
+    reopen_count = db.Column(db.Integer, nullable=False, default=0)
 
     auditor = db.relationship('User', foreign_keys=[auditor_id])
     assigned_employee = db.relationship('User', foreign_keys=[assigned_employee_id])
@@ -70,6 +80,26 @@ class Query(db.Model):
     attachments = db.relationship('Attachment', backref='query', lazy=True, cascade='all, delete-orphan')
     audit_trail_entries = db.relationship('AuditTrail', backref='query', lazy=True, cascade='all, delete-orphan')
 
+    # Each role's desk: status-filtered lists and counts, and unfiltered lists in (updated_at, id) order
+    __table_args__ = (
+        db.Index('ix_query_auditor_status_updated', 'auditor_id', 'status', 'updated_at', 'id'),
+        db.Index('ix_query_employee_status_updated', 'assigned_employee_id', 'status', 'updated_at', 'id'),
+        db.Index('ix_query_manager_status_updated', 'manager_id', 'status', 'updated_at', 'id'),
+        db.Index('ix_query_auditor_updated', 'auditor_id', 'updated_at', 'id'),
+        db.Index('ix_query_employee_updated', 'assigned_employee_id', 'updated_at', 'id'),
+        db.Index('ix_query_manager_updated', 'manager_id', 'updated_at', 'id'),
+        # ... and in the other dashboard and API sort orders (see DASHBOARD_SORTS)
+        db.Index('ix_query_auditor_activity', 'auditor_id', 'last_activity_at', 'id'),
+        db.Index('ix_query_employee_activity', 'assigned_employee_id', 'last_activity_at', 'id'),
+        db.Index('ix_query_manager_activity', 'manager_id', 'last_activity_at', 'id'),
+        db.Index('ix_query_auditor_comments', 'auditor_id', 'comment_count', 'id'),
+        db.Index('ix_query_employee_comments', 'assigned_employee_id', 'comment_count', 'id'),
+        db.Index('ix_query_manager_comments', 'manager_id', 'comment_count', 'id'),
+        db.Index('ix_query_auditor_attachments', 'auditor_id', 'attachment_count', 'id'),
+        db.Index('ix_query_employee_attachments', 'assigned_employee_id', 'attachment_count', 'id'),
+        db.Index('ix_query_manager_attachments', 'manager_id', 'attachment_count', 'id'),
+    )
+
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     query_id = db.Column(db.Integer, db.ForeignKey('query.id'), nullable=False)
@@ -79,21 +109,40 @@ class Comment(db.Model):
 
     user = db.relationship('User')
 
+    __table_args__ = (db.Index('ix_comment_query_id', 'query_id', 'id'),)
+
+class StoredBlob(db.Model):
+    # One row per distinct file content in the attachment store; see app/storage.py
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+ATTACHMENT_STATUSES = ('pending', 'done', 'failed', 'infected')
+
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     query_id = db.Column(db.Integer, db.ForeignKey('query.id'), nullable=False)
-    filename = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(255), nullable=False)  # path relative to UPLOAD_FOLDER
     original_name = db.Column(db.String(255))
+    sha256 = db.Column(db.String(64), db.ForeignKey('stored_blob.sha256'), nullable=True)  # NULL for legacy flat files
+    size = db.Column(db.BigInteger)
+    mime_type = db.Column(db.String(100))
+    processing_status = db.Column(db.String(20))  # one of ATTACHMENT_STATUSES; NULL for legacy rows
     uploaded_by_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     uploaded_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     uploaded_by = db.relationship('User')
+    jobs = db.relationship('Job', backref='attachment', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (db.Index('ix_attachment_query_id', 'query_id', 'id'),)
 
 class AuditTrail(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     query_id = db.Column(db.Integer, db.ForeignKey('query.id'), nullable=False)
     action = db.Column(db.String(120), nullable=False)
-    detail = db.Column(db.Text)
+    detail = db.Column(db.Text)  # legacy pre-rendered text; new rows store params and render at read time
+    params = db.Column(db.JSON)  # typed event parameters, e.g. {"file": "evidence.xlsx"}
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     target_user_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # user impacted by the action (e.g., assigned employee, manager)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -101,9 +150,106 @@ class AuditTrail(db.Model):
     user = db.relationship('User', foreign_keys=[user_id])
     target_user = db.relationship('User', foreign_keys=[target_user_id])
 
+    __table_args__ = (
+        db.Index('ix_audit_trail_query_id', 'query_id', 'id'),
+        db.Index('ix_audit_trail_created_at', 'created_at', 'id'),  # date-range exports in time order
+    )
+
+class UserTaskCounter(db.Model):
+    # Materialized pending-task count for the navbar badge; see app/counters.py
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    pending = db.Column(db.Integer, nullable=False, default=0)
+
+class Job(db.Model):
+    # Background work item; see app/jobs.py
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(60), nullable=False)
+    payload = db.Column(db.Text)  # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(120))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    attachment_id = db.Column(db.Integer, db.ForeignKey('attachment.id'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_job_status_run_after', 'status', 'run_after', 'id'),)
+
+class BackfillCheckpoint(db.Model):
+    # Progress of a chunked backfill run (one row per backfill or per parallel slice); see app/backfill.py
+    name = db.Column(db.String(120), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    end_id = db.Column(db.Integer)
+    rows_seen = db.Column(db.Integer, nullable=False, default=0)
+    rows_changed = db.Column(db.Integer, nullable=False, default=0)
+    finished_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class SearchDocument(db.Model):
+    # One row per searchable text (query text + template, comment, attachment name); see app/search.py
+    id = db.Column(db.Integer, primary_key=True)
+    query_id = db.Column(db.Integer, db.ForeignKey('query.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # query, comment, attachment
+    source_id = db.Column(db.Integer, nullable=False)  # id of the Query/Comment/Attachment row
+    body = db.Column(db.Text, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'source_id', name='uq_search_document_source'),
+        db.Index('ix_search_document_query_id', 'query_id'),
+    )
+
+class QueryWorkflowStats(db.Model):
+    # Per-query summary folded from the audit trail; see app/analytics.py
+    query_id = db.Column(db.Integer, db.ForeignKey('query.id'), primary_key=True)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'))
+    employee_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    manager_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    status = db.Column(db.String(40), nullable=False)
+    status_since = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime)
+    cycle_seconds = db.Column(db.Float)  # creation to latest close; NULL while never closed
+    assigned_seconds = db.Column(db.Float, nullable=False, default=0)
+    submitted_seconds = db.Column(db.Float, nullable=False, default=0)
+    approved_seconds = db.Column(db.Float, nullable=False, default=0)
+    rejections = db.Column(db.Integer, nullable=False, default=0)
+    reopens = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_query_workflow_stats_category', 'category_id'),
+        db.Index('ix_query_workflow_stats_employee', 'employee_id'),
+        db.Index('ix_query_workflow_stats_manager', 'manager_id'),
+        db.Index('ix_query_workflow_stats_status_since', 'status', 'status_since'),
+    )
+
+class SummaryWatermark(db.Model):
+    # Highest source row id folded into a summary table; see app/analytics.py
+    name = db.Column(db.String(60), primary_key=True)
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class CacheVersion(db.Model):
+    # Cross-worker invalidation stamp for process-local caches; see app/refcache.py
+    name = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 # Utility functions
 
-def record_audit_action(query, action, detail, user_id=None, target_user_id=None):
-    entry = AuditTrail(query=query, action=action, detail=detail, user_id=user_id, target_user_id=target_user_id)
+def record_audit_action(query, action, user_id=None, target_user_id=None, **params):
+    """Add an audit event; display text is rendered from it later by app/audit_format.py."""
+    entry = AuditTrail(query=query, action=action, user_id=user_id, target_user_id=target_user_id, params=params or None)
     db.session.add(entry)
-
+    return entry
+
+
+def query_scope_for(user):
+    """Filter criterion limiting ``Query`` rows to those on ``user``'s desk."""
+    if user.role == 'auditor':
+        return Query.auditor_id == user.id
+    if user.role == 'employee':
+        return Query.assigned_employee_id == user.id
+    if user.role == 'manager':
+        return Query.manager_id == user.id
+    return None
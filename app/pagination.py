@@ -0,0 +1,69 @@
+"""Keyset (seek) pagination helpers shared by list views.
+
+A cursor is an opaque, URL-safe token holding the sort-key values of the last
+row on the previous page. The next page is fetched with a row-value comparison
+against those values, so the database seeks straight to the right index entry
+instead of counting past an OFFSET.
+"""
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values):
+    payload = []
+    for v in values:
+        if isinstance(v, datetime):
+            payload.append({'dt': v.isoformat()})
+        else:
+            payload.append(v)
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Return the list of values in ``token`` or None if it is missing/invalid."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(payload, list):
+        return None
+    values = []
+    for v in payload:
+        if isinstance(v, dict) and 'dt' in v:
+            try:
+                v = datetime.fromisoformat(v['dt'])
+            except (TypeError, ValueError):
+                return None
+        values.append(v)
+    return values
+
+
+def keyset_page(query, columns, cursor=None, limit=50, descending=True):
+    """Apply seek pagination on ``columns`` to ``query``.
+
+    Returns ``(rows, next_cursor)``; ``next_cursor`` is None on the last page.
+    ``columns`` must end with a unique column (normally the primary key) so
+    the ordering is total.
+    """
+    if descending:
+        query = query.order_by(*[c.desc() for c in columns])
+    else:
+        query = query.order_by(*[c.asc() for c in columns])
+    values = decode_cursor(cursor)
+    if values is not None and len(values) == len(columns):
+        key = tuple_(*columns)
+        query = query.filter(key < tuple(values) if descending else key > tuple(values))
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, c.key) for c in columns])
+    return rows, next_cursor
@@ -0,0 +1,84 @@
+"""Password hashing with configurable cost and rehash-on-login.
+
+``PASSWORD_HASH_METHOD`` is any werkzeug method string, e.g.
+``scrypt:32768:8:1`` or ``pbkdf2:sha256:600000``. Stored hashes made with
+other parameters still verify, and ``needs_rehash`` tells the login view to
+upgrade them while it has the plain password.
+
+Hash checks are deliberately slow. With ``PASSWORD_HASH_WORKERS`` > 0 they
+run in a small per-process thread pool (hashlib releases the GIL), so at
+most that many run at once and at most ``PASSWORD_HASH_QUEUE`` more wait.
+A check that finds no room within ``PASSWORD_HASH_WAIT`` seconds raises
+``HasherBusy`` and the login is refused with 503 instead of tying up every
+worker thread.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from flask import current_app
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    """Too many password checks are already running or queued."""
+
+
+def hash_password(password):
+    cfg = current_app.config
+    return generate_password_hash(password, method=cfg['PASSWORD_HASH_METHOD'], salt_length=cfg['PASSWORD_SALT_LENGTH'])
+
+
+@lru_cache(maxsize=8)
+def _parameters(method, salt_length):
+    # Let werkzeug fill in its defaults (e.g. 'pbkdf2:sha256' -> 'pbkdf2:sha256:600000')
+    stored_method, salt, _ = generate_password_hash('', method=method, salt_length=salt_length).split('$', 2)
+    return stored_method, len(salt)
+
+
+def needs_rehash(pwhash):
+    """True if ``pwhash`` was made with other parameters than the configured ones."""
+    cfg = current_app.config
+    try:
+        stored_method, salt, _ = pwhash.split('$', 2)
+    except ValueError:
+        return True
+    return (stored_method, len(salt)) != _parameters(cfg['PASSWORD_HASH_METHOD'], cfg['PASSWORD_SALT_LENGTH'])
+
+
+class BoundedHasher:
+    def __init__(self, workers, queue):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pwhash')
+        self._slots = threading.BoundedSemaphore(workers + queue)
+
+    def check(self, pwhash, password, timeout):
+        if not self._slots.acquire(timeout=timeout):
+            raise HasherBusy()
+        try:
+            return self._executor.submit(check_password_hash, pwhash, password).result()
+        finally:
+            self._slots.release()
+
+
+def init_app(app):
+    workers = app.config['PASSWORD_HASH_WORKERS']
+    if workers > 0:
+        app.extensions['password_hasher'] = BoundedHasher(workers, app.config['PASSWORD_HASH_QUEUE'])
+
+
+def verify_password(pwhash, password):
+    hasher = current_app.extensions.get('password_hasher')
+    if hasher is None:
+        return check_password_hash(pwhash, password)
+    return hasher.check(pwhash, password, current_app.config['PASSWORD_HASH_WAIT'])
+
+
+def dummy_hash():
+    """A hash with the configured cost, checked for unknown usernames so they take as long as wrong passwords."""
+    cfg = current_app.config
+    return _dummy(cfg['PASSWORD_HASH_METHOD'], cfg['PASSWORD_SALT_LENGTH'])
+
+
+@lru_cache(maxsize=8)
+def _dummy(method, salt_length):
+    return generate_password_hash('unused', method=method, salt_length=salt_length)
@@ -0,0 +1,137 @@
+"""Post-upload attachment processing, run by the job worker.
+
+Each upload enqueues one ``attachment.process`` job. The handler sniffs the
+real content type, calls the optional malware-scan hook, and writes derived
+artifacts (thumbnail, extracted text) under ``<UPLOAD_FOLDER>/derived``, keyed
+by content hash so deduplicated files are processed once. Thumbnails need
+Pillow (images) or poppler's ``pdftoppm`` (PDFs); text extraction from PDFs
+needs ``pdftotext``. Missing tools just skip that step.
+"""
+import os
+import re
+import shutil
+import subprocess
+import zipfile
+from importlib import import_module
+
+from flask import current_app
+
+from .jobs import job_handler
+from .storage import attachment_path
+
+MAGIC = [
+    (b'%PDF', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),  # legacy .xls/.doc
+    (b'PK\x03\x04', 'application/zip'),
+]
+OOXML_TYPES = {
+    'xl/': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'word/': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+}
+OLE_TYPES = {'xls': 'application/vnd.ms-excel', 'doc': 'application/msword'}
+THUMBNAIL_SIZE = (256, 256)
+
+
+def sniff_type(path, original_name):
+    with open(path, 'rb') as f:
+        head = f.read(4096)
+    ext = original_name.rsplit('.', 1)[-1].lower() if original_name and '.' in original_name else ''
+    for magic, mime in MAGIC:
+        if head.startswith(magic):
+            if mime == 'application/zip':
+                try:
+                    with zipfile.ZipFile(path) as zf:
+                        names = zf.namelist()
+                except zipfile.BadZipFile:
+                    return mime
+                for prefix, ooxml in OOXML_TYPES.items():
+                    if any(n.startswith(prefix) for n in names):
+                        return ooxml
+            if mime == 'application/x-ole-storage':
+                return OLE_TYPES.get(ext, mime)
+            return mime
+    try:
+        head.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'application/octet-stream'
+    return 'text/csv' if ext == 'csv' else 'text/plain'
+
+
+def derived_path(sha256, suffix):
+    folder = os.path.join(current_app.config['UPLOAD_FOLDER'], 'derived', sha256[:2], sha256[2:4])
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f'{sha256}.{suffix}')
+
+
+def run_scan_hook(path):
+    """Call ``ATTACHMENT_SCAN_HOOK`` ('package.module:function'); True means clean."""
+    spec = current_app.config['ATTACHMENT_SCAN_HOOK']
+    if not spec:
+        return True
+    module, _, name = spec.partition(':')
+    return bool(getattr(import_module(module), name)(path))
+
+
+def make_thumbnail(path, mime, target):
+    if mime.startswith('image/'):
+        try:
+            from PIL import Image
+        except ImportError:
+            return False
+        with Image.open(path) as im:
+            im.thumbnail(THUMBNAIL_SIZE)
+            im.convert('RGB').save(target, 'PNG')
+        return True
+    if mime == 'application/pdf' and shutil.which('pdftoppm'):
+        subprocess.run(['pdftoppm', '-png', '-singlefile', '-f', '1', '-scale-to', str(THUMBNAIL_SIZE[0]),
+                        path, target[:-len('.png')]], check=True, timeout=60, capture_output=True)
+        return True
+    return False
+
+
+def _xml_text(zf, members):
+    parts = []
+    for name in members:
+        if name in zf.namelist():
+            parts.append(re.sub(r'<[^>]+>', ' ', zf.read(name).decode('utf-8', 'replace')))
+    return re.sub(r'\s+', ' ', ' '.join(parts)).strip()
+
+
+def extract_text(path, mime):
+    if mime.startswith('text/'):
+        with open(path, 'rb') as f:
+            return f.read().decode('utf-8', 'replace')
+    if mime == OOXML_TYPES['word/']:
+        with zipfile.ZipFile(path) as zf:
+            return _xml_text(zf, ['word/document.xml'])
+    if mime == OOXML_TYPES['xl/']:
+        with zipfile.ZipFile(path) as zf:
+            return _xml_text(zf, ['xl/sharedStrings.xml'])
+    if mime == 'application/pdf' and shutil.which('pdftotext'):
+        result = subprocess.run(['pdftotext', '-q', path, '-'], check=True, timeout=120, capture_output=True)
+        return result.stdout.decode('utf-8', 'replace')
+    return None
+
+
+@job_handler('attachment.process')
+def process_attachment(job, payload):
+    att = job.attachment
+    path = attachment_path(att)
+    att.mime_type = sniff_type(path, att.original_name)
+    if not run_scan_hook(path):
+        att.processing_status = 'infected'
+        current_app.logger.warning('Attachment %s failed the malware scan', att.id)
+        return
+    if att.sha256:
+        thumb = derived_path(att.sha256, 'thumb.png')
+        if not os.path.exists(thumb):
+            make_thumbnail(path, att.mime_type, thumb)
+        text_path = derived_path(att.sha256, 'txt')
+        if not os.path.exists(text_path):
+            text = extract_text(path, att.mime_type)
+            if text is not None:
+                with open(text_path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+    att.processing_status = 'done'
@@ -1,24 +1,70 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_from_directory, jsonify, current_app
+from datetime import datetime, timedelta
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app, abort, Response, stream_with_context
 from flask_login import login_required, current_user
-from werkzeug.utils import secure_filename
-from . import db, allowed_file
-from .models import Category, SubCategory, QueryTemplate, Query, User, Comment, Attachment, record_audit_action, QueryStatus
+from sqlalchemy import case, func, or_, select
+from sqlalchemy.orm import joinedload
+from . import db, export, search, workflow
+from .database import read_only
+from .fragcache import fragment
+from .models import Query, User, Comment, Attachment, AuditTrail, CacheVersion, ATTACHMENT_STATUSES, record_audit_action, QueryStatus, query_scope_for
+from .pagination import keyset_page
+from .counters import update_pending_counters
+from .refcache import reference_data
+from .storage import save_attachment, send_attachment, iter_zip
+from .usercache import USERS
+from .audit_format import audit_views
 
 query_bp = Blueprint('query', __name__)
 
+# sort= value -> keyset columns; each role's desk has an index for every order (see the Query model)
+DASHBOARD_SORTS = {
+    'updated': (Query.updated_at, Query.id),
+    'activity': (Query.last_activity_at, Query.id),
+    'comments': (Query.comment_count, Query.id),
+    'attachments': (Query.attachment_count, Query.id),
+}
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
 @query_bp.route('/')
 @login_required
+@read_only
 def dashboard():
     # Basic segregation by role
-    if current_user.role == 'auditor':
-        queries = Query.query.filter_by(auditor_id=current_user.id).all()
-    elif current_user.role == 'employee':
-        queries = Query.query.filter_by(assigned_employee_id=current_user.id).all()
-    elif current_user.role == 'manager':
-        queries = Query.query.filter_by(manager_id=current_user.id).all()
-    else:
-        queries = []
-    return render_template('dashboard.html', queries=queries)
+    scope = query_scope_for(current_user)
+    if scope is None:
+        return render_template('dashboard.html', queries=[], next_cursor=None, filters={}, categories=[], statuses=[])
+    filters = {
+        'status': request.args.get('status') or '',
+        'category': request.args.get('category', type=int),
+        'date_from': request.args.get('date_from') or '',
+        'date_to': request.args.get('date_to') or '',
+        'order': 'asc' if request.args.get('order') == 'asc' else 'desc',
+        'sort': request.args.get('sort') if request.args.get('sort') in DASHBOARD_SORTS else 'updated',
+    }
+    qry = Query.query.filter(scope).options(
+        joinedload(Query.category), joinedload(Query.assigned_employee), joinedload(Query.manager))
+    if filters['status'] in {s.value for s in QueryStatus}:
+        qry = qry.filter(Query.status == filters['status'])
+    if filters['category']:
+        qry = qry.filter(Query.category_id == filters['category'])
+    date_from = _parse_date(filters['date_from'])
+    if date_from:
+        qry = qry.filter(Query.updated_at >= date_from)
+    date_to = _parse_date(filters['date_to'])
+    if date_to:
+        qry = qry.filter(Query.updated_at < date_to + timedelta(days=1))
+    queries, next_cursor = keyset_page(qry, list(DASHBOARD_SORTS[filters['sort']]), request.args.get('cursor'),
+                                       limit=current_app.config['DASHBOARD_PAGE_SIZE'],
+                                       descending=filters['order'] == 'desc')
+    categories = reference_data().categories
+    employees = User.query.filter_by(role='employee').all() if current_user.role == 'auditor' else []
+    return render_template('dashboard.html', queries=queries, next_cursor=next_cursor, filters=filters,
+                           categories=categories, statuses=[s.value for s in QueryStatus], employees=employees)
 
 @query_bp.route('/query/new', methods=['GET','POST'])
 @login_required
@@ -26,9 +72,6 @@ def new_query():
     if current_user.role != 'auditor':
         flash('Only auditors can create queries', 'warning')
         return redirect(url_for('query.dashboard'))
-    categories = Category.query.all()
-    templates = QueryTemplate.query.all()
-    employees = User.query.filter_by(role='employee').all()
     if request.method == 'POST':
         category_id = request.form.get('category')
         subcategory_id = request.form.get('subcategory') or None
@@ -41,55 +84,130 @@ def new_query():
                   status=QueryStatus.ASSIGNED.value if assigned_employee_id else QueryStatus.DRAFT.value)
         db.session.add(q)
         db.session.flush()
-        record_audit_action(q, 'created', f'Query created by auditor (ID {current_user.id}) {current_user.full_name or current_user.username}', user_id=current_user.id)
+        update_pending_counters(set(), q)
+        record_audit_action(q, 'created', user_id=current_user.id)
         if assigned_employee_id:
-            emp = User.query.get(int(assigned_employee_id))
-            if emp:
-                record_audit_action(q, 'assigned', f'Assigned to employee (ID {emp.id}) {emp.full_name or emp.username}', user_id=current_user.id, target_user_id=emp.id)
+            record_audit_action(q, 'assigned', user_id=current_user.id, target_user_id=int(assigned_employee_id))
         # handle files
         for f in request.files.getlist('attachments'):
-            if f and allowed_file(f.filename):
-                filename = secure_filename(f.filename)
-                save_path = current_app.config['UPLOAD_FOLDER']
-                f.save(f"{save_path}/{q.id}_{filename}")
-                att = Attachment(query_id=q.id, filename=f"{q.id}_{filename}", original_name=filename, uploaded_by_id=current_user.id)
-                db.session.add(att)
-                record_audit_action(q, 'file_upload', f'File {filename} uploaded by (ID {current_user.id}) {current_user.full_name or current_user.username}', user_id=current_user.id)
+            att = save_attachment(q.id, f, current_user.id)
+            if att:
+                record_audit_action(q, 'file_upload', user_id=current_user.id, file=att.original_name)
         db.session.commit()
         flash('Query created', 'success')
         return redirect(url_for('query.dashboard'))
-    return render_template('new_query.html', categories=categories, templates=templates, employees=employees)
+    ref = reference_data()
+    employees = User.query.filter_by(role='employee').all()
+    return render_template('new_query.html', categories=ref.categories, templates=ref.templates, employees=employees)
 
 @query_bp.route('/subcategories/<int:category_id>')
 @login_required
+@read_only
 def get_subcategories(category_id):
-    subs = SubCategory.query.filter_by(category_id=category_id).all()
-    return jsonify([{'id': s.id, 'name': s.name} for s in subs])
+    ref = reference_data()
+    resp = jsonify([{'id': s.id, 'name': s.name} for s in ref.subcategories.get(category_id, [])])
+    # Content only changes with the reference version, so browsers can revalidate cheaply
+    resp.set_etag(f'ref-{ref.version}-{category_id}')
+    resp.cache_control.private = True
+    resp.cache_control.max_age = current_app.config['SUBCATEGORIES_MAX_AGE']
+    return resp.make_conditional(request)
+
+def _audit_page(query_id, cursor=None):
+    qry = db.session.query(AuditTrail).filter_by(query_id=query_id)
+    entries, next_cursor = keyset_page(qry, [AuditTrail.id], cursor, limit=current_app.config['DETAIL_PAGE_SIZE'])
+    return audit_views(entries), next_cursor
+
+def _comment_page(query_id, cursor=None):
+    qry = db.session.query(Comment).filter_by(query_id=query_id).options(joinedload(Comment.user))
+    return keyset_page(qry, [Comment.id], cursor, limit=current_app.config['DETAIL_PAGE_SIZE'])
+
+def _section_versions(query_id):
+    """Versions of the audit, comment and attachment sections of a query.
+
+    Newest audit, comment and attachment ids, plus attachment counts per processing status. The sections show
+    user names, resolved at render time, so each version also carries the ``users`` cache version that user
+    renames bump (app/usercache.py).
+    """
+    newest_audit = select(func.max(AuditTrail.id)).where(AuditTrail.query_id == query_id).scalar_subquery()
+    newest_comment = select(func.max(Comment.id)).where(Comment.query_id == query_id).scalar_subquery()
+    users = select(CacheVersion.version).where(CacheVersion.name == USERS).scalar_subquery()
+    row = db.session.execute(
+        select(users, newest_audit, newest_comment, func.max(Attachment.id),
+               *(func.sum(case((Attachment.processing_status == s, 1), else_=0)) for s in ATTACHMENT_STATUSES))
+        .where(Attachment.query_id == query_id)
+    ).one()
+    names = f'u{row[0] or 0}'
+    attachments = '-'.join(str(v or 0) for v in row[3:])
+    return f'{row[1]}:{names}', f'{row[2]}:{names}', f'{attachments}:{names}'
+
+def _render_attachments(query_id):
+    attachments = db.session.query(Attachment).filter_by(query_id=query_id).options(
+        joinedload(Attachment.uploaded_by)).order_by(Attachment.id).all()
+    return render_template('_attachment_list.html', query_id=query_id, attachments=attachments)
+
+def _render_comments(query_id):
+    comments, comment_cursor = _comment_page(query_id)
+    return render_template('_comment_entries.html', query_id=query_id, comments=comments, comment_cursor=comment_cursor)
+
+def _render_audit(query_id):
+    audit_trail, audit_cursor = _audit_page(query_id)
+    return render_template('_audit_entries.html', query_id=query_id, audit_trail=audit_trail, audit_cursor=audit_cursor)
 
 @query_bp.route('/query/<int:query_id>')
 @login_required
+@read_only
 def view_query(query_id):
-    q = Query.query.get_or_404(query_id)
-    audit_trail = q.audit_trail_entries
-    comments = q.comments
+    q = Query.query.filter_by(id=query_id).options(
+        joinedload(Query.category), joinedload(Query.subcategory), joinedload(Query.template),
+        joinedload(Query.assigned_employee), joinedload(Query.manager),
+    ).first_or_404()
+    # The history sections only grow, so their newest ids (and the user names version) identify their content;
+    # only the forms vary per user.
+    # They show the newest entries only; older ones are fetched on demand by the fragment routes below.
+    audit_version, comment_version, attachment_version = _section_versions(query_id)
+    sections = {
+        'attachments': fragment(f'attachments:{query_id}', attachment_version, lambda: _render_attachments(query_id)),
+        'comments': fragment(f'comments:{query_id}', comment_version, lambda: _render_comments(query_id)),
+        'audit_trail': fragment(f'audit:{query_id}', audit_version, lambda: _render_audit(query_id)),
+    }
     employees = User.query.filter_by(role='employee').all()
     managers = User.query.filter_by(role='manager').all()
-    return render_template('query_detail.html', q=q, audit_trail=audit_trail, comments=comments, employees=employees, managers=managers)
+    transitions = {name for name in workflow.TRANSITIONS if workflow.allowed(name, q, current_user)}
+    return render_template('query_detail.html', q=q, query_id=query_id, sections=sections,
+                           employees=employees, managers=managers, transitions=transitions)
+
+@query_bp.route('/query/<int:query_id>/audit_trail')
+@login_required
+@read_only
+def audit_trail_fragment(query_id):
+    audit_trail, audit_cursor = _audit_page(query_id, request.args.get('cursor'))
+    return render_template('_audit_entries.html', query_id=query_id, audit_trail=audit_trail, audit_cursor=audit_cursor)
+
+@query_bp.route('/query/<int:query_id>/comments')
+@login_required
+@read_only
+def comments_fragment(query_id):
+    comments, comment_cursor = _comment_page(query_id, request.args.get('cursor'))
+    return render_template('_comment_entries.html', query_id=query_id, comments=comments, comment_cursor=comment_cursor)
+
+def _transition(query_id, name, value=None):
+    """Apply workflow transition ``name`` for the current user; flashes and returns False if refused."""
+    try:
+        workflow.apply(name, query_id, current_user, value, expected=workflow.expected_state(request.form))
+    except workflow.TransitionError as exc:
+        db.session.rollback()
+        flash(str(exc), 'danger')
+        return False
+    return True
 
 @query_bp.route('/query/<int:query_id>/assign', methods=['POST'])
 @login_required
 def assign_employee(query_id):
-    q = Query.query.get_or_404(query_id)
     if current_user.role != 'auditor':
         flash('Only auditor can assign employee', 'warning')
         return redirect(url_for('query.view_query', query_id=query_id))
-    emp_id = request.form.get('assigned_employee')
-    if emp_id:
-        q.assigned_employee_id = emp_id
-        q.status = QueryStatus.ASSIGNED.value
-        emp = User.query.get(int(emp_id))
-        if emp:
-            record_audit_action(q, 'assigned', f'Assigned to employee (ID {emp.id}) {emp.full_name or emp.username}', user_id=current_user.id, target_user_id=emp.id)
+    emp_id = request.form.get('assigned_employee', type=int)
+    if emp_id and _transition(query_id, 'assign', emp_id):
         db.session.commit()
         flash('Employee assigned', 'success')
     return redirect(url_for('query.view_query', query_id=query_id))
@@ -97,26 +215,14 @@ def assign_employee(query_id):
 @query_bp.route('/query/<int:query_id>/employee_submit', methods=['POST'])
 @login_required
 def employee_submit(query_id):
-    q = Query.query.get_or_404(query_id)
-    if current_user.role != 'employee' or q.assigned_employee_id != current_user.id:
-        flash('Not authorized', 'danger')
+    if not _transition(query_id, 'submit', request.form.get('manager_id', type=int)):
         return redirect(url_for('query.view_query', query_id=query_id))
-    manager_id = request.form.get('manager_id')
-    q.manager_id = manager_id
-    q.status = QueryStatus.EMPLOYEE_SUBMITTED.value
-    mgr = User.query.get(int(manager_id)) if manager_id else None
-    if mgr:
-        record_audit_action(q, 'employee_submitted', f'Submitted to manager (ID {mgr.id}) {mgr.full_name or mgr.username}', user_id=current_user.id, target_user_id=mgr.id)
-    else:
-        record_audit_action(q, 'employee_submitted', 'Submitted to manager (ID unknown)', user_id=current_user.id)
+    q = None
     for f in request.files.getlist('attachments'):
-        if f and allowed_file(f.filename):
-            filename = secure_filename(f.filename)
-            save_path = current_app.config['UPLOAD_FOLDER']
-            f.save(f"{save_path}/{q.id}_{filename}")
-            att = Attachment(query_id=q.id, filename=f"{q.id}_{filename}", original_name=filename, uploaded_by_id=current_user.id)
-            db.session.add(att)
-            record_audit_action(q, 'file_upload', f'File {filename} uploaded by (ID {current_user.id}) {current_user.full_name or current_user.username}', user_id=current_user.id)
+        att = save_attachment(query_id, f, current_user.id)
+        if att:
+            q = q or db.session.get(Query, query_id)
+            record_audit_action(q, 'file_upload', user_id=current_user.id, file=att.original_name)
     db.session.commit()
     flash('Submitted to manager', 'success')
     return redirect(url_for('query.view_query', query_id=query_id))
@@ -124,47 +230,83 @@ def employee_submit(query_id):
 @query_bp.route('/query/<int:query_id>/manager_decide', methods=['POST'])
 @login_required
 def manager_decide(query_id):
-    q = Query.query.get_or_404(query_id)
-    if current_user.role != 'manager' or q.manager_id != current_user.id:
-        flash('Not authorized', 'danger')
-        return redirect(url_for('query.view_query', query_id=query_id))
-    decision = request.form.get('decision')
-    if decision == 'approve':
-        q.status = QueryStatus.MANAGER_APPROVED.value
-        record_audit_action(q, 'manager_approved', f'Manager (ID {current_user.id}) {current_user.full_name or current_user.username} approved submission', user_id=current_user.id, target_user_id=q.assigned_employee_id)
-    else:
-        q.status = QueryStatus.MANAGER_REJECTED.value
-        record_audit_action(q, 'manager_rejected', f'Manager (ID {current_user.id}) {current_user.full_name or current_user.username} rejected submission', user_id=current_user.id, target_user_id=q.assigned_employee_id)
-    db.session.commit()
-    flash('Manager decision recorded', 'success')
+    if _transition(query_id, 'approve' if request.form.get('decision') == 'approve' else 'reject'):
+        db.session.commit()
+        flash('Manager decision recorded', 'success')
     return redirect(url_for('query.view_query', query_id=query_id))
 
 @query_bp.route('/query/<int:query_id>/auditor_close', methods=['POST'])
 @login_required
 def auditor_close(query_id):
-    q = Query.query.get_or_404(query_id)
-    if current_user.role != 'auditor' or q.auditor_id != current_user.id:
-        flash('Not authorized', 'danger')
-        return redirect(url_for('query.view_query', query_id=query_id))
-    q.status = QueryStatus.CLOSED.value
-    record_audit_action(q, 'closed', f'Auditor (ID {current_user.id}) {current_user.full_name or current_user.username} closed query', user_id=current_user.id, target_user_id=q.assigned_employee_id)
-    db.session.commit()
-    flash('Query closed', 'success')
+    if _transition(query_id, 'close'):
+        db.session.commit()
+        flash('Query closed', 'success')
     return redirect(url_for('query.view_query', query_id=query_id))
 
 @query_bp.route('/query/<int:query_id>/auditor_reopen', methods=['POST'])
 @login_required
 def auditor_reopen(query_id):
-    q = Query.query.get_or_404(query_id)
-    if current_user.role != 'auditor' or q.auditor_id != current_user.id:
-        flash('Not authorized', 'danger')
-        return redirect(url_for('query.view_query', query_id=query_id))
-    q.status = QueryStatus.REOPENED.value
-    record_audit_action(q, 'reopened', f'Auditor (ID {current_user.id}) {current_user.full_name or current_user.username} reopened query', user_id=current_user.id, target_user_id=q.assigned_employee_id)
-    db.session.commit()
-    flash('Query reopened', 'success')
+    if _transition(query_id, 'reopen'):
+        db.session.commit()
+        flash('Query reopened', 'success')
     return redirect(url_for('query.view_query', query_id=query_id))
 
+@query_bp.route('/queries/bulk/<action>', methods=['POST'])
+@login_required
+def bulk_action(action):
+    """Apply one transition to many queries with a single UPDATE, INSERT and commit."""
+    if action not in workflow.BULK_TRANSITIONS:
+        abort(404)
+    if current_user.role != 'auditor':
+        flash('Only auditors can run bulk actions', 'warning')
+        return redirect(url_for('query.dashboard'))
+    ids = sorted({int(x) for x in request.form.getlist('query_ids') if x.isdigit()})[:current_app.config['BULK_MAX_QUERIES']]
+    emp = None
+    if action == 'assign':
+        emp_id = request.form.get('assigned_employee', type=int)
+        emp = User.query.filter_by(id=emp_id, role='employee').first() if emp_id else None
+        if emp is None:
+            flash('Select an employee to assign', 'warning')
+            return redirect(url_for('query.dashboard'))
+    updated, skipped = workflow.apply_many(action, ids, current_user, emp.id if emp else None)
+    db.session.commit()
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'action': action, 'updated': updated,
+                        'skipped': [{'id': qid, 'reason': reason} for qid, reason in sorted(skipped.items())]})
+    flash(f'{action.capitalize()}: {len(updated)} queries updated', 'success' if updated else 'warning')
+    if skipped:
+        flash('Skipped ' + ', '.join(f'#{qid} ({reason})' for qid, reason in sorted(skipped.items())), 'warning')
+    return redirect(url_for('query.dashboard'))
+
+@query_bp.route('/search')
+@login_required
+@read_only
+def search_queries():
+    terms = (request.args.get('q') or '').strip()
+    hits, next_cursor = search.search(query_scope_for(current_user), terms, request.args.get('cursor'),
+                                      limit=current_app.config['SEARCH_PAGE_SIZE'])
+    return render_template('search.html', terms=terms, hits=hits, next_cursor=next_cursor)
+
+@query_bp.route('/audit_trail/export')
+@login_required
+@read_only
+def export_audit_trail():
+    if current_user.role not in ('auditor', 'admin'):
+        flash('Only auditors can export the audit trail', 'warning')
+        return redirect(url_for('query.dashboard'))
+    fmt = request.args.get('format')
+    if fmt not in export.FORMATS:
+        return render_template('audit_export.html', formats=sorted(export.FORMATS))
+    date_from = _parse_date(request.args.get('date_from'))
+    date_to = _parse_date(request.args.get('date_to'))
+    gzip = request.args.get('gzip') == '1'
+    filename = f'audit_trail.{fmt}' + ('.gz' if gzip else '')
+    chunks = export.export_audit_trail(fmt, date_from, date_to, gzip=gzip)
+    return Response(stream_with_context(chunks), mimetype='application/gzip' if gzip else export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename={filename}',
+                             'Cache-Control': 'private, no-store'})
+
 @query_bp.route('/query/<int:query_id>/comment', methods=['POST'])
 @login_required
 def add_comment(query_id):
@@ -173,12 +315,31 @@ def add_comment(query_id):
     if content:
         c = Comment(query_id=query_id, user_id=current_user.id, content=content)
         db.session.add(c)
-        record_audit_action(q, 'comment', f'Comment added by (ID {current_user.id}) {current_user.full_name or current_user.username}', user_id=current_user.id)
+        record_audit_action(q, 'comment', user_id=current_user.id)
         db.session.commit()
         flash('Comment added', 'success')
     return redirect(url_for('query.view_query', query_id=query_id))
 
-@query_bp.route('/uploads/<path:filename>')
+@query_bp.route('/attachments/<int:attachment_id>')
 @login_required
-def download_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, as_attachment=True)
+def download_file(attachment_id):
+    att = db.session.get(Attachment, attachment_id) or abort(404)
+    if att.processing_status == 'infected':
+        abort(403)
+    return send_attachment(att)
+
+@query_bp.route('/query/<int:query_id>/attachments.zip')
+@login_required
+def download_all_attachments(query_id):
+    q = Query.query.get_or_404(query_id)
+    # Quarantined files are refused one by one (download_file), so they stay out of the archive too;
+    # legacy rows have no processing status at all
+    attachments = (db.session.query(Attachment).filter_by(query_id=q.id)
+                   .filter(or_(Attachment.processing_status.is_(None), Attachment.processing_status != 'infected'))
+                   .order_by(Attachment.id).all())
+    if not attachments:
+        abort(404)
+    return Response(iter_zip(attachments), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename=query-{q.id}-attachments.zip',
+        'Cache-Control': 'private, no-store',
+    })
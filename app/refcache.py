@@ -0,0 +1,107 @@
+"""Process-local cache of categories, subcategories and query templates.
+
+Each gunicorn worker keeps its own copy. Consistency across workers comes from
+a version number in ``cache_version``: any flush that touches the reference
+tables bumps it in the same transaction, and a worker re-reads the version at
+most once every ``REFERENCE_CACHE_TTL`` seconds, reloading when it changed.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, insert, update
+from sqlalchemy.orm import Session
+
+from . import db
+from .counters import UPSERT_INSERTS
+from .models import CacheVersion, Category, SubCategory, QueryTemplate
+
+REFERENCE = 'reference'
+REFERENCE_MODELS = (Category, SubCategory, QueryTemplate)
+
+CategoryRef = namedtuple('CategoryRef', 'id name')
+SubCategoryRef = namedtuple('SubCategoryRef', 'id name category_id')
+TemplateRef = namedtuple('TemplateRef', 'id category_id subcategory_id text')
+ReferenceData = namedtuple('ReferenceData', 'version categories subcategories templates')
+
+
+def bump_version(connection, name):
+    table = CacheVersion.__table__
+    dialect_insert = UPSERT_INSERTS.get(connection.dialect.name)
+    if dialect_insert is None:
+        result = connection.execute(update(table).where(table.c.name == name).values(version=table.c.version + 1))
+        if result.rowcount == 0:
+            connection.execute(insert(table).values(name=name, version=1))
+        return
+    # One statement, so the first two edits cannot both insert the row
+    connection.execute(dialect_insert(table).values(name=name, version=1)
+                       .on_conflict_do_update(index_elements=[table.c.name], set_={'version': table.c.version + 1}))
+
+
+def current_version(name):
+    row = db.session.get(CacheVersion, name)
+    return row.version if row else 0
+
+
+class ReferenceCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = None
+        self._checked_at = 0.0
+
+    def invalidate(self):
+        self._checked_at = 0.0
+
+    def get(self):
+        data = self._data
+        if data is not None and time.monotonic() - self._checked_at < self.ttl:
+            return data
+        with self._lock:
+            version = current_version(REFERENCE)
+            if self._data is None or self._data.version != version:
+                self._data = self._load(version)
+            self._checked_at = time.monotonic()
+            return self._data
+
+    @staticmethod
+    def _load(version):
+        categories = [CategoryRef(c.id, c.name) for c in Category.query.order_by(Category.name)]
+        subcategories = {}
+        for s in SubCategory.query.order_by(SubCategory.name):
+            subcategories.setdefault(s.category_id, []).append(SubCategoryRef(s.id, s.name, s.category_id))
+        templates = [TemplateRef(t.id, t.category_id, t.subcategory_id, t.text)
+                     for t in QueryTemplate.query.order_by(QueryTemplate.id)]
+        return ReferenceData(version, categories, subcategories, templates)
+
+
+def reference_data():
+    return current_app.extensions['reference_cache'].get()
+
+
+def init_app(app):
+    app.extensions['reference_cache'] = ReferenceCache(app.config['REFERENCE_CACHE_TTL'])
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_on_reference_change(session, flush_context):
+    if session.info.get('reference_bumped'):
+        return
+    changed = (session.new | session.dirty | session.deleted)
+    if any(isinstance(obj, REFERENCE_MODELS) for obj in changed):
+        bump_version(session.connection(), REFERENCE)
+        session.info['reference_bumped'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_local_copy(session):
+    if session.info.pop('reference_bumped', False) and has_app_context():
+        cache = current_app.extensions.get('reference_cache')
+        if cache:
+            cache.invalidate()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_bump(session):
+    session.info.pop('reference_bumped', None)
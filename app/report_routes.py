@@ -0,0 +1,36 @@
+from flask import Blueprint, render_template, redirect, url_for, request, flash, jsonify
+from flask_login import login_required, current_user
+from . import analytics
+from .database import primary, read_only
+
+reports_bp = Blueprint('reports', __name__)
+
+def _refreshed():
+    # Reports only read the summary; folding new audit rows is left to the job worker.
+    # The lag check reads the watermark and may queue a job, so it must see the primary.
+    with primary():
+        analytics.request_refresh()
+    by = request.args.get('by')
+    return by if by in analytics.DIMENSIONS else 'category'
+
+@reports_bp.route('/reports')
+@login_required
+@read_only
+def workflow_reports():
+    if current_user.role not in ('auditor', 'admin'):
+        flash('Only auditors can view reports', 'warning')
+        return redirect(url_for('query.dashboard'))
+    by = _refreshed()
+    return render_template('reports.html', by=by, dimensions=list(analytics.DIMENSIONS),
+                           rows=analytics.workflow_report(by), aging=analytics.aging(),
+                           tracked=list(analytics.TRACKED))
+
+@reports_bp.route('/reports/workflow.json')
+@login_required
+@read_only
+def workflow_reports_json():
+    if current_user.role not in ('auditor', 'admin'):
+        return jsonify({'error': 'forbidden'}), 403
+    by = _refreshed()
+    return jsonify({'by': by, 'as_of_audit_id': analytics.watermark(),
+                    'groups': analytics.workflow_report(by), 'aging': analytics.aging()})
@@ -0,0 +1,211 @@
+"""Full-text search over query text, templates, comments and attachment names.
+
+Every searchable text has a row in ``search_document`` (see
+``SearchDocument``), written in the same transaction as the row it mirrors by
+an ``after_flush`` hook. The index over it is engine specific:
+
+* PostgreSQL: a generated ``tsvector`` column with a GIN index.
+* SQLite: an external-content FTS5 table kept in step by triggers.
+
+Both are created with the table (``db.create_all`` or the migration). Rows
+written outside the ORM (bulk loads, raw SQL) are picked up by rebuilding
+with ``flask backfill run search-index``.
+"""
+import re
+from collections import namedtuple
+
+from markupsafe import Markup, escape
+from sqlalchemy import DDL, bindparam, column, delete, event, func, inspect, literal_column, select, table, update
+from sqlalchemy.orm import Session, joinedload
+
+from . import db
+from .models import Attachment, Comment, Query, QueryTemplate, SearchDocument
+from .pagination import keyset_page
+
+TS_CONFIG = 'english'
+FTS_TABLE = 'search_document_fts'
+
+SQLITE_DDL = [
+    f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(body, content='search_document', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    f"CREATE TRIGGER search_document_ai AFTER INSERT ON search_document BEGIN "
+    f"INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body); END",
+    f"CREATE TRIGGER search_document_ad AFTER DELETE ON search_document BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body); END",
+    f"CREATE TRIGGER search_document_au AFTER UPDATE ON search_document BEGIN "
+    f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, body) VALUES ('delete', old.id, old.body); "
+    f"INSERT INTO {FTS_TABLE}(rowid, body) VALUES (new.id, new.body); END",
+]
+POSTGRES_DDL = [
+    f"ALTER TABLE search_document ADD COLUMN tsv tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{TS_CONFIG}', body)) STORED",
+    "CREATE INDEX ix_search_document_tsv ON search_document USING gin (tsv)",
+]
+
+for _stmt in SQLITE_DDL:
+    event.listen(SearchDocument.__table__, 'after_create', DDL(_stmt).execute_if(dialect='sqlite'))
+for _stmt in POSTGRES_DDL:
+    event.listen(SearchDocument.__table__, 'after_create', DDL(_stmt).execute_if(dialect='postgresql'))
+event.listen(SearchDocument.__table__, 'before_drop',
+             DDL(f'DROP TABLE IF EXISTS {FTS_TABLE}').execute_if(dialect='sqlite'))
+
+SearchHit = namedtuple('SearchHit', 'query kind snippet')
+
+HIGHLIGHT_START, HIGHLIGHT_END = '\x02', '\x03'
+
+
+# Index maintenance
+
+def query_body(custom_text, template_text):
+    return '\n'.join(t for t in (custom_text, template_text) if t)
+
+
+def _documents(connection, queries=(), comments=(), attachments=()):
+    """Search rows for the given ORM objects (their ids must be assigned)."""
+    docs = []
+    template_ids = {q.template_id for q in queries if q.template_id}
+    templates = {}
+    if template_ids:
+        templates = dict(connection.execute(
+            select(QueryTemplate.id, QueryTemplate.text).where(QueryTemplate.id.in_(template_ids))).all())
+    for q in queries:
+        docs.append({'query_id': q.id, 'kind': 'query', 'source_id': q.id,
+                     'body': query_body(q.custom_text, templates.get(q.template_id))})
+    for c in comments:
+        docs.append({'query_id': c.query_id, 'kind': 'comment', 'source_id': c.id, 'body': c.content or ''})
+    for a in attachments:
+        docs.append({'query_id': a.query_id, 'kind': 'attachment', 'source_id': a.id, 'body': a.original_name or ''})
+    return [d for d in docs if d['body']]
+
+
+def _changed(obj, *attrs):
+    state = inspect(obj)
+    return any(state.attrs[a].history.has_changes() for a in attrs)
+
+
+def _delete_sources(connection, sources):
+    doc = SearchDocument.__table__
+    for kind in {k for k, _ in sources}:
+        ids = [i for k, i in sources if k == kind]
+        connection.execute(delete(doc).where(doc.c.kind == kind, doc.c.source_id.in_(ids)))
+
+
+def _reindex_template(connection, template):
+    doc = SearchDocument.__table__
+    rows = connection.execute(select(Query.id, Query.custom_text).where(Query.template_id == template.id)).all()
+    if rows:
+        connection.execute(
+            update(doc).where(doc.c.kind == 'query', doc.c.source_id == bindparam('qid')).values(body=bindparam('b')),
+            [{'qid': qid, 'b': query_body(text, template.text)} for qid, text in rows])
+
+
+@event.listens_for(Session, 'after_flush')
+def _index_changes(session, flush_context):
+    new, dirty, deleted = session.new, session.dirty, session.deleted
+    queries, comments, attachments, stale = [], [], [], set()
+    # Document kinds are the table names of their sources
+    for obj in new | dirty:
+        is_new = obj in new
+        if isinstance(obj, Query) and (is_new or _changed(obj, 'custom_text', 'template_id')):
+            queries.append(obj)
+        elif isinstance(obj, Comment) and (is_new or _changed(obj, 'content')):
+            comments.append(obj)
+        elif isinstance(obj, Attachment) and (is_new or _changed(obj, 'original_name')):
+            attachments.append(obj)
+        else:
+            continue
+        if not is_new:
+            stale.add((obj.__tablename__, obj.id))
+    templates = [t for t in dirty if isinstance(t, QueryTemplate) and _changed(t, 'text')]
+    removed = [obj for obj in deleted if isinstance(obj, (Query, Comment, Attachment))]
+    if not (queries or comments or attachments or templates or removed):
+        return
+    connection = session.connection()
+    doc = SearchDocument.__table__
+    gone_queries = [obj.id for obj in removed if isinstance(obj, Query)]
+    if gone_queries:
+        connection.execute(delete(doc).where(doc.c.query_id.in_(gone_queries)))
+    stale |= {(obj.__tablename__, obj.id) for obj in removed if not isinstance(obj, Query)}
+    if stale:
+        _delete_sources(connection, stale)
+    docs = _documents(connection, queries, comments, attachments)
+    if docs:
+        connection.execute(doc.insert(), docs)
+    for template in templates:
+        _reindex_template(connection, template)
+
+
+def reindex_queries(query_rows):
+    """Rebuild the search rows of ``query_rows`` and their comments and attachments."""
+    ids = [q.id for q in query_rows]
+    connection = db.session.connection()
+    doc = SearchDocument.__table__
+    connection.execute(delete(doc).where(doc.c.query_id.in_(ids)))
+    comments = db.session.execute(
+        select(Comment.id, Comment.query_id, Comment.content).where(Comment.query_id.in_(ids))).all()
+    attachments = db.session.execute(
+        select(Attachment.id, Attachment.query_id, Attachment.original_name).where(Attachment.query_id.in_(ids))).all()
+    docs = _documents(connection, query_rows, comments, attachments)
+    if docs:
+        connection.execute(doc.insert(), docs)
+    return len(docs)
+
+
+# Searching
+
+def fts5_query(terms):
+    """Quote each word so user input cannot inject FTS5 operators; words are ANDed."""
+    return ' '.join(f'"{w}"' for w in re.findall(r'\w+', terms))
+
+
+def _match(terms):
+    """``(from clause, criterion, score, snippet)`` for documents matching ``terms``; lower scores rank first."""
+    doc = SearchDocument.__table__
+    if db.engine.dialect.name == 'postgresql':
+        tsq = func.websearch_to_tsquery(TS_CONFIG, terms)
+        tsv = literal_column('search_document.tsv')
+        snippet = func.ts_headline(TS_CONFIG, doc.c.body, tsq,
+                                   f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, MaxFragments=1')
+        return doc, tsv.op('@@')(tsq), -func.ts_rank_cd(tsv, tsq), snippet
+    # The hidden ``rank`` column is bm25(); unlike the function it may be used inside the grouped subquery
+    fts = table(FTS_TABLE, column('rowid'), column('rank'))
+    fts_col = literal_column(FTS_TABLE)
+    snippet = func.snippet(fts_col, 0, HIGHLIGHT_START, HIGHLIGHT_END, '…', 16)
+    return (doc.join(fts, fts.c.rowid == doc.c.id), fts_col.op('MATCH')(fts5_query(terms)),
+            fts.c.rank, snippet)
+
+
+def highlight(snippet):
+    return Markup(str(escape(snippet)).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
+
+
+def search(scope, terms, cursor=None, limit=20):
+    """Queries within ``scope`` matching ``terms``, best match first.
+
+    Returns ``(hits, next_cursor)``; each hit carries the query, the kind of
+    its best-matching document and a highlighted snippet from it.
+    """
+    if scope is None or not re.search(r'\w', terms or ''):
+        return [], None
+    doc = SearchDocument.__table__
+    source, criterion, score, snippet = _match(terms)
+    matches = (select(doc.c.query_id, score.label('score'))
+               .select_from(source.join(Query.__table__, Query.id == doc.c.query_id))
+               .where(criterion, scope).subquery())
+    ranked = (select(matches.c.query_id, func.min(matches.c.score).label('score'))
+              .group_by(matches.c.query_id).subquery())
+    rows, next_cursor = keyset_page(db.session.query(ranked.c.query_id, ranked.c.score),
+                                    [ranked.c.score, ranked.c.query_id], cursor, limit=limit, descending=False)
+    if not rows:
+        return [], None
+    ids = [r.query_id for r in rows]
+    queries = {q.id: q for q in Query.query.filter(Query.id.in_(ids)).options(
+        joinedload(Query.category), joinedload(Query.assigned_employee), joinedload(Query.manager))}
+    # One snippet per query, from its best-scoring document on this page
+    best = {}
+    for query_id, kind, text in db.session.execute(
+            select(doc.c.query_id, doc.c.kind, snippet).select_from(source)
+            .where(criterion, doc.c.query_id.in_(ids)).order_by(score)):
+        best.setdefault(query_id, (kind, highlight(text)))
+    hits = [SearchHit(queries[i], *best.get(i, ('query', ''))) for i in ids if i in queries]
+    return hits, next_cursor
@@ -0,0 +1,360 @@
+"""Content-addressed attachment store.
+
+Uploads are streamed to a temporary file in fixed-size chunks while being
+hashed, then renamed to ``<UPLOAD_FOLDER>/<aa>/<bb>/<sha256>``. Identical
+content is kept once; ``stored_blob.ref_count`` tracks how many ``Attachment``
+rows point at it. Legacy attachments (``{query_id}_{filename}`` in the flat
+folder) keep working and can be moved over with
+``flask attachments migrate-storage``.
+"""
+import hashlib
+import io
+import os
+import time
+import uuid
+import zipfile
+
+from flask import abort, current_app, request
+from sqlalchemy import event, insert, select, update
+from werkzeug.utils import secure_filename, send_file
+
+from . import db, allowed_file
+from .counters import UPSERT_INSERTS
+from .jobs import enqueue
+from .models import Attachment, StoredBlob
+
+CHUNK_SIZE = 64 * 1024
+# Formats that are already compressed; deflating them again only burns CPU
+STORED_EXTENSIONS = {'xlsx', 'docx', 'jpg', 'jpeg', 'png', 'pdf', 'zip', 'gz'}
+
+
+def blob_relpath(sha256):
+    return f'{sha256[:2]}/{sha256[2:4]}/{sha256}'
+
+
+def attachment_path(attachment):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], attachment.filename)
+
+
+def _tmp_dir():
+    path = os.path.join(current_app.config['UPLOAD_FOLDER'], '.tmp')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _place(tmp_path, sha256):
+    """Move ``tmp_path`` to the blob location unless that content is already stored."""
+    final = os.path.join(current_app.config['UPLOAD_FOLDER'], blob_relpath(sha256))
+    if os.path.exists(final):
+        os.remove(tmp_path)
+        os.utime(final)  # in use again: keep the orphan sweep of collect_garbage off it
+    else:
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        os.replace(tmp_path, final)
+    return final
+
+
+def store_stream(stream):
+    """Write ``stream`` into the store; returns ``(sha256, size)``."""
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = os.path.join(_tmp_dir(), uuid.uuid4().hex)
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    sha256 = digest.hexdigest()
+    _place(tmp_path, sha256)
+    return sha256, size
+
+
+def add_reference(sha256, size, connection=None):
+    conn = connection or db.session
+    dialect = conn.dialect if connection is not None else conn.get_bind().dialect
+    dialect_insert = UPSERT_INSERTS.get(dialect.name)
+    if dialect_insert is None:
+        result = conn.execute(update(StoredBlob).where(StoredBlob.sha256 == sha256)
+                              .values(ref_count=StoredBlob.ref_count + 1))
+        if result.rowcount == 0:
+            conn.execute(insert(StoredBlob).values(sha256=sha256, size=size, ref_count=1))
+        return
+    # One statement, so two uploads of the same new content cannot both INSERT
+    stmt = dialect_insert(StoredBlob).values(sha256=sha256, size=size, ref_count=1)
+    conn.execute(stmt.on_conflict_do_update(index_elements=[StoredBlob.sha256],
+                                            set_={'ref_count': StoredBlob.ref_count + 1}))
+
+
+def release_reference(sha256, connection=None):
+    conn = connection or db.session
+    conn.execute(update(StoredBlob).where(StoredBlob.sha256 == sha256)
+                 .values(ref_count=StoredBlob.ref_count - 1))
+
+
+def save_attachment(query_id, file_storage, user_id):
+    """Store an uploaded ``FileStorage`` and add its ``Attachment`` row to the session.
+
+    Returns the new attachment, or None when the file type is not allowed.
+    A processing job for it is queued in the same transaction.
+    """
+    if not file_storage or not allowed_file(file_storage.filename):
+        return None
+    sha256, size = store_stream(file_storage.stream)
+    add_reference(sha256, size)
+    att = Attachment(query_id=query_id, filename=blob_relpath(sha256), sha256=sha256, size=size,
+                     original_name=secure_filename(file_storage.filename), uploaded_by_id=user_id,
+                     processing_status='pending')
+    db.session.add(att)
+    # Type sniffing, scanning, thumbnails etc. happen in the job worker, after the response
+    enqueue('attachment.process', attachment=att)
+    return att
+
+
+def send_attachment(att):
+    """Build the download response for ``att``.
+
+    Content-addressed files get their hash as a strong ETag. With
+    ``ATTACHMENT_OFFLOAD`` set the body is left to the front proxy
+    (``X-Accel-Redirect`` for nginx, ``X-Sendfile`` for Apache/lighttpd), which
+    then also serves Range requests; otherwise werkzeug streams the file and
+    handles Range and conditional requests itself.
+    """
+    config = current_app.config
+    offload = config['ATTACHMENT_OFFLOAD']
+    path = attachment_path(att)
+    if not os.path.isfile(path):
+        # The proxy would answer 404 itself, but only after we had sent 200 headers for it
+        current_app.logger.warning('Attachment %s missing on disk at %s', att.id, path)
+        abort(404)
+    resp = send_file(
+        path, request.environ, as_attachment=True,
+        download_name=att.original_name or os.path.basename(att.filename),
+        etag=att.sha256 or True, max_age=config['ATTACHMENT_MAX_AGE'],
+        conditional=not offload, use_x_sendfile=bool(offload),
+        response_class=current_app.response_class,
+    )
+    resp.cache_control.private = True
+    resp.cache_control.public = False
+    if offload:
+        resp.make_conditional(request)
+        if resp.status_code == 304 or offload == 'x-accel-redirect':
+            resp.headers.pop('X-Sendfile', None)
+        if resp.status_code != 304 and offload == 'x-accel-redirect':
+            resp.headers['X-Accel-Redirect'] = config['ATTACHMENT_ACCEL_PREFIX'].rstrip('/') + '/' + att.filename
+    return resp
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable buffer that ``zipfile`` streams into."""
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf += b
+        return len(b)
+
+    def __len__(self):
+        return len(self._buf)
+
+    def take(self):
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+
+def _unique_names(attachments):
+    seen = {}
+    for att in attachments:
+        name = att.original_name or os.path.basename(att.filename)
+        count = seen.get(name, 0) + 1
+        seen[name] = count
+        if count > 1:
+            root, ext = os.path.splitext(name)
+            name = f'{root} ({count}){ext}'
+        yield name, att
+
+
+def iter_zip(attachments):
+    """Yield a ZIP archive of ``attachments`` chunk by chunk.
+
+    Nothing is buffered beyond one read chunk (plus whatever deflate holds), so
+    memory stays flat and the first bytes go out immediately. Because the
+    output is not seekable, sizes and CRCs are written in data descriptors.
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    members = []
+    for name, att in _unique_names(attachments):
+        path = os.path.join(folder, att.filename)
+        if os.path.isfile(path):
+            members.append((name, path))
+        else:
+            current_app.logger.warning('Attachment %s missing on disk at %s', att.id, path)
+    return _zip_chunks(members)
+
+
+def _zip_chunks(members):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for name, path in members:
+            stat = os.stat(path)
+            info = zipfile.ZipInfo.from_file(path, arcname=name)
+            ext = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+            info.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as src, zf.open(info, 'w', force_zip64=stat.st_size > zipfile.ZIP64_LIMIT // 2) as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    if len(sink) >= CHUNK_SIZE:
+                        yield sink.take()
+            if len(sink):
+                yield sink.take()
+    yield sink.take()
+
+
+@event.listens_for(Attachment, 'after_delete')
+def _release_on_delete(mapper, connection, target):
+    if target.sha256:
+        release_reference(target.sha256, connection)
+
+
+def migrate_legacy_files(batch_size=500, log=None):
+    """Move flat ``{query_id}_{filename}`` files into the content-addressed layout.
+
+    Works in id-ordered batches, committing after each, so it can be stopped
+    and re-run. Returns ``(migrated, missing)`` counts.
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    migrated = missing = 0
+    last_id = 0
+    while True:
+        batch = db.session.execute(
+            select(Attachment).where(Attachment.sha256.is_(None), Attachment.id > last_id)
+            .order_by(Attachment.id).limit(batch_size)
+        ).scalars().all()
+        if not batch:
+            break
+        legacy_names = set()
+        for att in batch:
+            last_id = att.id
+            legacy = os.path.join(folder, att.filename)
+            if not os.path.isfile(legacy):
+                missing += 1
+                continue
+            digest = hashlib.sha256()
+            size = 0
+            with open(legacy, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    size += len(chunk)
+            sha256 = digest.hexdigest()
+            # Link rather than move: several legacy rows may share one overwritten file
+            tmp_path = os.path.join(_tmp_dir(), uuid.uuid4().hex)
+            try:
+                os.link(legacy, tmp_path)
+            except OSError:
+                with open(legacy, 'rb') as src, open(tmp_path, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                        dst.write(chunk)
+            _place(tmp_path, sha256)
+            add_reference(sha256, size)
+            legacy_names.add(att.filename)
+            att.filename = blob_relpath(sha256)
+            att.sha256 = sha256
+            att.size = size
+            migrated += 1
+        db.session.commit()
+        if legacy_names:
+            still_used = set(db.session.execute(
+                select(Attachment.filename).where(Attachment.filename.in_(legacy_names))
+            ).scalars())
+            for name in legacy_names - still_used:
+                os.remove(os.path.join(folder, name))
+        if log:
+            log(f'Migrated {migrated} attachments (last id {last_id}, {missing} missing files).')
+    return migrated, missing
+
+
+def collect_garbage(orphan_age=3600):
+    """Delete blobs no attachment references any more. Returns the number removed.
+
+    Besides blobs whose count dropped to zero, this sweeps files on disk with
+    no ``stored_blob`` row at all: an upload is moved into place before its
+    transaction commits, so a rolled-back upload leaves its file behind. Only
+    files older than ``orphan_age`` seconds are swept, which leaves uploads
+    still in flight alone.
+
+    Best run in a quiet period: an upload of the same bytes racing the delete
+    could lose its file.
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    removed = 0
+    for sha256 in db.session.execute(select(StoredBlob.sha256).where(StoredBlob.ref_count <= 0)).scalars().all():
+        result = db.session.execute(StoredBlob.__table__.delete().where(
+            StoredBlob.sha256 == sha256, StoredBlob.ref_count <= 0))
+        db.session.commit()
+        path = os.path.join(folder, blob_relpath(sha256))
+        if result.rowcount and os.path.exists(path):
+            os.remove(path)
+            removed += 1
+    return removed + _sweep_untracked(folder, time.time() - orphan_age)
+
+
+def _stored_files(folder):
+    """``(sha256, path)`` of every file in the sharded blob layout, plus leftover temporary files."""
+    for top in os.listdir(folder):
+        top_path = os.path.join(folder, top)
+        if len(top) != 2 or not os.path.isdir(top_path):
+            continue
+        for sub in os.listdir(top_path):
+            sub_path = os.path.join(top_path, sub)
+            if len(sub) != 2 or not os.path.isdir(sub_path):
+                continue
+            for name in os.listdir(sub_path):
+                if len(name) == 64 and name.startswith(top + sub):
+                    yield name, os.path.join(sub_path, name)
+    tmp = os.path.join(folder, '.tmp')
+    if os.path.isdir(tmp):
+        for name in os.listdir(tmp):
+            yield None, os.path.join(tmp, name)
+
+
+def _remove_untracked(candidates):
+    known = set(db.session.execute(select(StoredBlob.sha256).where(
+        StoredBlob.sha256.in_([sha256 for sha256, _ in candidates if sha256]))).scalars())
+    removed = 0
+    for sha256, path in candidates:
+        if sha256 not in known:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def _sweep_untracked(folder, cutoff, batch_size=500):
+    removed, batch = 0, []
+    for sha256, path in _stored_files(folder):
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+        except FileNotFoundError:
+            continue
+        batch.append((sha256, path))
+        if len(batch) >= batch_size:
+            removed += _remove_untracked(batch)
+            batch = []
+    removed += _remove_untracked(batch) if batch else 0
+    db.session.rollback()  # end the read transaction
+    return removed
@@ -0,0 +1,133 @@
+"""Process-local cache behind Flask-Login's user loader.
+
+``current_user`` is a ``CachedUser`` snapshot (id, username, role, names),
+so authenticated requests do not read the ``user`` table. The session holds
+``"<id>:<auth_version>"`` (``User.get_id``), and a change of the username,
+password or role bumps ``auth_version`` in the same flush. A cached snapshot
+is served only while it is younger than ``USER_CACHE_TTL`` and its version
+matches the session's. Otherwise the row is re-read, and a session carrying
+an older version is rejected. Changing a password or role therefore signs
+that user out of other sessions within one TTL.
+
+Profile edits (display name, email) keep sessions signed in. They drop the
+snapshot in this process, and other processes re-read it within one TTL.
+Because names are rendered into cached pages, any change of a user's
+username, name or email also bumps the ``users`` row of ``cache_version``
+(see ``app/fragcache.py``).
+
+Routes that need more than the snapshot (e.g. the password hash) load the
+``User`` row by ``current_user.id``.
+"""
+import threading
+import time
+
+from flask import current_app, has_app_context
+from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from . import db, login_manager
+from .models import User
+from .refcache import bump_version
+
+# Columns whose change bumps User.auth_version
+AUTH_FIELDS = ('username', 'password_hash', 'role')
+# Columns shown to other users; their change bumps the USERS cache version
+DISPLAY_FIELDS = ('username', 'full_name', 'email')
+USERS = 'users'
+
+
+class CachedUser(UserMixin):
+    """Read-only snapshot of a ``User`` row."""
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.role = user.role
+        self.full_name = user.full_name
+        self.email = user.email
+        self.auth_version = user.auth_version or 0
+
+    def get_id(self):
+        return f'{self.id}:{self.auth_version}'
+
+    def __repr__(self):
+        return f"<CachedUser {self.username} ({self.role})>"
+
+
+def parse_id(value):
+    """``(user_id, auth_version)`` from a session id; sessions predating versions count as version 0."""
+    user_id, _, version = str(value).partition(':')
+    return int(user_id), int(version or 0)
+
+
+class UserCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}  # user id -> (CachedUser, loaded at)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def load(self, session_id):
+        try:
+            user_id, version = parse_id(session_id)
+        except ValueError:
+            return None
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0].auth_version == version and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+        user = db.session.get(User, user_id, populate_existing=True)
+        if user is None:
+            self.invalidate(user_id)
+            return None
+        snapshot = CachedUser(user)
+        with self._lock:
+            if len(self._entries) > 10000:
+                self._entries.clear()
+            self._entries[user_id] = (snapshot, time.monotonic())
+        return snapshot if snapshot.auth_version == version else None
+
+
+def init_app(app):
+    app.extensions['user_cache'] = UserCache(app.config['USER_CACHE_TTL'])
+
+
+@login_manager.user_loader
+def load_user(session_id):
+    return current_app.extensions['user_cache'].load(session_id)
+
+
+@event.listens_for(Session, 'before_flush')
+def _bump_auth_version(session, flush_context, instances):
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            state = inspect(obj)
+            changed = {f for f in AUTH_FIELDS + DISPLAY_FIELDS if state.attrs[f].history.has_changes()}
+            if not changed:
+                continue
+            if changed & set(AUTH_FIELDS):
+                obj.auth_version = (obj.auth_version or 0) + 1
+            session.info.setdefault('edited_users', set()).add(obj.id)
+            if changed & set(DISPLAY_FIELDS) and not session.info.get('users_bumped'):
+                bump_version(session.connection(), USERS)
+                session.info['users_bumped'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_edited_users(session):
+    session.info.pop('users_bumped', None)
+    edited = session.info.pop('edited_users', None)
+    if edited and has_app_context():
+        cache = current_app.extensions.get('user_cache')
+        if cache:
+            for user_id in edited:
+                cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_edited_users(session):
+    session.info.pop('edited_users', None)
+    session.info.pop('users_bumped', None)
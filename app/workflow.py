@@ -0,0 +1,206 @@
+"""Query workflow: the allowed transitions and how they are applied.
+
+``TRANSITIONS`` lists, for each action, the statuses it may start from, the
+status it leads to, the role that may perform it and the owner column that
+must hold the acting user's id. Some transitions also set a user column
+(the assigned employee, the manager).
+
+A transition is one conditional UPDATE:
+
+    UPDATE query SET status=:target, version=version+1, ...
+    WHERE id=:id AND status=:status AND version=:version AND <owner>=:user
+
+followed by the audit row and counter updates in the same transaction. The
+expected status and version come from hidden fields of the form the user
+acted on, so no SELECT precedes the write and no row lock is held. If
+another action got there first, the version no longer matches, nothing is
+written and the user is asked to review the query again instead of one
+change silently overwriting the other. Posts without the hidden fields
+(scripts, older pages) read the current state first and are otherwise
+applied the same way.
+"""
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import insert, select, tuple_, update
+
+from . import db, events
+from .counters import adjust_counters, pending_owners
+from .models import AuditTrail, Query, QueryStatus
+
+Transition = namedtuple('Transition', 'action sources target role owner sets audit_target')
+
+S = QueryStatus
+# name -> Transition; ``action`` is the audit action code, ``audit_target`` the column naming the affected user
+TRANSITIONS = {
+    'assign': Transition('assigned', frozenset({S.DRAFT.value, S.ASSIGNED.value, S.REOPENED.value,
+                                                S.MANAGER_REJECTED.value}),
+                         S.ASSIGNED.value, 'auditor', 'auditor_id', 'assigned_employee_id', 'assigned_employee_id'),
+    # Re-submitting before the manager decided adds evidence or picks another manager
+    'submit': Transition('employee_submitted', frozenset({S.ASSIGNED.value, S.REOPENED.value,
+                                                          S.MANAGER_REJECTED.value, S.EMPLOYEE_SUBMITTED.value}),
+                         S.EMPLOYEE_SUBMITTED.value, 'employee', 'assigned_employee_id', 'manager_id', 'manager_id'),
+    'approve': Transition('manager_approved', frozenset({S.EMPLOYEE_SUBMITTED.value}),
+                          S.MANAGER_APPROVED.value, 'manager', 'manager_id', None, 'assigned_employee_id'),
+    'reject': Transition('manager_rejected', frozenset({S.EMPLOYEE_SUBMITTED.value}),
+                         S.MANAGER_REJECTED.value, 'manager', 'manager_id', None, 'assigned_employee_id'),
+    'close': Transition('closed', frozenset({S.MANAGER_APPROVED.value}),
+                        S.CLOSED.value, 'auditor', 'auditor_id', None, 'assigned_employee_id'),
+    'reopen': Transition('reopened', frozenset({S.MANAGER_APPROVED.value, S.CLOSED.value}),
+                         S.REOPENED.value, 'auditor', 'auditor_id', None, 'assigned_employee_id'),
+}
+BULK_TRANSITIONS = ('assign', 'close', 'reopen')
+OWNER_COLUMNS = ('auditor_id', 'assigned_employee_id', 'manager_id')
+
+
+class TransitionError(Exception):
+    """The transition was refused; the message is shown to the user."""
+
+
+def allowed(name, q, user):
+    """Whether ``user`` may apply transition ``name`` to ``q`` as it stands (for showing forms)."""
+    t = TRANSITIONS[name]
+    return user.role == t.role and getattr(q, t.owner) == user.id and q.status in t.sources
+
+
+def _optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def expected_state(form):
+    """The state a form was rendered from (see ``_expected_state.html``), or None for posts without it."""
+    if 'expected_version' not in form:
+        return None
+    try:
+        state = {'status': form['expected_status'], 'version': int(form['expected_version'])}
+        for column in OWNER_COLUMNS:
+            state[column] = _optional_int(form.get(f'expected_{column}'))
+    except (KeyError, ValueError):
+        return None
+    return state
+
+
+def current_state(query_id):
+    row = db.session.execute(select(Query.status, Query.version, *(getattr(Query, c) for c in OWNER_COLUMNS))
+                             .where(Query.id == query_id)).first()
+    return row._asdict() if row else None
+
+
+def _counter_deltas(deltas, old_status, old, new_status, new):
+    before = pending_owners(old_status, *(old[c] for c in OWNER_COLUMNS))
+    after = pending_owners(new_status, *(new[c] for c in OWNER_COLUMNS))
+    for uid in before - after:
+        deltas[uid] = deltas.get(uid, 0) - 1
+    for uid in after - before:
+        deltas[uid] = deltas.get(uid, 0) + 1
+
+
+def _values(t, now):
+    # The audit row is a core INSERT, so the activity columns (app/activity.py) are set here
+    values = {'status': t.target, 'version': Query.version + 1, 'updated_at': now, 'last_activity_at': now}
+    if t.action == 'reopened':
+        values['reopen_count'] = Query.reopen_count + 1
+    return values
+
+
+def apply(name, query_id, user, value=None, expected=None):
+    """Apply transition ``name`` to one query in the caller's transaction; returns the new owner columns.
+
+    ``value`` is the user id for the column the transition sets. ``expected``
+    is the state the user saw (``expected_state``); without it the current
+    state is read. Raises ``TransitionError`` if the transition is not
+    allowed or the query changed since.
+    """
+    t = TRANSITIONS[name]
+    if user.role != t.role:
+        raise TransitionError('Not authorized')
+    if expected is None:
+        expected = current_state(query_id)
+        if expected is None:
+            raise TransitionError('Query not found')
+        if expected[t.owner] != user.id:
+            raise TransitionError('Not authorized')
+    if expected['status'] not in t.sources:
+        raise TransitionError(f"Not possible while the query is {expected['status'].replace('_', ' ')}")
+    now = datetime.utcnow()
+    values = _values(t, now)
+    criteria = [Query.id == query_id, Query.status == expected['status'], Query.version == expected['version'],
+                getattr(Query, t.owner) == user.id]
+    if t.sets:
+        values[t.sets] = value
+        # Pins the value being replaced, which the counters of its previous holder depend on
+        column = getattr(Query, t.sets)
+        criteria.append(column.is_(None) if expected[t.sets] is None else column == expected[t.sets])
+    row = db.session.execute(
+        update(Query).where(*criteria).values(**values)
+        .returning(*(getattr(Query, c) for c in OWNER_COLUMNS))
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        raise TransitionError('The query was changed by someone else in the meantime; please review it and try again.')
+    new = row._asdict()
+    old = dict(new)
+    if t.sets:
+        old[t.sets] = expected[t.sets]
+    deltas = {}
+    _counter_deltas(deltas, expected['status'], old, t.target, new)
+    adjust_counters(deltas)
+    db.session.execute(insert(AuditTrail).values(query_id=query_id, action=t.action, user_id=user.id,
+                                                 target_user_id=new[t.audit_target], created_at=now))
+    events.query_changed(query_id, t.action, t.target, new.values())
+    return new
+
+
+def apply_many(name, query_ids, user, value=None):
+    """Apply transition ``name`` to many queries with one UPDATE and one INSERT.
+
+    Returns ``(updated ids, {skipped id: reason})``. Rows that change between
+    the read and the UPDATE (their version moved on) are skipped as 'changed
+    concurrently'.
+    """
+    t = TRANSITIONS[name]
+    rows = {r.id: r for r in db.session.execute(
+        select(Query.id, Query.status, Query.version, *(getattr(Query, c) for c in OWNER_COLUMNS))
+        .where(Query.id.in_(query_ids)))} if query_ids else {}
+    skipped = {}
+    eligible = []
+    for qid in query_ids:
+        r = rows.get(qid)
+        if r is None:
+            skipped[qid] = 'not found'
+        elif user.role != t.role or getattr(r, t.owner) != user.id:
+            skipped[qid] = 'not authorized'
+        elif r.status not in t.sources:
+            skipped[qid] = f'status is {r.status}'
+        else:
+            eligible.append(qid)
+    if not eligible:
+        return [], skipped
+
+    now = datetime.utcnow()
+    values = _values(t, now)
+    if t.sets:
+        values[t.sets] = value
+    # Pin each row's version so concurrent changes are skipped, not overwritten
+    updated = db.session.execute(
+        update(Query).where(Query.id.in_(eligible),
+                            tuple_(Query.id, Query.version).in_([(qid, rows[qid].version) for qid in eligible]))
+        .values(**values).returning(Query.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    for qid in set(eligible) - set(updated):
+        skipped[qid] = 'changed concurrently'
+    deltas = {}
+    audit_rows = []
+    for qid in updated:
+        r = rows[qid]
+        old = {c: getattr(r, c) for c in OWNER_COLUMNS}
+        new = dict(old, **({t.sets: value} if t.sets else {}))
+        _counter_deltas(deltas, r.status, old, t.target, new)
+        audit_rows.append({'query_id': qid, 'action': t.action, 'user_id': user.id,
+                           'target_user_id': new[t.audit_target], 'created_at': now})
+        events.query_changed(qid, t.action, t.target, new.values())
+    adjust_counters(deltas)
+    if audit_rows:
+        db.session.execute(insert(AuditTrail), audit_rows)
+    return sorted(updated), skipped
@@ -0,0 +1,243 @@
+"""Bulk-load synthetic users, queries, audit rows and comments for load tests.
+
+Rows go in with batched core INSERTs (one executemany and one commit per
+``--batch-size`` queries with their audit rows and comments), so millions of
+rows load in minutes rather than hours. Every query gets a consistent
+history: its audit trail walks the workflow up to its current status, with
+rejection loops and file uploads making up the requested audit volume, and
+every comment has its 'comment' audit row.
+
+Afterwards the derived tables are rebuilt: pending-task counters, the search
+index and the workflow summary (skip the last two with ``--no-derived``).
+
+    python benchmarks/datagen.py --database sqlite:////tmp/bench.db
+    python benchmarks/datagen.py --database postgresql+psycopg2://... \\
+        --queries 100000 --audit-rows 2000000 --comments 500000
+
+All generated users are named ``bench_<role><n>`` with the password
+``password``; an existing load is extended, not replaced.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, insert, select, text  # noqa: E402
+
+from app import analytics, create_app, db  # noqa: E402
+from app.backfill import REGISTRY, run_backfill  # noqa: E402
+from app.counters import reconcile_counters  # noqa: E402
+from app.models import AuditTrail, Category, Comment, Query, QueryStatus, QueryTemplate, SubCategory, User  # noqa: E402
+from app.passwords import hash_password  # noqa: E402
+from config import Config  # noqa: E402
+
+PASSWORD = 'password'
+
+WORDS = ('invoice vendor payment ledger reconciliation variance accrual receivable payable journal approval '
+         'branch cash deposit petty voucher contract procurement inventory stock count depreciation asset '
+         'payroll overtime allowance expense claim travel policy exception limit override segregation access '
+         'backup retention evidence sample audit control deficiency remediation deadline manager review').split()
+
+# status -> (weight, actions after 'created' that lead to it)
+STATUS_PATHS = {
+    QueryStatus.DRAFT.value: (5, []),
+    QueryStatus.ASSIGNED.value: (25, ['assigned']),
+    QueryStatus.EMPLOYEE_SUBMITTED.value: (15, ['assigned', 'employee_submitted']),
+    QueryStatus.MANAGER_REJECTED.value: (10, ['assigned', 'employee_submitted', 'manager_rejected']),
+    QueryStatus.MANAGER_APPROVED.value: (10, ['assigned', 'employee_submitted', 'manager_approved']),
+    QueryStatus.CLOSED.value: (30, ['assigned', 'employee_submitted', 'manager_approved', 'closed']),
+    QueryStatus.REOPENED.value: (5, ['assigned', 'employee_submitted', 'manager_approved', 'closed', 'reopened']),
+}
+
+
+def sentence(rng, low, high):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high))).capitalize() + '.'
+
+
+def split_evenly(total, parts, rng):
+    """``parts`` random non-negative counts summing to ``total``."""
+    counts = [0] * parts
+    for i in rng.choices(range(parts), k=total):
+        counts[i] += 1
+    return counts
+
+
+def ensure_users(role, count):
+    prefix = f'bench_{role}'
+    existing = dict(db.session.execute(select(User.username, User.id).where(User.username.like(f'{prefix}%'))).all())
+    pwhash = hash_password(PASSWORD)
+    missing = [{'username': f'{prefix}{i}', 'full_name': f'Bench {role.capitalize()} {i}', 'role': role,
+                'password_hash': pwhash, 'auth_version': 0}
+               for i in range(1, count + 1) if f'{prefix}{i}' not in existing]
+    if missing:
+        db.session.execute(insert(User), missing)
+        db.session.commit()
+        existing = dict(db.session.execute(
+            select(User.username, User.id).where(User.username.like(f'{prefix}%'))).all())
+    return [existing[f'{prefix}{i}'] for i in range(1, count + 1)]
+
+
+def ensure_reference_data(rng, categories):
+    have = db.session.execute(select(func.count()).select_from(Category)).scalar()
+    for i in range(have + 1, categories + 1):
+        cat = Category(name=f'Bench Category {i}')
+        db.session.add(cat)
+        db.session.flush()
+        for j in range(1, 4):
+            sub = SubCategory(name=f'Bench Area {i}.{j}', category_id=cat.id)
+            db.session.add(sub)
+            db.session.flush()
+            db.session.add(QueryTemplate(category_id=cat.id, subcategory_id=sub.id, text=sentence(rng, 8, 16)))
+    db.session.commit()
+    return db.session.execute(select(QueryTemplate.id, QueryTemplate.category_id, QueryTemplate.subcategory_id)).all()
+
+
+def next_id(model):
+    return (db.session.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+
+class Generator:
+    def __init__(self, rng, users, templates, days):
+        self.rng = rng
+        self.auditors, self.employees, self.managers = users
+        self.templates = templates
+        self.now = datetime.utcnow()
+        self.days = days
+        self.statuses = list(STATUS_PATHS)
+        self.weights = [STATUS_PATHS[s][0] for s in self.statuses]
+        self.query_id, self.audit_id, self.comment_id = next_id(Query), next_id(AuditTrail), next_id(Comment)
+
+    def _later(self, when, max_hours=72):
+        return min(when + timedelta(minutes=self.rng.randint(5, max_hours * 60)), self.now)
+
+    def batch(self, size, audit_budget, comment_budget):
+        """Rows for ``size`` queries sharing ``audit_budget`` extra audit rows and ``comment_budget`` comments."""
+        rng = self.rng
+        queries, audits, comments = [], [], []
+        extra_audits = split_evenly(audit_budget, size, rng)
+        comment_counts = split_evenly(comment_budget, size, rng)
+        for extra, n_comments in zip(extra_audits, comment_counts):
+            qid = self.query_id
+            self.query_id += 1
+            status = rng.choices(self.statuses, self.weights)[0]
+            path = list(STATUS_PATHS[status][1])
+            auditor, employee, manager = rng.choice(self.auditors), rng.choice(self.employees), rng.choice(self.managers)
+            if 'employee_submitted' in path:
+                # Spend part of the extra audit rows on rejection loops, like real back-and-forth
+                loops = rng.randint(0, extra // 2)
+                at = path.index('employee_submitted') + 1
+                path[at:at] = ['manager_rejected', 'employee_submitted'] * loops
+                extra -= 2 * loops
+            # Only users the query has reached upload files and comment on it
+            participants = (auditor, employee, manager)[:1 + bool(path) + ('employee_submitted' in path)]
+            template_id, category_id, subcategory_id = rng.choice(self.templates)
+            created = self.now - timedelta(days=self.days * rng.random())
+            when = created
+            events = [('created', auditor, None, None, created)]
+            for action in path:
+                when = self._later(when)
+                actor, target = {
+                    'assigned': (auditor, employee), 'employee_submitted': (employee, manager),
+                    'manager_approved': (manager, employee), 'manager_rejected': (manager, employee),
+                    'closed': (auditor, employee), 'reopened': (auditor, employee),
+                }[action]
+                events.append((action, actor, target, None, when))
+            for n in range(extra):
+                events.append(('file_upload', rng.choice(participants), None, {'file': f'evidence-{qid}-{n}.xlsx'},
+                               created + (when - created) * rng.random()))
+            for _ in range(n_comments):
+                cid = self.comment_id
+                self.comment_id += 1
+                author = rng.choice(participants)
+                posted = created + (when - created) * rng.random()
+                comments.append({'id': cid, 'query_id': qid, 'user_id': author, 'content': sentence(rng, 4, 30),
+                                 'created_at': posted})
+                events.append(('comment', author, None, None, posted))
+            events.sort(key=lambda e: e[4])
+            for action, actor, target, params, at in events:
+                audits.append({'id': self.audit_id, 'query_id': qid, 'action': action, 'user_id': actor,
+                               'target_user_id': target, 'params': params, 'created_at': at})
+                self.audit_id += 1
+            queries.append({
+                'id': qid, 'category_id': category_id, 'subcategory_id': subcategory_id, 'template_id': template_id,
+                'custom_text': sentence(rng, 8, 40) if rng.random() < 0.7 else None, 'status': status,
+                'auditor_id': auditor, 'assigned_employee_id': employee if path else None,
+                'manager_id': manager if 'employee_submitted' in path else None,
+                'created_at': created, 'updated_at': events[-1][4],
+                # Activity columns (app/activity.py): no Attachment rows are generated, only upload audit rows
+                'last_activity_at': events[-1][4], 'comment_count': n_comments, 'attachment_count': 0,
+                'reopen_count': path.count('reopened'),
+            })
+        return queries, audits, comments
+
+
+def fix_sequences():
+    # Explicit ids leave PostgreSQL's serial sequences behind
+    if db.engine.dialect.name == 'postgresql':
+        for table in ('user', 'query', 'audit_trail', 'comment'):
+            db.session.execute(text(f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+                                    f"(SELECT max(id) FROM \"{table}\"))"))
+        db.session.commit()
+
+
+def load(args):
+    rng = random.Random(args.seed)
+    db.create_all()
+    users = (ensure_users('auditor', args.auditors), ensure_users('employee', args.employees),
+             ensure_users('manager', args.managers))
+    ensure_users('admin', 1)
+    templates = ensure_reference_data(rng, args.categories)
+    gen = Generator(rng, users, templates, args.days)
+    # Each query has a 'created' row, its workflow path and one row per comment; the rest is spread as extras
+    avg_path = sum(w * (len(p) + 1) for w, p in STATUS_PATHS.values()) / sum(w for w, _ in STATUS_PATHS.values())
+    extra_audits = max(args.audit_rows - args.comments - round(avg_path * args.queries), 0)
+    done, start = 0, time.perf_counter()
+    while done < args.queries:
+        size = min(args.batch_size, args.queries - done)
+        # This batch's share of the totals, rounded so the batches add up exactly
+        share = [total * (done + size) // args.queries - total * done // args.queries
+                 for total in (extra_audits, args.comments)]
+        queries, audits, comments = gen.batch(size, *share)
+        db.session.execute(insert(Query), queries)
+        db.session.execute(insert(AuditTrail), audits)
+        if comments:
+            db.session.execute(insert(Comment), comments)
+        db.session.commit()
+        done += size
+        elapsed = time.perf_counter() - start
+        print(f'{done}/{args.queries} queries, {gen.audit_id - 1} audit rows, {gen.comment_id - 1} comments '
+              f'({elapsed:.0f}s, {done / elapsed:.0f} queries/s)', flush=True)
+    fix_sequences()
+    print(f'Pending-task counters rebuilt for {reconcile_counters()} users.')
+    if not args.no_derived:
+        result = run_backfill(REGISTRY['search-index'](), restart=True)
+        print(f"Search index rebuilt: {result['rows_changed']} documents.")
+        print(f'Workflow summary rebuilt from {analytics.rebuild(batch_size=5000)} audit rows.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', default=Config.SQLALCHEMY_DATABASE_URI, help='SQLAlchemy URL (default: DATABASE_URL)')
+    parser.add_argument('--queries', type=int, default=100_000)
+    parser.add_argument('--audit-rows', type=int, default=2_000_000, help='approximate total audit rows')
+    parser.add_argument('--comments', type=int, default=500_000)
+    parser.add_argument('--auditors', type=int, default=50)
+    parser.add_argument('--employees', type=int, default=500)
+    parser.add_argument('--managers', type=int, default=50)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--days', type=int, default=730, help='spread creation dates over this many past days')
+    parser.add_argument('--batch-size', type=int, default=2000, help='queries per INSERT batch and commit')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--no-derived', action='store_true', help='skip rebuilding the search index and analytics')
+    args = parser.parse_args()
+    config = type('DatagenConfig', (Config,), {'SQLALCHEMY_DATABASE_URI': args.database, 'METRICS_ENABLED': False})
+    with create_app(config).app_context():
+        load(args)
+
+
+if __name__ == '__main__':
+    main()
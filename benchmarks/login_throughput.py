@@ -0,0 +1,103 @@
+"""Measure login throughput of one worker process at different hash settings.
+
+Each setting gets a fresh SQLite database with users already hashed at that
+setting (so no rehash happens), then ``--threads`` test clients post logins
+concurrently, the way a gthread worker would serve them. Reports the cost of
+a single hash, logins per second and latency percentiles.
+
+    python benchmarks/login_throughput.py
+    python benchmarks/login_throughput.py --method scrypt:16384:8:1 --method pbkdf2:sha256:600000 \\
+        --threads 8 --hash-workers 2 --logins 400
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from werkzeug.security import check_password_hash, generate_password_hash  # noqa: E402
+
+from app import create_app, db  # noqa: E402
+from app.models import User  # noqa: E402
+from config import TestConfig  # noqa: E402
+
+DEFAULT_METHODS = ['pbkdf2:sha256:600000', 'scrypt:32768:8:1', 'scrypt:16384:8:1']
+N_USERS = 20
+
+
+def hash_cost(method, rounds=5):
+    pwhash = generate_password_hash('password', method=method)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        check_password_hash(pwhash, 'password')
+    return (time.perf_counter() - start) / rounds
+
+
+def run_setting(method, threads, logins, hash_workers):
+    tmp = tempfile.mkdtemp()
+    config = type('BenchConfig', (TestConfig,), {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+        'PASSWORD_HASH_METHOD': method,
+        'PASSWORD_HASH_WORKERS': hash_workers,
+        'PASSWORD_HASH_QUEUE': threads,
+        'UPLOAD_FOLDER': tmp,
+    })
+    app = create_app(config)
+    with app.app_context():
+        db.create_all()
+        pwhash = generate_password_hash('password', method=method, salt_length=app.config['PASSWORD_SALT_LENGTH'])
+        db.session.add_all([User(username=f'bench{i}', password_hash=pwhash, role='employee') for i in range(N_USERS)])
+        db.session.commit()
+
+    latencies, failures = [], []
+    lock = threading.Lock()
+
+    def client_loop(index, count):
+        client = app.test_client()
+        for n in range(count):
+            start = time.perf_counter()
+            resp = client.post('/login', data={'username': f'bench{(index + n) % N_USERS}', 'password': 'password'})
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if resp.status_code == 302 else failures).append(elapsed)
+
+    per_thread = [logins // threads + (1 if i < logins % threads else 0) for i in range(threads)]
+    workers = [threading.Thread(target=client_loop, args=(i, n)) for i, n in enumerate(per_thread)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    wall = time.perf_counter() - start
+    shutil.rmtree(tmp, ignore_errors=True)
+    latencies.sort()
+    return {
+        'rps': len(latencies) / wall,
+        'p50': statistics.median(latencies) if latencies else 0,
+        'p95': latencies[int(len(latencies) * 0.95) - 1] if latencies else 0,
+        'failed': len(failures),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--method', action='append', dest='methods', help='werkzeug hash method (repeatable)')
+    parser.add_argument('--threads', type=int, default=4, help='concurrent clients (worker threads)')
+    parser.add_argument('--logins', type=int, default=200, help='logins per setting')
+    parser.add_argument('--hash-workers', type=int, default=TestConfig.PASSWORD_HASH_WORKERS,
+                        help='PASSWORD_HASH_WORKERS (0 = hash inline in the request thread)')
+    args = parser.parse_args()
+    print(f'{"method":28} {"hash ms":>8} {"logins/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"failed":>6}')
+    for method in args.methods or DEFAULT_METHODS:
+        cost = hash_cost(method)
+        r = run_setting(method, args.threads, args.logins, args.hash_workers)
+        print(f'{method:28} {cost * 1000:8.1f} {r["rps"]:9.1f} {r["p50"] * 1000:8.1f} {r["p95"] * 1000:8.1f} {r["failed"]:6}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""Drive every auth and query route and report latency, throughput and SQL per request.
+
+Each ``--threads`` client runs ``--iterations`` rounds of a scenario as one
+auditor, employee and manager of a ``benchmarks/datagen.py`` load: the
+dashboards with filters, a query's detail page and fragments, search, an
+audit export, a full workflow on a new query (create with an attachment,
+comment, submit, reject, reassign, approve, close, reopen, bulk close), the
+downloads and the auth pages. Routes are timed on the client; SQL statements
+per request come from the app's ``/metrics`` (before/after the run), so give
+a gunicorn server ``METRICS_FLUSH_SECONDS=0`` and a ``METRICS_DIR``.
+
+By default requests go through the Flask test client in this process;
+``--url`` sends them over HTTP to a running server instead. ``--database``
+must name the server's database either way (ids are looked up there).
+
+    python benchmarks/routes.py --database sqlite:////tmp/bench.db --save-baseline bench-baseline.json
+    python benchmarks/routes.py --database sqlite:////tmp/bench.db --baseline bench-baseline.json
+    python benchmarks/routes.py --url http://127.0.0.1:8000 --database postgresql+psycopg2://... --threads 8
+
+With ``--baseline`` the run fails (exit status 1) if a route's p95 or the
+overall throughput got worse by more than ``--max-slowdown``, or a route
+runs more than ``--max-extra-sql`` additional statements per request.
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import func, select  # noqa: E402
+
+from app import create_app  # noqa: E402
+from app import db  # noqa: E402
+from app.models import Attachment, Query, QueryTemplate, User  # noqa: E402
+from config import Config  # noqa: E402
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import PASSWORD, WORDS  # noqa: E402
+
+SAMPLE_QUERIES = 200  # recent queries per auditor to pick detail pages from
+UPLOAD = b'benchmark evidence\n' * 64
+
+
+# Clients
+
+class TestClient:
+    """Requests through ``app.test_client()``; runs the app in this process."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None, files=None, headers=None):
+        form = dict(data or {})
+        for field, (filename, content) in (files or {}).items():
+            form[field] = (io.BytesIO(content), filename)
+        resp = self.client.open(path, method=method, data=form, headers=headers)
+        body = resp.get_data()  # drains streamed bodies (exports, zips)
+        resp.close()
+        return resp.status_code, body
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpClient:
+    """Requests over HTTP to a running server, with this client's own cookies."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None, files=None, headers=None):
+        headers = dict(headers or {})
+        body = None
+        if files:
+            body, headers['Content-Type'] = _multipart(data or {}, files)
+        elif data is not None:
+            body = urllib.parse.urlencode(data, doseq=True).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        try:
+            with self.opener.open(req) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+
+
+def _multipart(data, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in data.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, content) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode() + content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+# Scenario
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+
+    def add(self, route, elapsed, status):
+        with self.lock:
+            self.latencies[route].append(elapsed)
+            if status >= 400:
+                self.failures[route] += 1
+
+
+class Session:
+    """One client thread: an auditor, employee and manager working together, an admin and an anonymous visitor."""
+
+    def __init__(self, app, make_client, index, recorder, seed):
+        self.app = app
+        self.recorder = recorder
+        self.rng = random.Random(seed + index)
+        with app.app_context():
+            users = {u.username: u for u in User.query.filter(User.username.in_(
+                [f'bench_auditor{index + 1}', f'bench_employee{index + 1}', f'bench_manager{index + 1}',
+                 'bench_admin1']))}
+            missing = {f'bench_{r}{n}' for r, n in (('auditor', index + 1), ('employee', index + 1),
+                                                     ('manager', index + 1), ('admin', 1))} - set(users)
+            if missing:
+                sys.exit(f'Missing users {sorted(missing)}: load more with benchmarks/datagen.py')
+            self.auditor, self.employee, self.manager, admin = (
+                users[f'bench_auditor{index + 1}'], users[f'bench_employee{index + 1}'],
+                users[f'bench_manager{index + 1}'], users['bench_admin1'])
+            self.sample_ids = db.session.execute(
+                select(Query.id).where(Query.auditor_id == self.auditor.id)
+                .order_by(Query.id.desc()).limit(SAMPLE_QUERIES)).scalars().all()
+            self.templates = db.session.execute(
+                select(QueryTemplate.id, QueryTemplate.category_id, QueryTemplate.subcategory_id)).all()
+            db.session.remove()
+        if not self.sample_ids or not self.templates:
+            sys.exit('No queries to benchmark: load data with benchmarks/datagen.py first')
+        self.clients = {}
+        for role, user in (('auditor', self.auditor), ('employee', self.employee), ('manager', self.manager),
+                           ('admin', admin)):
+            client = self.clients[role] = make_client()
+            status, _ = client.request('POST', '/login', {'username': user.username, 'password': PASSWORD})
+            if status != 302:
+                sys.exit(f'Login as {user.username} failed with status {status}')
+        self.clients['anonymous'] = make_client()
+
+    def hit(self, role, route, method, path, data=None, files=None):
+        start = time.perf_counter()
+        status, _ = self.clients[role].request(method, path, data, files)
+        self.recorder.add(f'{method} {route}', time.perf_counter() - start, status)
+
+    def _lookup(self, stmt):
+        with self.app.app_context():
+            value = db.session.execute(stmt).scalar()
+            db.session.remove()
+        return value
+
+    def run(self):
+        rng = self.rng
+        a, e, m = self.auditor, self.employee, self.manager
+        qid = rng.choice(self.sample_ids)
+        template_id, category_id, subcategory_id = rng.choice(self.templates)
+        day = date.today() - timedelta(days=rng.randint(1, 365))
+
+        self.hit('anonymous', 'auth.login', 'GET', '/login')
+        self.hit('anonymous', 'auth.login', 'POST', '/login', {'username': e.username, 'password': PASSWORD})
+        self.hit('anonymous', 'auth.logout', 'GET', '/logout')
+        self.hit('employee', 'auth.change_password', 'GET', '/change_password')
+        # A wrong current password exercises the hash check without changing anything
+        self.hit('employee', 'auth.change_password', 'POST', '/change_password',
+                 {'old_password': 'not-the-password', 'new_password': 'x' * 8, 'confirm_password': 'x' * 8})
+        self.hit('admin', 'auth.create_user', 'GET', '/create_user')
+
+        self.hit('auditor', 'query.dashboard', 'GET', '/')
+        self.hit('employee', 'query.dashboard', 'GET', '/?status=assigned')
+        self.hit('manager', 'query.dashboard', 'GET', f'/?order=asc&category={category_id}')
+        self.hit('auditor', 'query.dashboard', 'GET', '/?sort=activity')
+        self.hit('auditor', 'query.new_query', 'GET', '/query/new')
+        self.hit('auditor', 'query.get_subcategories', 'GET', f'/subcategories/{category_id}')
+        self.hit('auditor', 'query.view_query', 'GET', f'/query/{qid}')
+        self.hit('auditor', 'query.audit_trail_fragment', 'GET', f'/query/{qid}/audit_trail')
+        self.hit('auditor', 'query.comments_fragment', 'GET', f'/query/{qid}/comments')
+        self.hit('auditor', 'query.search_queries', 'GET', f'/search?q={rng.choice(WORDS)}+{rng.choice(WORDS)}')
+        self.hit('auditor', 'query.export_audit_trail', 'GET',
+                 f'/audit_trail/export?format=csv&date_from={day}&date_to={day}')
+
+        self.hit('auditor', 'query.new_query', 'POST', '/query/new', {
+            'category': category_id, 'subcategory': subcategory_id or '', 'template': template_id,
+            'custom_text': ' '.join(rng.choice(WORDS) for _ in range(12)), 'assigned_employee': e.id,
+        }, files={'attachments': ('evidence.txt', UPLOAD)})
+        # This session's auditor is the only one creating queries for it
+        new_id = self._lookup(select(func.max(Query.id)).where(Query.auditor_id == a.id))
+        base = f'/query/{new_id}'
+        self.hit('employee', 'query.add_comment', 'POST', f'{base}/comment', {'comment': 'Evidence attached.'})
+        self.hit('employee', 'query.employee_submit', 'POST', f'{base}/employee_submit', {'manager_id': m.id})
+        self.hit('manager', 'query.manager_decide', 'POST', f'{base}/manager_decide', {'decision': 'reject'})
+        self.hit('auditor', 'query.assign_employee', 'POST', f'{base}/assign', {'assigned_employee': e.id})
+        self.hit('employee', 'query.employee_submit', 'POST', f'{base}/employee_submit', {'manager_id': m.id})
+        self.hit('manager', 'query.manager_decide', 'POST', f'{base}/manager_decide', {'decision': 'approve'})
+        self.hit('auditor', 'query.auditor_close', 'POST', f'{base}/auditor_close')
+        self.hit('auditor', 'query.auditor_reopen', 'POST', f'{base}/auditor_reopen')
+        self.hit('employee', 'query.employee_submit', 'POST', f'{base}/employee_submit', {'manager_id': m.id})
+        self.hit('manager', 'query.manager_decide', 'POST', f'{base}/manager_decide', {'decision': 'approve'})
+        self.hit('auditor', 'query.bulk_action', 'POST', '/queries/bulk/close', {'query_ids': new_id})
+
+        attachment_id = self._lookup(select(func.max(Attachment.id)).where(Attachment.query_id == new_id))
+        self.hit('auditor', 'query.download_file', 'GET', f'/attachments/{attachment_id}')
+        self.hit('auditor', 'query.download_all_attachments', 'GET', f'{base}/attachments.zip')
+
+
+# Results
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted ``values``."""
+    return values[max(math.ceil(pct / 100 * len(values)) - 1, 0)]
+
+
+SAMPLE_RE = re.compile(r'^http_request_sql_statements_(sum|count)\{endpoint="([^"]*)",method="([^"]*)"\} (\S+)$', re.M)
+
+
+def sql_totals(client, token):
+    """``{'METHOD endpoint': [statements, requests]}`` from the app's /metrics, or None if it is disabled."""
+    status, body = client.request('GET', '/metrics', headers={'Authorization': f'Bearer {token}'} if token else None)
+    if status != 200:
+        return None
+    totals = defaultdict(lambda: [0.0, 0.0])
+    for kind, endpoint, method, value in SAMPLE_RE.findall(body.decode()):
+        totals[f'{method} {endpoint}'][kind == 'count'] += float(value)
+    return totals
+
+
+def summarize(recorder, wall, sql_before, sql_after):
+    routes = {}
+    for route, values in sorted(recorder.latencies.items()):
+        values.sort()
+        sql = None
+        if sql_before is not None and sql_after is not None:
+            statements = sql_after[route][0] - sql_before.get(route, [0, 0])[0]
+            requests = sql_after[route][1] - sql_before.get(route, [0, 0])[1]
+            sql = round(statements / requests, 2) if requests else None
+        routes[route] = {'n': len(values), 'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                         'p99': percentile(values, 99), 'sql': sql, 'failed': recorder.failures[route]}
+    total = sum(r['n'] for r in routes.values())
+    return {'requests': total, 'wall': wall, 'rps': total / wall if wall else 0, 'routes': routes}
+
+
+def report(result):
+    print(f'{"route":42} {"n":>5} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"sql/req":>8} {"failed":>6}')
+    for route, r in result['routes'].items():
+        sql = '-' if r['sql'] is None else f'{r["sql"]:.1f}'
+        print(f'{route:42} {r["n"]:5} {r["p50"] * 1000:8.1f} {r["p95"] * 1000:8.1f} {r["p99"] * 1000:8.1f} '
+              f'{sql:>8} {r["failed"]:6}')
+    print(f'{result["requests"]} requests in {result["wall"]:.1f}s: {result["rps"]:.1f} requests/s')
+
+
+def compare(result, baseline, max_slowdown, max_extra_sql, min_ms):
+    """Regressions of ``result`` against ``baseline``, as printable lines."""
+    problems = []
+    if result['rps'] < baseline['rps'] * (1 - max_slowdown):
+        problems.append(f'throughput {result["rps"]:.1f} requests/s, baseline {baseline["rps"]:.1f}')
+    for route, base in baseline['routes'].items():
+        r = result['routes'].get(route)
+        if r is None:
+            problems.append(f'{route}: not run')
+            continue
+        if r['p95'] > base['p95'] * (1 + max_slowdown) and (r['p95'] - base['p95']) * 1000 > min_ms:
+            problems.append(f'{route}: p95 {r["p95"] * 1000:.1f} ms, baseline {base["p95"] * 1000:.1f} ms')
+        if r['sql'] is not None and base['sql'] is not None and r['sql'] > base['sql'] + max_extra_sql:
+            problems.append(f'{route}: {r["sql"]:.1f} SQL statements per request, baseline {base["sql"]:.1f}')
+        if r['failed'] > base.get('failed', 0):
+            problems.append(f'{route}: {r["failed"]} failed requests, baseline {base.get("failed", 0)}')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', default=Config.SQLALCHEMY_DATABASE_URI, help='SQLAlchemy URL (default: DATABASE_URL)')
+    parser.add_argument('--url', help='base URL of a running server (default: Flask test client in-process)')
+    parser.add_argument('--threads', type=int, default=1, help='concurrent client sessions')
+    parser.add_argument('--iterations', type=int, default=10, help='scenario rounds per session')
+    parser.add_argument('--warmup', type=int, default=1, help='untimed rounds per session first')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--metrics-token', default=Config.METRICS_TOKEN)
+    parser.add_argument('--baseline', help='fail if results regressed against this file')
+    parser.add_argument('--save-baseline', help='write results to this file')
+    parser.add_argument('--max-slowdown', type=float, default=0.25, help='allowed p95/throughput loss (fraction)')
+    parser.add_argument('--max-extra-sql', type=float, default=0.5, help='allowed extra statements per request')
+    parser.add_argument('--min-ms', type=float, default=5, help='ignore p95 changes smaller than this')
+    args = parser.parse_args()
+
+    upload_dir = tempfile.mkdtemp() if not args.url else None
+    config = type('RoutesBenchConfig', (Config,), {
+        'SQLALCHEMY_DATABASE_URI': args.database, 'METRICS_ENABLED': True, 'METRICS_DIR': '',
+        'UPLOAD_FOLDER': upload_dir or Config.UPLOAD_FOLDER,
+        'METRICS_TOKEN': args.metrics_token or uuid.uuid4().hex,  # /metrics is admin-only without one
+    })
+    app = create_app(config)
+    make_client = (lambda: HttpClient(args.url)) if args.url else (lambda: TestClient(app))
+    try:
+        sessions = [Session(app, make_client, i, Recorder(), args.seed) for i in range(args.threads)]
+        for session in sessions:
+            for _ in range(args.warmup):
+                session.run()
+        recorder = Recorder()
+        for session in sessions:
+            session.recorder = recorder
+        probe = make_client()
+        token = args.metrics_token if args.url else app.config['METRICS_TOKEN']
+        sql_before = sql_totals(probe, token)
+        threads = [threading.Thread(target=lambda s=s: [s.run() for _ in range(args.iterations)]) for s in sessions]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - start
+        result = summarize(recorder, wall, sql_before, sql_totals(probe, token))
+    finally:
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+    report(result)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as fh:
+            json.dump(result, fh, indent=2, sort_keys=True)
+        print(f'Baseline written to {args.save_baseline}')
+    if args.baseline:
+        with open(args.baseline) as fh:
+            problems = compare(result, json.load(fh), args.max_slowdown, args.max_extra_sql, args.min_ms)
+        for line in problems:
+            print(f'REGRESSION {line}')
+        if problems:
+            sys.exit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""Add cache_version for cross-worker cache invalidation
+
+Revision ID: 2f9a5d7b1c83
+Revises: 8d1f6c0a2e47
+Create Date: 2026-10-18 10:48:03.220917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2f9a5d7b1c83'
+down_revision = '8d1f6c0a2e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cache_version',
+        sa.Column('name', sa.String(length=40), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('cache_version')
@@ -0,0 +1,38 @@
+"""Add user_task_counter for the pending-task badge
+
+Revision ID: 4b7e2a91d3c5
+Revises: c9f02953a178
+Create Date: 2026-10-18 09:12:31.104233
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e2a91d3c5'
+down_revision = 'c9f02953a178'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('user_task_counter',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('pending', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('user_id')
+    )
+    # Seed the counters from existing rows; `flask counters reconcile` does the same later on.
+    op.execute(
+        "INSERT INTO user_task_counter (user_id, pending) "
+        "SELECT user_id, COUNT(*) FROM ("
+        "  SELECT auditor_id AS user_id FROM query WHERE status IN ('employee_submitted', 'manager_approved', 'reopened')"
+        "  UNION ALL SELECT assigned_employee_id FROM query WHERE status = 'assigned'"
+        "  UNION ALL SELECT manager_id FROM query WHERE status = 'employee_submitted'"
+        ") owners WHERE user_id IS NOT NULL GROUP BY user_id"
+    )
+
+
+def downgrade():
+    op.drop_table('user_task_counter')
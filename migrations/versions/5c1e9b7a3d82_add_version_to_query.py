@@ -0,0 +1,26 @@
+"""Add version to query
+
+Revision ID: 5c1e9b7a3d82
+Revises: e2b7c5a9f146
+Create Date: 2026-10-18 19:02:11.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e9b7a3d82'
+down_revision = 'e2b7c5a9f146'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('query', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('query', schema=None) as batch_op:
+        batch_op.drop_column('version')
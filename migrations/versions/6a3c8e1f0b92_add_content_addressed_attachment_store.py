@@ -0,0 +1,38 @@
+"""Add stored_blob and content hash columns on attachment
+
+Revision ID: 6a3c8e1f0b92
+Revises: 2f9a5d7b1c83
+Create Date: 2026-10-18 11:30:44.018265
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a3c8e1f0b92'
+down_revision = '2f9a5d7b1c83'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stored_blob',
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False),
+        sa.Column('ref_count', sa.Integer(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('sha256')
+    )
+    with op.batch_alter_table('attachment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('sha256', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('size', sa.BigInteger(), nullable=True))
+        batch_op.create_foreign_key('fk_attachment_sha256_stored_blob', 'stored_blob', ['sha256'], ['sha256'])
+
+
+def downgrade():
+    with op.batch_alter_table('attachment', schema=None) as batch_op:
+        batch_op.drop_constraint('fk_attachment_sha256_stored_blob', type_='foreignkey')
+        batch_op.drop_column('size')
+        batch_op.drop_column('sha256')
+    op.drop_table('stored_blob')
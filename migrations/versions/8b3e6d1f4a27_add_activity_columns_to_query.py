@@ -0,0 +1,73 @@
+"""Add activity columns to query
+
+Revision ID: 8b3e6d1f4a27
+Revises: 5c1e9b7a3d82
+Create Date: 2026-10-18 21:36:52.180447
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b3e6d1f4a27'
+down_revision = '5c1e9b7a3d82'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_query_auditor_activity', 'query', ['auditor_id', 'last_activity_at', 'id']),
+    ('ix_query_employee_activity', 'query', ['assigned_employee_id', 'last_activity_at', 'id']),
+    ('ix_query_manager_activity', 'query', ['manager_id', 'last_activity_at', 'id']),
+    ('ix_query_auditor_comments', 'query', ['auditor_id', 'comment_count', 'id']),
+    ('ix_query_employee_comments', 'query', ['assigned_employee_id', 'comment_count', 'id']),
+    ('ix_query_manager_comments', 'query', ['manager_id', 'comment_count', 'id']),
+    ('ix_query_auditor_attachments', 'query', ['auditor_id', 'attachment_count', 'id']),
+    ('ix_query_employee_attachments', 'query', ['assigned_employee_id', 'attachment_count', 'id']),
+    ('ix_query_manager_attachments', 'query', ['manager_id', 'attachment_count', 'id']),
+]
+
+# The same rules as app/activity.py; `flask activity verify` checks them later
+BACKFILL = """
+UPDATE "query" SET
+    comment_count = (SELECT count(*) FROM comment WHERE comment.query_id = "query".id),
+    attachment_count = (SELECT count(*) FROM attachment WHERE attachment.query_id = "query".id),
+    reopen_count = (SELECT count(*) FROM audit_trail
+                    WHERE audit_trail.query_id = "query".id AND audit_trail.action = 'reopened'),
+    last_activity_at = COALESCE((
+        SELECT max(activity.at) FROM (
+            SELECT "query".created_at AS at
+            UNION ALL SELECT created_at FROM audit_trail WHERE audit_trail.query_id = "query".id
+            UNION ALL SELECT created_at FROM comment WHERE comment.query_id = "query".id
+            UNION ALL SELECT uploaded_at FROM attachment WHERE attachment.query_id = "query".id
+        ) AS activity), "query".updated_at, CURRENT_TIMESTAMP)
+"""
+
+
+def upgrade():
+    with op.batch_alter_table('query', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('last_activity_at', sa.DateTime(), nullable=True))
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('attachment_count', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.add_column(sa.Column('reopen_count', sa.Integer(), nullable=False, server_default='0'))
+    op.execute(BACKFILL)
+    with op.batch_alter_table('query', schema=None) as batch_op:
+        batch_op.alter_column('last_activity_at', existing_type=sa.DateTime(), nullable=False)
+    if op.get_bind().dialect.name == 'postgresql':
+        # Build without blocking writes on large production tables
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, unique=False, postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
+    with op.batch_alter_table('query', schema=None) as batch_op:
+        batch_op.drop_column('reopen_count')
+        batch_op.drop_column('attachment_count')
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('last_activity_at')
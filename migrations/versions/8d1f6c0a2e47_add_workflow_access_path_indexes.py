@@ -0,0 +1,45 @@
+"""Add indexes for the workflow access paths
+
+Revision ID: 8d1f6c0a2e47
+Revises: 4b7e2a91d3c5
+Create Date: 2026-10-18 10:05:12.551870
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d1f6c0a2e47'
+down_revision = '4b7e2a91d3c5'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_query_auditor_status_updated', 'query', ['auditor_id', 'status', 'updated_at', 'id']),
+    ('ix_query_employee_status_updated', 'query', ['assigned_employee_id', 'status', 'updated_at', 'id']),
+    ('ix_query_manager_status_updated', 'query', ['manager_id', 'status', 'updated_at', 'id']),
+    ('ix_query_auditor_updated', 'query', ['auditor_id', 'updated_at', 'id']),
+    ('ix_query_employee_updated', 'query', ['assigned_employee_id', 'updated_at', 'id']),
+    ('ix_query_manager_updated', 'query', ['manager_id', 'updated_at', 'id']),
+    ('ix_comment_query_id', 'comment', ['query_id', 'id']),
+    ('ix_attachment_query_id', 'attachment', ['query_id', 'id']),
+    ('ix_audit_trail_query_id', 'audit_trail', ['query_id', 'id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # Build without blocking writes on large production tables
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, unique=False, postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade():
+    for name, table, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
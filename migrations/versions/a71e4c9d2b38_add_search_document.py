@@ -0,0 +1,58 @@
+"""Add search_document and its full-text index
+
+Revision ID: a71e4c9d2b38
+Revises: f3d9a2c71b56
+Create Date: 2026-10-18 15:48:09.204615
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a71e4c9d2b38'
+down_revision = 'f3d9a2c71b56'
+branch_labels = None
+depends_on = None
+
+
+POSTGRES_DDL = [
+    "ALTER TABLE search_document ADD COLUMN tsv tsvector GENERATED ALWAYS AS (to_tsvector('english', body)) STORED",
+    "CREATE INDEX ix_search_document_tsv ON search_document USING gin (tsv)",
+]
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE search_document_fts USING fts5(body, content='search_document', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER search_document_ai AFTER INSERT ON search_document BEGIN "
+    "INSERT INTO search_document_fts(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER search_document_ad AFTER DELETE ON search_document BEGIN "
+    "INSERT INTO search_document_fts(search_document_fts, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER search_document_au AFTER UPDATE ON search_document BEGIN "
+    "INSERT INTO search_document_fts(search_document_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO search_document_fts(rowid, body) VALUES (new.id, new.body); END",
+]
+
+
+def upgrade():
+    op.create_table('search_document',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('query_id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=20), nullable=False),
+        sa.Column('source_id', sa.Integer(), nullable=False),
+        sa.Column('body', sa.Text(), nullable=False),
+        sa.ForeignKeyConstraint(['query_id'], ['query.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('kind', 'source_id', name='uq_search_document_source')
+    )
+    op.create_index('ix_search_document_query_id', 'search_document', ['query_id'], unique=False)
+    dialect = op.get_bind().dialect.name
+    for stmt in POSTGRES_DDL if dialect == 'postgresql' else SQLITE_DDL if dialect == 'sqlite' else []:
+        op.execute(stmt)
+    # Existing rows are indexed by `flask backfill run search-index`
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('DROP TABLE IF EXISTS search_document_fts')
+    op.drop_index('ix_search_document_query_id', table_name='search_document')
+    op.drop_table('search_document')
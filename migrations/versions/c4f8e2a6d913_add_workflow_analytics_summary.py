@@ -0,0 +1,59 @@
+"""Add query_workflow_stats and summary_watermark
+
+Revision ID: c4f8e2a6d913
+Revises: a71e4c9d2b38
+Create Date: 2026-10-18 16:31:55.840213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f8e2a6d913'
+down_revision = 'a71e4c9d2b38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('query_workflow_stats',
+        sa.Column('query_id', sa.Integer(), nullable=False),
+        sa.Column('category_id', sa.Integer(), nullable=True),
+        sa.Column('employee_id', sa.Integer(), nullable=True),
+        sa.Column('manager_id', sa.Integer(), nullable=True),
+        sa.Column('status', sa.String(length=40), nullable=False),
+        sa.Column('status_since', sa.DateTime(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('cycle_seconds', sa.Float(), nullable=True),
+        sa.Column('assigned_seconds', sa.Float(), nullable=False),
+        sa.Column('submitted_seconds', sa.Float(), nullable=False),
+        sa.Column('approved_seconds', sa.Float(), nullable=False),
+        sa.Column('rejections', sa.Integer(), nullable=False),
+        sa.Column('reopens', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['category_id'], ['category.id'], ),
+        sa.ForeignKeyConstraint(['employee_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['manager_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['query_id'], ['query.id'], ),
+        sa.PrimaryKeyConstraint('query_id')
+    )
+    op.create_index('ix_query_workflow_stats_category', 'query_workflow_stats', ['category_id'], unique=False)
+    op.create_index('ix_query_workflow_stats_employee', 'query_workflow_stats', ['employee_id'], unique=False)
+    op.create_index('ix_query_workflow_stats_manager', 'query_workflow_stats', ['manager_id'], unique=False)
+    op.create_index('ix_query_workflow_stats_status_since', 'query_workflow_stats', ['status', 'status_since'], unique=False)
+    op.create_table('summary_watermark',
+        sa.Column('name', sa.String(length=60), nullable=False),
+        sa.Column('last_id', sa.Integer(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+    # Populate with `flask analytics refresh`
+
+
+def downgrade():
+    op.drop_table('summary_watermark')
+    op.drop_index('ix_query_workflow_stats_status_since', table_name='query_workflow_stats')
+    op.drop_index('ix_query_workflow_stats_manager', table_name='query_workflow_stats')
+    op.drop_index('ix_query_workflow_stats_employee', table_name='query_workflow_stats')
+    op.drop_index('ix_query_workflow_stats_category', table_name='query_workflow_stats')
+    op.drop_table('query_workflow_stats')
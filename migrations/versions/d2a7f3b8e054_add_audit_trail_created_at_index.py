@@ -0,0 +1,29 @@
+"""Add audit_trail (created_at, id) index for exports
+
+Revision ID: d2a7f3b8e054
+Revises: b5e0d4c7a619
+Create Date: 2026-10-18 13:02:57.480113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a7f3b8e054'
+down_revision = 'b5e0d4c7a619'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index('ix_audit_trail_created_at', 'audit_trail', ['created_at', 'id'], unique=False,
+                            postgresql_concurrently=True)
+    else:
+        op.create_index('ix_audit_trail_created_at', 'audit_trail', ['created_at', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_audit_trail_created_at', table_name='audit_trail')
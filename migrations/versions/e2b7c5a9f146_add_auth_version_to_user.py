@@ -0,0 +1,26 @@
+"""Add auth_version to user
+
+Revision ID: e2b7c5a9f146
+Revises: c4f8e2a6d913
+Create Date: 2026-10-18 17:12:30.662904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2b7c5a9f146'
+down_revision = 'c4f8e2a6d913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('auth_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_column('auth_version')
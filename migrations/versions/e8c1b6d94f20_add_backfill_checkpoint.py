@@ -0,0 +1,33 @@
+"""Add backfill_checkpoint
+
+Revision ID: e8c1b6d94f20
+Revises: d2a7f3b8e054
+Create Date: 2026-10-18 13:47:20.911358
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8c1b6d94f20'
+down_revision = 'd2a7f3b8e054'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('backfill_checkpoint',
+        sa.Column('name', sa.String(length=120), nullable=False),
+        sa.Column('last_id', sa.Integer(), nullable=False),
+        sa.Column('end_id', sa.Integer(), nullable=True),
+        sa.Column('rows_seen', sa.Integer(), nullable=False),
+        sa.Column('rows_changed', sa.Integer(), nullable=False),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('backfill_checkpoint')
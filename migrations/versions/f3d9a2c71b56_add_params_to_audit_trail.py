@@ -0,0 +1,26 @@
+"""Add params to audit_trail
+
+Revision ID: f3d9a2c71b56
+Revises: e8c1b6d94f20
+Create Date: 2026-10-18 15:02:41.377120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3d9a2c71b56'
+down_revision = 'e8c1b6d94f20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('audit_trail', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('params', sa.JSON(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('audit_trail', schema=None) as batch_op:
+        batch_op.drop_column('params')
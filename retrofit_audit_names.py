@@ -1,28 +1,34 @@
 """Retrofit existing AuditTrail.detail values to include user names for entries
 that were recorded before enhanced formatting.
 
-Run: python retrofit_audit_names.py
+Thin wrapper around the ``retrofit-audit-names`` backfill in app/backfill.py,
+which walks the table in id chunks, commits and checkpoints per chunk and
+resumes after interruption. Equivalent to
+``flask backfill run retrofit-audit-names``.
+
+Run: python retrofit_audit_names.py [--chunk-size N] [--workers N] [--restart]
 """
-from app import create_app, db
-from app.models import AuditTrail, User
+import argparse
 
-app = create_app()
+from app import create_app
+from app.backfill import REGISTRY, run_backfill, run_parallel
 
-KEY_WORDS = ['Assigned to employee', 'Submitted to manager', 'Manager approved submission', 'Manager rejected submission', 'Auditor closed query', 'Auditor reopened query', 'File', 'Comment added']
+NAME = 'retrofit-audit-names'
 
-def needs_update(detail: str) -> bool:
-    # If detail already has a closing parenthesis after ID or contains fullname, skip
-    return not (')' in detail and 'ID' in detail) and any(k in detail for k in KEY_WORDS)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--chunk-size', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--restart', action='store_true')
+    args = parser.parse_args()
 
-with app.app_context():
-    updates = 0
-    for entry in AuditTrail.query.all():
-        if entry.user_id and needs_update(entry.detail or ''):
-            user = User.query.get(entry.user_id)
-            if user:
-                # Append name info
-                entry.detail = f"{entry.detail} by (ID {user.id}) {user.full_name or user.username}".strip()
-                updates += 1
-    if updates:
-        db.session.commit()
-    print(f"Retrofit complete. Updated {updates} audit trail rows.")
\ No newline at end of file
+    app = create_app()
+    with app.app_context():
+        if args.workers > 1:
+            result = run_parallel(NAME, args.workers, 'config.Config', chunk_size=args.chunk_size, restart=args.restart)
+        else:
+            backfill = REGISTRY[NAME]()
+            if args.chunk_size:
+                backfill.chunk_size = args.chunk_size
+            result = run_backfill(backfill, restart=args.restart, log=print)
+    print(f"Retrofit complete. Updated {result['rows_changed']} audit trail rows.")
@@ -0,0 +1,103 @@
+import io
+import shutil
+import tempfile
+import unittest
+from flask import g
+from sqlalchemy import update
+from app import create_app, db
+from app.activity import verify
+from app.models import User, Query, Category, QueryStatus
+from werkzeug.security import generate_password_hash
+
+class ActivityColumnsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+        config = type('ActivityTestConfig', (__import__('config').TestConfig,), {'UPLOAD_FOLDER': self.upload_dir})
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        pw = generate_password_hash('pw')
+        self.auditor = User(username='aud', password_hash=pw, role='auditor')
+        self.employee = User(username='emp', password_hash=pw, role='employee')
+        self.manager = User(username='mgr', password_hash=pw, role='manager')
+        self.cat = Category(name='TestCat')
+        db.session.add_all([self.auditor, self.employee, self.manager, self.cat])
+        db.session.flush()
+        self.q = Query(category_id=self.cat.id, auditor_id=self.auditor.id, assigned_employee_id=self.employee.id,
+                       status=QueryStatus.ASSIGNED.value)
+        self.other = Query(category_id=self.cat.id, auditor_id=self.auditor.id, status=QueryStatus.DRAFT.value)
+        db.session.add_all([self.q, self.other])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.upload_dir)
+
+    def login(self, username):
+        g.pop('_login_user', None)
+        self.client.post('/login', data={'username': username, 'password': 'pw'})
+
+    def columns(self, query_id):
+        db.session.expire_all()
+        q = db.session.get(Query, query_id)
+        return q.last_activity_at, q.comment_count, q.attachment_count, q.reopen_count, q.updated_at
+
+    def test_comments_uploads_and_transitions_keep_the_columns_in_step(self):
+        created_at, *counts, updated_at = self.columns(self.q.id)
+        self.assertEqual(counts, [0, 0, 0])
+        self.login('emp')
+        self.client.post(f'/query/{self.q.id}/comment', data={'comment': 'looking into it'})
+        after_comment, comments, _, _, unchanged = self.columns(self.q.id)
+        self.assertEqual(comments, 1)
+        self.assertGreaterEqual(after_comment, created_at)
+        self.assertEqual(unchanged, updated_at)  # a comment is not an edit of the query
+
+        self.client.post(f'/query/{self.q.id}/employee_submit', content_type='multipart/form-data',
+                         data={'manager_id': str(self.manager.id), 'attachments': (io.BytesIO(b'a,b\n1,2\n'), 'e.csv')})
+        _, comments, attachments, reopens, _ = self.columns(self.q.id)
+        self.assertEqual((comments, attachments, reopens), (1, 1, 0))
+
+        db.session.execute(update(Query).where(Query.id == self.q.id).values(status=QueryStatus.CLOSED.value))
+        db.session.commit()
+        self.login('aud')
+        self.client.post(f'/query/{self.q.id}/auditor_reopen')
+        reopened_at, comments, attachments, reopens, _ = self.columns(self.q.id)
+        self.assertEqual((comments, attachments, reopens), (1, 1, 1))
+        self.assertGreaterEqual(reopened_at, after_comment)
+        self.assertEqual(verify(), (2, []))
+
+    def test_verify_reports_and_repairs_drift(self):
+        self.login('aud')
+        self.client.post(f'/query/{self.q.id}/comment', data={'comment': 'one'})
+        self.client.post(f'/query/{self.q.id}/comment', data={'comment': 'two'})
+        db.session.execute(update(Query).where(Query.id == self.q.id).values(comment_count=7, reopen_count=3))
+        db.session.commit()
+
+        result = self.app.test_cli_runner().invoke(args=['activity', 'verify'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertEqual(verify(batch_size=1), (2, [self.q.id]))
+        self.assertEqual(verify(repair=True, batch_size=1), (2, [self.q.id]))
+        self.assertEqual(self.columns(self.q.id)[1:4], (2, 0, 0))
+        self.assertEqual(verify(), (2, []))
+        self.assertEqual(self.app.test_cli_runner().invoke(args=['activity', 'verify']).exit_code, 0)
+
+    def test_lists_sort_by_activity_columns(self):
+        self.login('aud')
+        for text in ('a', 'b'):
+            self.client.post(f'/query/{self.other.id}/comment', data={'comment': text})
+        g.pop('_db_replica', None)
+        items = self.client.get('/api/v1/queries?sort=comment_count').get_json()['data']
+        self.assertEqual([(i['id'], i['comment_count']) for i in items], [(self.other.id, 2), (self.q.id, 0)])
+        self.assertIn('last_activity_at', items[0])
+        self.assertEqual(self.client.get('/api/v1/queries?sort=nope').status_code, 400)
+
+        g.pop('_db_replica', None)
+        html = self.client.get('/?sort=comments').get_data(as_text=True)
+        self.assertLess(html.index(f'/query/{self.other.id}"'), html.index(f'/query/{self.q.id}"'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+from app import analytics, create_app, db
+from app.analytics import aging, rebuild, refresh, watermark, workflow_report
+from app.jobs import run_pending
+from app.models import User, Query, Category, AuditTrail, Job, QueryWorkflowStats
+from werkzeug.security import generate_password_hash
+
+class AnalyticsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_class=__import__('config').TestConfig)
+        self.app.config['ANALYTICS_SETTLE_SECONDS'] = 0
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        pw = generate_password_hash('pw')
+        self.auditor = User(username='aud', password_hash=pw, role='auditor', full_name='Aud')
+        self.emp1 = User(username='emp1', password_hash=pw, role='employee', full_name='Emp One')
+        self.emp2 = User(username='emp2', password_hash=pw, role='employee', full_name='Emp Two')
+        self.manager = User(username='mgr', password_hash=pw, role='manager', full_name='Mgr')
+        self.cat = Category(name='TestCat')
+        db.session.add_all([self.auditor, self.emp1, self.emp2, self.manager, self.cat])
+        db.session.commit()
+        self.start = datetime(2025, 1, 1)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def history(self, employee, events):
+        """Create a query and audit rows for ``events``: (hours after start, action, target user)."""
+        q = Query(category_id=self.cat.id, auditor_id=self.auditor.id, created_at=self.start)
+        db.session.add(q)
+        db.session.flush()
+        for hours, action, target in events:
+            db.session.add(AuditTrail(query_id=q.id, action=action, user_id=self.auditor.id,
+                                      target_user_id=target.id if target else None,
+                                      created_at=self.start + timedelta(hours=hours)))
+        db.session.commit()
+        return q
+
+    def loop(self, employee, first_hours):
+        return [
+            (0, 'created', None),
+            (first_hours, 'assigned', employee),
+            (first_hours + 2, 'comment', None),
+            (first_hours + 4, 'employee_submitted', self.manager),
+            (first_hours + 5, 'manager_rejected', employee),
+            (first_hours + 6, 'reopened', employee),
+            (first_hours + 6, 'assigned', employee),
+            (first_hours + 8, 'employee_submitted', self.manager),
+            (first_hours + 10, 'manager_approved', employee),
+            (first_hours + 13, 'closed', employee),
+        ]
+
+    def test_refresh_folds_dwell_times_and_loops_incrementally(self):
+        self.history(self.emp1, self.loop(self.emp1, 1))
+        self.assertEqual(refresh(batch_size=4), 10)
+        self.assertEqual(refresh(), 0)
+        self.history(self.emp2, [(0, 'created', None), (1, 'assigned', self.emp2)])
+        self.assertEqual(refresh(), 2)
+        report = {r['name']: r for r in workflow_report('employee')}
+        one = report['Emp One']
+        # assigned 4h + 2h, submitted 1h + 2h, approved 3h
+        self.assertEqual(one['avg_hours_in'], {'assigned': 6.0, 'employee_submitted': 3.0, 'manager_approved': 3.0})
+        self.assertEqual((one['rejections'], one['reopens'], one['loops_per_query']), (1, 1, 2.0))
+        self.assertEqual(one['avg_cycle_hours'], 14.0)
+        self.assertIsNone(report['Emp Two']['avg_cycle_hours'])
+        by_category = workflow_report('category')
+        self.assertEqual([(r['name'], r['queries']) for r in by_category], [('TestCat', 2)])
+        waiting = {a['status']: a for a in aging(now=self.start + timedelta(days=3))}
+        self.assertEqual((waiting['assigned']['queries'], waiting['assigned']['from_1d_to_7d']), (1, 1))
+
+        live = [(s.query_id, s.assigned_seconds, s.rejections) for s in db.session.query(QueryWorkflowStats)]
+        last = watermark()
+        rebuild()
+        self.assertEqual([(s.query_id, s.assigned_seconds, s.rejections) for s in db.session.query(QueryWorkflowStats)], live)
+        self.assertEqual(watermark(), last)
+
+    def test_unsettled_rows_wait_for_the_next_refresh(self):
+        self.app.config['ANALYTICS_SETTLE_SECONDS'] = 60
+        q = self.history(self.emp1, [(0, 'created', None)])
+        db.session.add(AuditTrail(query_id=q.id, action='assigned', target_user_id=self.emp1.id))
+        db.session.commit()
+        self.assertEqual(refresh(), 1)
+        self.assertEqual(db.session.get(QueryWorkflowStats, q.id).status, 'draft')
+
+    def test_refresh_that_loses_the_insert_race_backs_off(self):
+        q = self.history(self.emp1, [(0, 'created', None), (1, 'assigned', self.emp1)])
+        load_stats = analytics._load_stats
+
+        def racing(query_ids, first_seen):
+            stats = load_stats(query_ids, first_seen)
+            # The other refresh inserts the summary row between our read and our flush
+            with db.session.no_autoflush:
+                db.session.execute(insert(QueryWorkflowStats).values(
+                    query_id=q.id, category_id=self.cat.id, status='draft', status_since=self.start,
+                    assigned_seconds=0, submitted_seconds=0, approved_seconds=0, rejections=0, reopens=0))
+            return stats
+        analytics._load_stats = racing
+        try:
+            self.assertEqual(refresh(), 0)
+        finally:
+            analytics._load_stats = load_stats
+        self.assertEqual(watermark(), 0)
+        self.assertEqual(refresh(), 2)
+        self.assertEqual(db.session.get(QueryWorkflowStats, q.id).status, 'assigned')
+
+    def test_reports_page_and_json(self):
+        self.history(self.emp1, self.loop(self.emp1, 1))
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'aud', 'password': 'pw'})
+        # Views only read the summary and queue one refresh job while it lags
+        self.assertEqual(client.get('/reports/workflow.json').get_json()['as_of_audit_id'], 0)
+        client.get('/reports')
+        self.assertEqual(db.session.query(Job).filter_by(kind='analytics.refresh').count(), 1)
+        self.assertEqual(run_pending(), 1)
+        body = client.get('/reports/workflow.json?by=manager').get_json()
+        self.assertEqual(body['as_of_audit_id'], 10)
+        self.assertEqual(db.session.query(Job).filter_by(kind='analytics.refresh', status='queued').count(), 0)
+        self.assertEqual([(g['name'], g['rejections']) for g in body['groups']], [('Mgr', 1)])
+        self.assertIn('Emp One', client.get('/reports?by=employee').get_data(as_text=True))
+        client.post('/login', data={'username': 'emp1', 'password': 'pw'})
+        self.assertEqual(client.get('/reports/workflow.json').status_code, 403)
+
+if __name__ == '__main__':
+    unittest.main()
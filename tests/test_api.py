@@ -0,0 +1,112 @@
+import unittest
+from datetime import datetime, timedelta
+from flask import g
+from sqlalchemy import event
+from app import create_app, db
+from app.models import User, Query, Category, Comment, AuditTrail, QueryStatus
+from werkzeug.security import generate_password_hash
+
+class APITestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_class=__import__('config').TestConfig)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        pw = generate_password_hash('pw')
+        self.auditor = User(username='aud', password_hash=pw, role='auditor', full_name='Aud')
+        self.employee = User(username='emp', password_hash=pw, role='employee', full_name='Emp')
+        self.cat = Category(name='TestCat')
+        db.session.add_all([self.auditor, self.employee, self.cat])
+        db.session.commit()
+        base = datetime(2025, 1, 1)
+        self.queries = [Query(category_id=self.cat.id, auditor_id=self.auditor.id, assigned_employee_id=self.employee.id,
+                              status=QueryStatus.ASSIGNED.value, updated_at=base + timedelta(hours=i)) for i in range(5)]
+        db.session.add_all(self.queries)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'aud', 'password': 'pw'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def selects(self, url, **kwargs):
+        statements = []
+        def before(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            resp = self.client.get(url, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        return resp, statements
+
+    def test_list_pages_trims_fields_and_embeds_in_one_query(self):
+        resp = self.client.get('/api/v1/queries?limit=3&fields=status&embed=assigned_employee,category')
+        body = resp.get_json()
+        self.assertEqual([q['id'] for q in body['data']], [q.id for q in reversed(self.queries)][:3])
+        self.assertEqual(set(body['data'][0]), {'id', 'status', 'assigned_employee', 'category'})
+        self.assertEqual(body['data'][0]['assigned_employee']['full_name'], 'Emp')
+        self.assertEqual(body['data'][0]['category'], {'id': self.cat.id, 'name': 'TestCat'})
+        more = self.client.get(f"/api/v1/queries?limit=3&cursor={body['next_cursor']}").get_json()
+        self.assertEqual(len(more['data']), 2)
+        self.assertIsNone(more['next_cursor'])
+        self.assertEqual(self.client.get('/api/v1/queries?fields=password').status_code, 400)
+
+    def test_conditional_get_skips_the_body_until_something_changes(self):
+        resp = self.client.get('/api/v1/queries')
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        resp, statements = self.selects('/api/v1/queries', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertFalse([s for s in statements if 'FROM query' in s and 'max(' not in s])
+        self.queries[0].custom_text = 'changed'
+        db.session.commit()
+        self.assertEqual(self.client.get('/api/v1/queries', headers={'If-None-Match': etag}).status_code, 200)
+
+        q = self.queries[1]
+        url = f'/api/v1/queries/{q.id}/comments?embed=user'
+        etag = self.client.get(url).headers['ETag']
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': etag}).status_code, 304)
+        db.session.add(Comment(query_id=q.id, user_id=self.employee.id, content='hello'))
+        db.session.commit()
+        resp = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.get_json()['data'][0]['user']['username'], 'emp')
+
+    def test_query_detail_and_audit_trail(self):
+        q = self.queries[2]
+        db.session.add(AuditTrail(query_id=q.id, action='assigned', user_id=self.auditor.id,
+                                  target_user_id=self.employee.id))
+        db.session.commit()
+        detail = self.client.get(f'/api/v1/queries/{q.id}?embed=auditor').get_json()['data']
+        self.assertEqual((detail['status'], detail['auditor']['username']), ('assigned', 'aud'))
+        entries = self.client.get(f'/api/v1/queries/{q.id}/audit_trail?fields=message').get_json()['data']
+        self.assertEqual(entries, [{'id': 1, 'message': f'Assigned to employee (ID {self.employee.id}) Emp'}])
+        self.assertEqual(self.client.get('/api/v1/queries/999').status_code, 404)
+        self.client.get('/logout')
+        self.assertEqual(self.client.get('/api/v1/queries').status_code, 401)
+
+    def test_single_query_routes_respect_the_desk_scope(self):
+        other = User(username='emp2', password_hash=generate_password_hash('pw'), role='employee')
+        db.session.add(other)
+        db.session.commit()
+        q = self.queries[0]
+        db.session.add(Comment(query_id=q.id, user_id=self.employee.id, content='private note'))
+        db.session.commit()
+        client = self.app.test_client()
+        g.pop('_login_user', None)
+        client.post('/login', data={'username': 'emp2', 'password': 'pw'})
+        for url in (f'/api/v1/queries/{q.id}', f'/api/v1/queries/{q.id}/comments',
+                    f'/api/v1/queries/{q.id}/audit_trail'):
+            g.pop('_login_user', None)
+            self.assertEqual(client.get(url).status_code, 404, url)
+        g.pop('_login_user', None)
+        client.post('/login', data={'username': 'emp', 'password': 'pw'})
+        g.pop('_login_user', None)
+        comments = client.get(f'/api/v1/queries/{q.id}/comments').get_json()['data']
+        self.assertEqual([c['content'] for c in comments], ['private note'])
+
+if __name__ == '__main__':
+    unittest.main()
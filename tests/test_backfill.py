@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from app import create_app, db
+from app.backfill import REGISTRY, RetrofitAuditNames, run_backfill, run_parallel
+from app.models import User, Query, Category, AuditTrail, BackfillCheckpoint
+from werkzeug.security import generate_password_hash
+
+class BackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        # File database so parallel worker processes see the same data
+        self.db_url = f"sqlite:///{os.path.join(self.tmp, 'backfill.db')}"
+        config = type('BackfillTestConfig', (__import__('config').TestConfig,), {'SQLALCHEMY_DATABASE_URI': self.db_url})
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        users = [User(username=f'u{i}', password_hash=generate_password_hash('pw'), role='employee', full_name=f'User {i}')
+                 for i in range(3)]
+        cat = Category(name='TestCat')
+        db.session.add_all(users + [cat])
+        db.session.flush()
+        q = Query(category_id=cat.id, auditor_id=users[0].id)
+        db.session.add(q)
+        db.session.flush()
+        for i in range(10):
+            db.session.add(AuditTrail(query_id=q.id, action='comment', detail='Comment added', user_id=users[i % 3].id))
+        db.session.add(AuditTrail(query_id=q.id, action='comment', detail='Comment added by (ID 1) User 0', user_id=users[0].id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmp)
+
+    def details(self):
+        db.session.expire_all()
+        return [a.detail for a in db.session.query(AuditTrail).order_by(AuditTrail.id)]
+
+    def test_resumes_after_crash(self):
+        backfill = RetrofitAuditNames()
+        backfill.chunk_size = 3
+        original = RetrofitAuditNames.process
+        calls = []
+        def crash_on_third_chunk(self, rows, users):
+            calls.append(len(rows))
+            if len(calls) == 3:
+                raise RuntimeError('worker killed')
+            return original(self, rows, users)
+        with mock.patch.object(RetrofitAuditNames, 'process', crash_on_third_chunk):
+            with self.assertRaises(RuntimeError):
+                run_backfill(backfill)
+        db.session.rollback()
+        ckpt = db.session.get(BackfillCheckpoint, 'retrofit-audit-names')
+        self.assertEqual((ckpt.last_id, ckpt.rows_changed), (6, 6))
+        self.assertEqual(sum('by (ID' in d for d in self.details()), 7)
+        result = run_backfill(RetrofitAuditNames())
+        self.assertEqual((result['rows_seen'], result['rows_changed']), (11, 10))
+        details = self.details()
+        self.assertEqual(details[0], 'Comment added by (ID 1) User 0')
+        self.assertEqual(details[4], 'Comment added by (ID 2) User 1')
+        self.assertEqual(details[-1], 'Comment added by (ID 1) User 0')
+
+    def test_parallel_slices(self):
+        db.session.remove()
+        with mock.patch.dict(os.environ, {'TEST_DATABASE_URL': self.db_url}):
+            result = run_parallel('retrofit-audit-names', 3, 'tests.test_backfill.ChildConfig', chunk_size=2)
+        self.assertEqual(result, {'rows_seen': 11, 'rows_changed': 10})
+        self.assertTrue(all('by (ID' in d for d in self.details()))
+        self.assertEqual(BackfillCheckpoint.query.filter(BackfillCheckpoint.name.like('retrofit-audit-names:%')).count(), 3)
+
+class ChildConfig(__import__('config').TestConfig):
+    # Re-read in the spawned worker, where TEST_DATABASE_URL points at the test's file database
+    SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URL', 'sqlite:///:memory:')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+from flask import g
+from sqlalchemy import select, update
+from app import create_app, db, database
+from app.models import User, Query, Category, QueryStatus, Comment
+from werkzeug.security import generate_password_hash
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    """Two SQLite files stand in for the primary and its replica."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        base = __import__('config').TestConfig
+        config = type('ReplicaConfig', (base,), {
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(self.tmp.name, 'primary.db')}",
+            'DATABASE_REPLICA_URL': f"sqlite:///{os.path.join(self.tmp.name, 'replica.db')}",
+            'DATABASE_REPLICA_STICKY_SECONDS': 60,
+        })
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.replica = database.replica_engine()
+        db.create_all()
+        db.metadata.create_all(self.replica)
+        # Same rows on both sides, except the text, which tells where a page read from
+        for engine, text in ((db.engine, 'primary copy'), (self.replica, 'replica copy')):
+            with engine.begin() as conn:
+                conn.execute(User.__table__.insert(), [
+                    {'id': 1, 'username': 'aud', 'password_hash': generate_password_hash('pw'), 'role': 'auditor'}])
+                conn.execute(Category.__table__.insert(), [{'id': 1, 'name': 'Cat'}])
+                conn.execute(Query.__table__.insert(), [{'id': 1, 'category_id': 1, 'auditor_id': 1, 'custom_text': text,
+                                                         'status': QueryStatus.DRAFT.value, 'version': 0}])
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.replica.dispose()
+        self.ctx.pop()
+        self.tmp.cleanup()
+
+    def login(self):
+        resp = self.client.post('/login', data={'username': 'aud', 'password': 'pw'})
+        self.client.delete_cookie(database.STICKY_COOKIE)
+        return resp
+
+    def page(self):
+        g.pop('_db_replica', None)
+        return self.client.get('/query/1').get_data(as_text=True)
+
+    def test_read_only_views_use_the_replica_until_the_user_writes(self):
+        self.login()
+        self.assertIn('replica copy', self.page())
+        # A change goes to the primary, and the user's next pages read it from there
+        g.pop('_db_replica', None)
+        self.client.post('/query/1/comment', data={'comment': 'noted'})
+        self.assertEqual(db.session.execute(select(Comment.content)).scalars().all(), ['noted'])
+        with self.replica.connect() as conn:
+            self.assertEqual(conn.execute(select(Comment.id)).all(), [])
+        self.assertIn('primary copy', self.page())
+        self.client.delete_cookie(database.STICKY_COOKIE)
+        self.assertIn('replica copy', self.page())
+        # Views without @read_only always read the primary
+        g.pop('_db_replica', None)
+        self.assertNotIn('replica copy', self.client.get('/query/new').get_data(as_text=True))
+
+    def test_only_plain_selects_are_routed(self):
+        with self.app.test_request_context('/'):
+            g._db_replica = True
+            self.assertIs(db.session.get_bind(clause=select(Query)), self.replica)
+            self.assertIs(db.session.get_bind(clause=select(Query).with_for_update()), db.engine)
+            self.assertIs(db.session.get_bind(clause=update(Query).values(version=1)), db.engine)
+            with database.primary():
+                self.assertIs(db.session.get_bind(clause=select(Query)), db.engine)
+            self.assertIs(db.session.get_bind(clause=select(Query)), self.replica)
+
+    def test_pool_options_skip_sqlite(self):
+        self.assertEqual(database.pool_options(self.app.config, 'sqlite:///x.db'), {})
+        options = database.pool_options(self.app.config, 'postgresql+psycopg2://db/ia')
+        self.assertEqual(options['pool_size'], self.app.config['DB_POOL_SIZE'])
+        self.assertTrue(options['pool_pre_ping'])
+
+if __name__ == '__main__':
+    unittest.main()
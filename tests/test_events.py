@@ -0,0 +1,118 @@
+import json
+import queue
+import threading
+import unittest
+from flask import g
+from app import create_app, db, events
+from app.models import User, Query, Category, QueryStatus
+from app.counters import update_pending_counters
+from werkzeug.security import generate_password_hash
+
+class EventsTestCase(unittest.TestCase):
+    def setUp(self):
+        config = type('EventsTestConfig', (__import__('config').TestConfig,), {
+            'EVENTS_ENABLED': True, 'EVENTS_HEARTBEAT_SECONDS': 0.05, 'EVENTS_STREAM_SECONDS': 2})
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        pw = generate_password_hash('pw')
+        self.auditor = User(username='aud', password_hash=pw, role='auditor')
+        self.employee = User(username='emp', password_hash=pw, role='employee')
+        cat = Category(name='TestCat')
+        db.session.add_all([self.auditor, self.employee, cat])
+        db.session.flush()
+        self.query = Query(category_id=cat.id, auditor_id=self.auditor.id, status=QueryStatus.DRAFT.value)
+        db.session.add(self.query)
+        db.session.commit()
+        self.ids = {'aud': self.auditor.id, 'emp': self.employee.id, 'query': self.query.id}
+        self.broker = self.app.extensions['events']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def client(self, username):
+        client = self.app.test_client()
+        g.pop('_login_user', None)
+        client.post('/login', data={'username': username, 'password': 'pw'})
+        return client
+
+    def post(self, client, url, data):
+        # Requests share the test's app context, so drop the user Flask-Login memoized in g
+        g.pop('_login_user', None)
+        return client.post(url, data=data)
+
+    def drain(self, subscription):
+        messages = []
+        while not subscription.empty():
+            messages.append(subscription.get_nowait())
+        return messages
+
+    def test_transition_announces_counts_and_query_change(self):
+        employee_events = self.broker.subscribe(self.ids['emp'])
+        auditor_events = self.broker.subscribe(self.ids['aud'])
+        resp = self.post(self.client('aud'), f"/query/{self.ids['query']}/assign",
+                         {'assigned_employee': self.ids['emp']})
+        self.assertEqual(resp.status_code, 302)
+        messages = self.drain(employee_events)
+        self.assertIn({'user': self.ids['emp'], 'event': 'pending', 'data': {'count': 1}}, messages)
+        self.assertIn({'user': self.ids['emp'], 'event': 'query',
+                       'data': {'id': self.ids['query'], 'action': 'assigned', 'status': 'assigned'}}, messages)
+        self.assertEqual([m['event'] for m in self.drain(auditor_events)], ['query'])
+
+    def test_bulk_action_announces_each_query(self):
+        q = db.session.get(Query, self.ids['query'])
+        q.status = QueryStatus.MANAGER_APPROVED.value
+        q.assigned_employee_id = self.ids['emp']
+        db.session.commit()
+        employee_events = self.broker.subscribe(self.ids['emp'])
+        self.post(self.client('aud'), '/queries/bulk/close', {'query_ids': self.ids['query']})
+        self.assertEqual(self.drain(employee_events), [{'user': self.ids['emp'], 'event': 'query', 'data': {
+            'id': self.ids['query'], 'action': 'closed', 'status': 'closed'}}])
+
+    def test_rolled_back_changes_are_not_announced(self):
+        employee_events = self.broker.subscribe(self.ids['emp'])
+        q = db.session.get(Query, self.ids['query'])
+        before = set()
+        q.assigned_employee_id, q.status = self.ids['emp'], QueryStatus.ASSIGNED.value
+        update_pending_counters(before, q)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(self.drain(employee_events), [])
+
+    def test_stream_sends_count_then_events(self):
+        client = self.client('emp')
+        chunks = queue.Queue()
+
+        def read():
+            # A server iterates a stream on the thread that handled the request
+            resp = client.get('/events', buffered=False)
+            chunks.put(resp.mimetype)
+            for chunk in resp.response:
+                chunks.put(chunk.decode())
+            resp.close()
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        self.assertEqual(chunks.get(timeout=2), 'text/event-stream')
+        self.assertIn('event: pending\ndata: {"count": 0}\n\n', chunks.get(timeout=2))
+        self.post(self.client('aud'), f"/query/{self.ids['query']}/assign", {'assigned_employee': self.ids['emp']})
+        received = []
+        while not (any('event: query' in c for c in received) and ': keepalive\n\n' in received):
+            received.append(chunks.get(timeout=2))
+        query_chunk = next(c for c in received if 'event: query' in c)
+        self.assertEqual(json.loads(query_chunk.split('data: ')[1])['id'], self.ids['query'])
+        reader.join(timeout=5)  # the stream ends after EVENTS_STREAM_SECONDS
+        self.assertFalse(reader.is_alive())
+
+    def test_notify_payloads_stay_under_limit(self):
+        messages = [{'user': i, 'event': 'query', 'data': {'id': i, 'action': 'closed', 'status': 'closed'}}
+                    for i in range(1000)]
+        payloads = list(events._payloads(messages))
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(p) < events.NOTIFY_PAYLOAD_LIMIT for p in payloads))
+        self.assertEqual([m for p in payloads for m in json.loads(p)], messages)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import unittest
+from flask import g, template_rendered
+from app import create_app, db
+from app.fragcache import FileBackend, MemoryBackend, SqliteBackend
+from app.models import User, Query, Category, QueryStatus, Comment, Attachment, AuditTrail
+from werkzeug.security import generate_password_hash
+
+class FragmentCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        config = __import__('config').TestConfig
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.auditor = User(username='aud', password_hash=generate_password_hash('pw'), role='auditor', full_name='Aud')
+        cat = Category(name='Cat')
+        db.session.add_all([self.auditor, cat])
+        db.session.flush()
+        self.q = Query(category_id=cat.id, auditor_id=self.auditor.id, status=QueryStatus.DRAFT.value)
+        db.session.add(self.q)
+        db.session.flush()
+        for i in range(30):
+            db.session.add(Comment(query_id=self.q.id, user_id=self.auditor.id, content=f'comment {i}'))
+            db.session.add(AuditTrail(query_id=self.q.id, action='comment', user_id=self.auditor.id))
+        self.att = Attachment(query_id=self.q.id, filename='a.pdf', original_name='a.pdf',
+                              uploaded_by_id=self.auditor.id, processing_status='pending')
+        db.session.add(self.att)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'aud', 'password': 'pw'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def view(self):
+        rendered = []
+        def record(sender, template, context, **extra):
+            rendered.append(template.name)
+        template_rendered.connect(record, self.app)
+        try:
+            html = self.client.get(f'/query/{self.q.id}').get_data(as_text=True)
+        finally:
+            template_rendered.disconnect(record, self.app)
+        return html, rendered
+
+    def test_sections_are_rendered_once_until_they_change(self):
+        first, rendered = self.view()
+        self.assertIn('_comment_entries.html', rendered)
+        again, rendered = self.view()
+        self.assertEqual(again, first)
+        self.assertFalse({'_attachment_list.html', '_comment_entries.html', '_audit_entries.html'} & set(rendered))
+
+        self.client.post(f'/query/{self.q.id}/comment', data={'comment': 'newest remark'})
+        html, rendered = self.view()
+        self.assertIn('newest remark', html)
+        self.assertIn('_comment_entries.html', rendered)
+        self.assertIn('_audit_entries.html', rendered)  # the comment's audit row
+        self.assertNotIn('_attachment_list.html', rendered)
+
+        db.session.query(Attachment).update({'processing_status': 'infected'})
+        db.session.commit()
+        html, rendered = self.view()
+        self.assertIn('>infected</span>', html)
+        self.assertEqual([t for t in rendered if t.startswith('_') and t != '_expected_state.html'],
+                         ['_attachment_list.html'])
+
+    def test_renamed_users_are_rendered_again(self):
+        html, _ = self.view()
+        self.assertIn('<strong>Aud</strong>', html)
+        db.session.get(User, self.auditor.id).full_name = 'Audrey'
+        db.session.commit()
+        g.pop('_login_user', None)
+        html, rendered = self.view()
+        self.assertIn('<strong>Audrey</strong>', html)
+        self.assertIn('_comment_entries.html', rendered)
+
+    def test_memory_backend_evicts_least_recently_used_past_the_byte_cap(self):
+        cache = MemoryBackend(max_bytes=100)
+        cache.set('a', 'v1', 'x' * 40)
+        cache.set('b', 'v1', 'x' * 40)
+        cache.get('a')
+        cache.set('c', 'v1', 'x' * 40)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), ('v1', 'x' * 40))
+        cache.set('a', 'v2', 'y')
+        self.assertEqual(cache.get('a'), ('v2', 'y'))
+        self.assertLessEqual(cache.size, 100)
+        cache.set('huge', 'v1', 'x' * 200)
+        self.assertIsNone(cache.get('huge'))
+        cache.set('wide', 'v1', '\u00e9' * 60)  # 60 characters, 120 bytes
+        self.assertIsNone(cache.get('wide'))
+
+    def test_shared_backends_keep_one_entry_per_fragment(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for backend in (FileBackend(os.path.join(tmp, 'files')), SqliteBackend(os.path.join(tmp, 'cache.db'))):
+                self.assertIsNone(backend.get('comments:1'))
+                backend.set('comments:1', 'v1', '<li>one\nline</li>')
+                backend.set('comments:1', 'v2', '<li>two</li>')
+                self.assertEqual(tuple(backend.get('comments:1')), ('v2', '<li>two</li>'))
+            self.assertEqual(os.listdir(os.path.join(tmp, 'files')), ['comments-1.html'])
+
+if __name__ == '__main__':
+    unittest.main()
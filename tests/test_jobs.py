@@ -0,0 +1,95 @@
+import io
+import shutil
+import tempfile
+import unittest
+import zipfile
+from datetime import datetime, timedelta
+from app import create_app, db
+from app.jobs import enqueue, job_handler, run_pending, HANDLERS
+from app.models import User, Query, Category, Attachment, Job, QueryStatus
+from werkzeug.security import generate_password_hash
+
+def reject_everything(path):
+    return False
+
+class JobsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+        config = type('JobsTestConfig', (__import__('config').TestConfig,), {'UPLOAD_FOLDER': self.upload_dir})
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.auditor = User(username='aud', password_hash=generate_password_hash('pw'), role='auditor')
+        self.employee = User(username='emp', password_hash=generate_password_hash('pw'), role='employee')
+        self.manager = User(username='mgr', password_hash=generate_password_hash('pw'), role='manager')
+        self.cat = Category(name='TestCat')
+        db.session.add_all([self.auditor, self.employee, self.manager, self.cat])
+        db.session.flush()
+        self.q = Query(category_id=self.cat.id, auditor_id=self.auditor.id, assigned_employee_id=self.employee.id,
+                       status=QueryStatus.ASSIGNED.value)
+        db.session.add(self.q)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'emp', 'password': 'pw'})
+
+    def tearDown(self):
+        HANDLERS.pop('test.flaky', None)
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.upload_dir)
+
+    def upload(self, content, name):
+        self.client.post(f'/query/{self.q.id}/employee_submit', content_type='multipart/form-data',
+                         data={'manager_id': str(self.manager.id), 'attachments': (io.BytesIO(content), name)})
+        return db.session.query(Attachment).order_by(Attachment.id.desc()).first()
+
+    def test_upload_is_processed_by_the_worker(self):
+        att = self.upload(b'a,b\n1,2\n', 'data.csv')
+        self.assertEqual(att.processing_status, 'pending')
+        self.assertEqual([j.status for j in att.jobs], ['queued'])
+        self.assertEqual(run_pending(), 1)
+        db.session.expire_all()
+        self.assertEqual((att.processing_status, att.mime_type), ('done', 'text/csv'))
+        self.assertEqual([j.status for j in att.jobs], ['done'])
+
+    def test_scan_hook_quarantines_upload(self):
+        self.app.config['ATTACHMENT_SCAN_HOOK'] = f'{__name__}:reject_everything'
+        att = self.upload(b'%PDF-1.4 not really', 'scan.pdf')
+        run_pending()
+        db.session.expire_all()
+        self.assertEqual((att.processing_status, att.mime_type), ('infected', 'application/pdf'))
+        self.assertEqual(self.client.get(f'/attachments/{att.id}').status_code, 403)
+        self.assertEqual(self.client.get(f'/query/{self.q.id}/attachments.zip').status_code, 404)
+        self.app.config['ATTACHMENT_SCAN_HOOK'] = ''
+        db.session.query(Query).update({'status': QueryStatus.ASSIGNED.value})
+        db.session.commit()
+        self.upload(b'a,b\n1,2\n', 'clean.csv')
+        run_pending()
+        resp = self.client.get(f'/query/{self.q.id}/attachments.zip')
+        self.assertEqual(zipfile.ZipFile(io.BytesIO(resp.data)).namelist(), ['clean.csv'])
+
+    def test_failed_jobs_back_off_then_fail(self):
+        calls = []
+
+        @job_handler('test.flaky')
+        def flaky(job, payload):
+            calls.append(payload['n'])
+            raise RuntimeError('boom')
+
+        job = enqueue('test.flaky', {'n': 1}, max_attempts=2)
+        db.session.commit()
+        run_pending()
+        db.session.expire_all()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_after, datetime.utcnow())
+        self.assertIn('boom', job.last_error)
+        job.run_after = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        run_pending()
+        db.session.expire_all()
+        self.assertEqual((job.status, job.attempts, calls), ('failed', 2, [1, 1]))
+
+if __name__ == '__main__':
+    unittest.main()
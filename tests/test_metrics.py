@@ -0,0 +1,123 @@
+import io
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from flask import g
+from app import create_app, db
+from app.metrics import Registry, merge, render
+from app.models import User, Query, Category, Comment, QueryStatus, Attachment
+from app.storage import blob_relpath, store_stream
+from werkzeug.security import generate_password_hash
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        config = type('MetricsTestConfig', (__import__('config').TestConfig,), {
+            'METRICS_DIR': self.tmp, 'METRICS_N_PLUS_ONE_THRESHOLD': 5, 'METRICS_SLOW_REQUEST_SECONDS': 0,
+            'METRICS_TOKEN': 'scrape', 'UPLOAD_FOLDER': os.path.join(self.tmp, 'uploads')})
+        self.app = create_app(config_class=config)
+
+        @self.app.route('/_n_plus_one')
+        def n_plus_one():
+            for _ in range(6):
+                db.session.get(User, self.auditor.id, populate_existing=True)
+            return 'ok'
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.auditor = User(username='aud', password_hash=generate_password_hash('pw'), role='auditor')
+        cat = Category(name='TestCat')
+        db.session.add_all([self.auditor, cat])
+        db.session.flush()
+        self.query = Query(category_id=cat.id, auditor_id=self.auditor.id, status=QueryStatus.ASSIGNED.value)
+        db.session.add(self.query)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'aud', 'password': 'pw'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.tmp)
+
+    def exposition(self):
+        return self.client.get('/metrics', headers={'Authorization': 'Bearer scrape'}).get_data(as_text=True)
+
+    def sample(self, text, name, **labels):
+        pattern = re.escape(name) + r'\{([^}]*)\} (\S+)'
+        for label_text, value in re.findall(pattern, text):
+            pairs = dict(re.findall(r'(\w+)="([^"]*)"', label_text))
+            if all(pairs.get(k) == str(v) for k, v in labels.items()):
+                return float(value)
+        return None
+
+    def test_requests_are_measured_and_exposed(self):
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get(f'/query/{self.query.id}')
+        self.assertTrue(any('Slow request GET' in line for line in logs.output))
+        self.client.post(f'/query/{self.query.id}/comment', data={'comment': 'x' * 2000})
+        text = self.exposition()
+        self.assertEqual(self.sample(text, 'http_request_duration_seconds_count', endpoint='query.view_query'), 1)
+        self.assertGreater(self.sample(text, 'http_request_sql_statements_sum', endpoint='query.view_query'), 0)
+        self.assertGreater(self.sample(text, 'http_request_template_duration_seconds_sum', endpoint='query.view_query'), 0)
+        self.assertEqual(self.sample(text, 'http_request_upload_bytes_bucket', endpoint='query.add_comment', le=10240), 1)
+        self.assertEqual(self.sample(text, 'http_requests_total', endpoint='query.add_comment', status=302), 1)
+        self.assertIsNone(self.sample(text, 'http_request_duration_seconds_count', endpoint='metrics.metrics'))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, f'metrics-{os.getpid()}.json')))
+
+    def test_streamed_responses_are_recorded_when_closed(self):
+        resp = self.client.get('/audit_trail/export?format=csv', buffered=False)
+        self.assertTrue(resp.is_streamed)
+        self.assertIsNone(self.sample(self.exposition(), 'http_request_sql_statements_count',
+                                      endpoint='query.export_audit_trail'))
+        resp.get_data()
+        resp.close()
+        text = self.exposition()
+        self.assertEqual(self.sample(text, 'http_request_sql_statements_count', endpoint='query.export_audit_trail'), 1)
+        self.assertGreater(self.sample(text, 'http_request_sql_statements_sum', endpoint='query.export_audit_trail'), 0)
+
+    def test_file_downloads_are_recorded(self):
+        sha256, size = store_stream(io.BytesIO(b'%PDF-1.4 measured'))
+        att = Attachment(query_id=self.query.id, filename=blob_relpath(sha256), sha256=sha256, size=size,
+                         original_name='m.pdf', uploaded_by_id=self.auditor.id, processing_status='done')
+        db.session.add(att)
+        db.session.commit()
+        resp = self.client.get(f'/attachments/{att.id}')
+        self.assertEqual(resp.get_data(), b'%PDF-1.4 measured')
+        resp.close()
+        text = self.exposition()
+        self.assertEqual(self.sample(text, 'http_request_sql_statements_count', endpoint='query.download_file'), 1)
+
+    def test_metrics_require_the_token_or_an_admin(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code, 403)
+        db.session.add(User(username='root', password_hash=generate_password_hash('pw'), role='admin'))
+        db.session.commit()
+        g.pop('_login_user', None)
+        self.client.post('/login', data={'username': 'root', 'password': 'pw'})
+        g.pop('_login_user', None)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_n_plus_one_is_logged(self):
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.client.get('/_n_plus_one')
+        self.assertTrue(any('Possible N+1' in line and 'run 6 times' in line for line in logs.output))
+
+    def test_worker_snapshots_are_summed(self):
+        a, b = Registry(), Registry()
+        labels = (('endpoint', 'query.dashboard'),)
+        a.observe('http_request_sql_statements', labels, 3)
+        b.observe('http_request_sql_statements', labels, 30)
+        a.inc('http_slow_requests_total', labels)
+        b.inc('http_slow_requests_total', labels)
+        text = render(*merge([a.snapshot(), b.snapshot()]))
+        self.assertIn('http_request_sql_statements_bucket{endpoint="query.dashboard",le="5"} 1', text)
+        self.assertIn('http_request_sql_statements_bucket{endpoint="query.dashboard",le="+Inf"} 2', text)
+        self.assertIn('http_request_sql_statements_sum{endpoint="query.dashboard"} 33', text)
+        self.assertIn('http_slow_requests_total{endpoint="query.dashboard"} 2', text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+from app import create_app, db
+from app.models import User
+from app.passwords import BoundedHasher, HasherBusy, hash_password, needs_rehash
+from werkzeug.security import check_password_hash, generate_password_hash
+
+class PasswordTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_class=__import__('config').TestConfig)
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:2000'
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.user = User(username='aud', password_hash=generate_password_hash('pw', method='pbkdf2:sha256:1000'),
+                         role='auditor')
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def test_login_upgrades_old_hashes_without_bumping_auth_version(self):
+        self.assertTrue(needs_rehash(self.user.password_hash))
+        self.assertFalse(needs_rehash(hash_password('pw')))
+        resp = self.client.post('/login', data={'username': 'aud', 'password': 'pw'})
+        self.assertEqual(resp.status_code, 302)
+        db.session.expire_all()
+        user = db.session.get(User, self.user.id)
+        self.assertTrue(user.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(check_password_hash(user.password_hash, 'pw'))
+        self.assertEqual(user.auth_version, 0)
+        self.assertFalse(needs_rehash(user.password_hash))
+
+    def test_wrong_or_unknown_credentials_do_not_rehash(self):
+        old = self.user.password_hash
+        self.client.post('/login', data={'username': 'aud', 'password': 'nope'})
+        self.client.post('/login', data={'username': 'ghost', 'password': 'pw'})
+        db.session.expire_all()
+        self.assertEqual(db.session.get(User, self.user.id).password_hash, old)
+
+    def test_full_executor_refuses_logins(self):
+        hasher = BoundedHasher(workers=1, queue=0)
+        self.assertTrue(hasher.check(self.user.password_hash, 'pw', timeout=1))
+        hasher._slots.acquire()
+        with self.assertRaises(HasherBusy):
+            hasher.check(self.user.password_hash, 'pw', timeout=0)
+        self.app.extensions['password_hasher'] = hasher
+        self.app.config['PASSWORD_HASH_WAIT'] = 0
+        resp = self.client.post('/login', data={'username': 'aud', 'password': 'pw'})
+        self.assertEqual(resp.status_code, 503)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,164 @@
+"""Query-plan regression test.
+
+Loads a synthetic dataset large enough for the planner to prefer indexes,
+drives every route through the test client while capturing the SQL it emits,
+and EXPLAINs each statement. Any sequential scan of a workflow table fails.
+Runs against SQLite by default and against PostgreSQL when TEST_DATABASE_URL
+points there.
+"""
+import random
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import event, insert, text
+from app import create_app, db
+from app.models import User, Query, Category, SubCategory, Comment, Attachment, AuditTrail, QueryStatus
+from werkzeug.security import generate_password_hash
+
+N_USERS_PER_ROLE = 20
+N_QUERIES = 5000
+HISTORY_PER_QUERY = 3
+
+# Small reference tables that are fine to scan
+SCAN_ALLOWED = {'user', 'category', 'sub_category', 'query_template'}
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app(config_class=__import__('config').TestConfig)
+        cls.ctx = cls.app.app_context()
+        cls.ctx.push()
+        db.create_all()
+        cls.load_dataset()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+        cls.ctx.pop()
+
+    @classmethod
+    def load_dataset(cls):
+        rnd = random.Random(4)
+        pw = generate_password_hash('pw')
+        users = []
+        for role in ('auditor', 'employee', 'manager'):
+            for i in range(N_USERS_PER_ROLE):
+                users.append({'username': f'{role}{i}', 'password_hash': pw, 'role': role, 'full_name': f'{role} {i}'})
+        db.session.execute(insert(User), users)
+        ids = {role: [u.id for u in User.query.filter_by(role=role)] for role in ('auditor', 'employee', 'manager')}
+        cats = [Category(name=f'Cat {i}') for i in range(5)]
+        db.session.add_all(cats)
+        db.session.flush()
+        db.session.add_all([SubCategory(name=f'Sub {c.id}', category_id=c.id) for c in cats])
+        statuses = [s.value for s in QueryStatus]
+        start = datetime(2024, 1, 1)
+        db.session.execute(insert(Query), [{
+            'category_id': rnd.choice(cats).id, 'status': rnd.choice(statuses),
+            'auditor_id': rnd.choice(ids['auditor']), 'assigned_employee_id': rnd.choice(ids['employee']),
+            'manager_id': rnd.choice(ids['manager']), 'created_at': start,
+            'updated_at': start + timedelta(minutes=i),
+        } for i in range(N_QUERIES)])
+        query_ids = [qid for (qid,) in db.session.query(Query.id)]
+        history = [(qid, n) for qid in query_ids for n in range(HISTORY_PER_QUERY)]
+        db.session.execute(insert(AuditTrail), [{
+            'query_id': qid, 'action': 'comment', 'detail': f'entry {n}', 'user_id': ids['employee'][0],
+        } for qid, n in history])
+        db.session.execute(insert(Comment), [{
+            'query_id': qid, 'user_id': ids['employee'][0], 'content': f'comment {n}',
+        } for qid, n in history])
+        db.session.execute(insert(Attachment), [{
+            'query_id': qid, 'filename': f'{qid}_f.pdf', 'original_name': 'f.pdf', 'uploaded_by_id': ids['employee'][0],
+        } for qid in query_ids])
+        db.session.commit()
+        db.session.execute(text('ANALYZE'))
+        db.session.commit()
+        cls.users = ids
+        cls.query_id = query_ids[len(query_ids) // 2]
+        cls.category_id = cats[0].id
+
+    def capture(self, username, requests):
+        client = self.app.test_client()
+        client.post('/login', data={'username': username, 'password': 'pw'})
+        statements = []
+        def before(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                statements.append((statement, parameters))
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            for method, url, data in requests:
+                resp = client.open(url, method=method, data=data)
+                self.assertLess(resp.status_code, 400, url)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        db.session.rollback()
+        return statements
+
+    def sequential_scans(self, statement, parameters):
+        with db.engine.connect() as conn:
+            if conn.dialect.name == 'postgresql':
+                plan = [row[0] for row in conn.exec_driver_sql('EXPLAIN ' + statement, parameters)]
+                scans = [line.split('Seq Scan on ')[1].split()[0].strip('"') for line in plan if 'Seq Scan on ' in line]
+            else:
+                plan = [row[-1] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+                # A MATCH against the FTS5 table is an index lookup, reported as 'SCAN ... VIRTUAL TABLE INDEX'
+                scans = [line.split()[1].strip('"') for line in plan
+                         if line.startswith('SCAN ') and 'VIRTUAL TABLE INDEX' not in line]
+        # Scans of subquery results (anon_1, ...) are not table scans
+        return [t for t in scans if t in db.metadata.tables and t not in SCAN_ALLOWED], plan
+
+    def assert_no_sequential_scans(self, statements):
+        self.assertTrue(statements)
+        for statement, parameters in statements:
+            scans, plan = self.sequential_scans(statement, parameters)
+            self.assertEqual(scans, [], f'sequential scan in:\n{statement}\nplan:\n' + '\n'.join(plan))
+
+    def read_requests(self):
+        qid = self.query_id
+        return [
+            ('GET', '/', None),
+            ('GET', '/?status=assigned', None),
+            ('GET', f'/?status=closed&category={self.category_id}&date_from=2024-01-01&date_to=2024-01-02&order=asc', None),
+            ('GET', '/?sort=activity', None),
+            ('GET', '/?sort=comments', None),
+            ('GET', '/?sort=attachments&status=assigned', None),
+            ('GET', f'/query/{qid}', None),
+            ('GET', f'/query/{qid}/comments', None),
+            ('GET', f'/query/{qid}/audit_trail', None),
+            ('GET', f'/subcategories/{self.category_id}', None),
+            ('GET', '/search?q=comment', None),
+            ('GET', '/api/v1/queries?status=assigned&embed=manager,category', None),
+            ('GET', '/api/v1/queries?sort=comment_count', None),
+            ('GET', f'/api/v1/queries/{qid}/comments?embed=user', None),
+            ('GET', f'/api/v1/queries/{qid}/audit_trail', None),
+        ]
+
+    def test_auditor_routes_use_indexes(self):
+        q = db.session.get(Query, self.query_id)
+        auditor = db.session.get(User, q.auditor_id)
+        qid = self.query_id
+        self.assert_no_sequential_scans(self.capture(auditor.username, self.read_requests() + [
+            ('GET', '/audit_trail/export?format=csv&date_from=2024-01-01&date_to=2024-01-01', None),
+            ('POST', f'/query/{qid}/comment', {'comment': 'plan check'}),
+            ('POST', f'/query/{qid}/assign', {'assigned_employee': str(q.assigned_employee_id)}),
+            ('POST', f'/query/{qid}/auditor_reopen', None),
+            ('POST', f'/query/{qid}/auditor_close', None),
+        ]))
+
+    def test_employee_routes_use_indexes(self):
+        q = db.session.get(Query, self.query_id)
+        employee = db.session.get(User, q.assigned_employee_id)
+        self.assert_no_sequential_scans(self.capture(employee.username, self.read_requests() + [
+            ('POST', f'/query/{self.query_id}/employee_submit', {'manager_id': str(q.manager_id)}),
+        ]))
+
+    def test_manager_routes_use_indexes(self):
+        q = db.session.get(Query, self.query_id)
+        manager = db.session.get(User, q.manager_id)
+        self.assert_no_sequential_scans(self.capture(manager.username, self.read_requests() + [
+            ('POST', f'/query/{self.query_id}/manager_decide', {'decision': 'approve'}),
+        ]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+import csv
+import gzip
+import io
+import json
+import re
+import unittest
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from app import create_app, db
+from app.models import (User, Query, Category, SubCategory, QueryStatus, UserTaskCounter, Comment, AuditTrail,
+                        QueryTemplate, Attachment, SearchDocument)
+from app.counters import adjust_counters, pending_count, reconcile_counters
+from app.refcache import REFERENCE, current_version
+from werkzeug.security import generate_password_hash
+
+class QueryRoutesTestCase(unittest.TestCase):
+    def setUp(self):
+        config = __import__('config').TestConfig
+        self.app = create_app(config_class=config)
+        self.app.config['DASHBOARD_PAGE_SIZE'] = 5
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.auditor = User(username='aud', password_hash=generate_password_hash('pw'), role='auditor', full_name='Aud')
+        self.employee = User(username='emp', password_hash=generate_password_hash('pw'), role='employee', full_name='Emp')
+        self.manager = User(username='mgr', password_hash=generate_password_hash('pw'), role='manager', full_name='Mgr')
+        self.cat = Category(name='TestCat')
+        self.other_cat = Category(name='OtherCat')
+        db.session.add_all([self.auditor, self.employee, self.manager, self.cat, self.other_cat])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def login(self, username):
+        return self.client.post('/login', data={'username': username, 'password': 'pw'})
+
+    def make_queries(self, n, **kwargs):
+        base = datetime(2025, 1, 1)
+        rows = []
+        for i in range(n):
+            values = dict(category_id=self.cat.id, auditor_id=self.auditor.id,
+                          assigned_employee_id=self.employee.id, manager_id=self.manager.id,
+                          status=QueryStatus.ASSIGNED.value, updated_at=base + timedelta(hours=i))
+            values.update(kwargs)
+            rows.append(Query(**values))
+        db.session.add_all(rows)
+        db.session.commit()
+        return rows
+
+    def count_selects(self, fn):
+        statements = []
+        def before(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT'):
+                statements.append(statement)
+        db.session.expire_all()
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            result = fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        return result, statements
+
+    def dashboard_ids(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        ids = [int(x) for x in re.findall(r'/query/(\d+)"', html)]
+        cursor = re.search(r'cursor=([\w-]+)', html)
+        return ids, cursor.group(1) if cursor else None
+
+    def test_dashboard_keyset_pages_do_not_overlap(self):
+        rows = self.make_queries(12)
+        self.login('aud')
+        seen = []
+        ids, cursor = self.dashboard_ids('/')
+        seen.extend(ids)
+        while cursor:
+            ids, cursor = self.dashboard_ids(f'/?cursor={cursor}')
+            seen.extend(ids)
+        self.assertEqual(seen, [q.id for q in reversed(rows)])
+
+    def test_dashboard_filters_on_server(self):
+        self.make_queries(3)
+        closed = self.make_queries(2, status=QueryStatus.CLOSED.value, category_id=self.other_cat.id)
+        self.login('aud')
+        ids, _ = self.dashboard_ids(f'/?status=closed&category={self.other_cat.id}&order=asc')
+        self.assertEqual(ids, [q.id for q in closed])
+        ids, _ = self.dashboard_ids('/?date_from=2025-01-01&date_to=2025-01-01')
+        self.assertEqual(len(ids), 5)
+        ids, _ = self.dashboard_ids('/?date_from=2025-02-01')
+        self.assertEqual(ids, [])
+
+    def test_dashboard_query_count_is_constant(self):
+        self.make_queries(2)
+        self.login('aud')
+        self.client.get('/')
+        _, small = self.count_selects(lambda: self.client.get('/'))
+        self.make_queries(20)
+        _, large = self.count_selects(lambda: self.client.get('/'))
+        self.assertEqual(len(small), len(large))
+
+    def counters(self):
+        db.session.expire_all()
+        return {u.username: pending_count(u.id) for u in (self.auditor, self.employee, self.manager)}
+
+    def test_workflow_keeps_pending_counters_in_step(self):
+        self.login('aud')
+        self.client.post('/query/new', data={'category': self.cat.id, 'custom_text': 'x',
+                                             'assigned_employee': self.employee.id})
+        q = Query.query.one()
+        self.assertEqual(self.counters(), {'aud': 0, 'emp': 1, 'mgr': 0})
+        self.login('emp')
+        self.client.post(f'/query/{q.id}/employee_submit', data={'manager_id': self.manager.id})
+        self.assertEqual(self.counters(), {'aud': 1, 'emp': 0, 'mgr': 1})
+        self.login('mgr')
+        self.client.post(f'/query/{q.id}/manager_decide', data={'decision': 'approve'})
+        self.assertEqual(self.counters(), {'aud': 1, 'emp': 0, 'mgr': 0})
+        self.login('aud')
+        self.client.post(f'/query/{q.id}/auditor_reopen')
+        self.assertEqual(self.counters(), {'aud': 1, 'emp': 0, 'mgr': 0})
+        self.client.post(f'/query/{q.id}/assign', data={'assigned_employee': self.employee.id})
+        self.assertEqual(self.counters(), {'aud': 0, 'emp': 1, 'mgr': 0})
+        live = self.counters()
+        db.session.query(UserTaskCounter).delete()
+        db.session.commit()
+        reconcile_counters()
+        self.assertEqual(self.counters(), live)
+
+    def test_counters_are_upserted_in_one_statement(self):
+        emp, mgr = self.employee.id, self.manager.id
+        statements = []
+        def before(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            adjust_counters({emp: 1})
+            adjust_counters({emp: 1, mgr: -1})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        db.session.commit()
+        self.assertEqual(self.counters(), {'aud': 0, 'emp': 2, 'mgr': 0})
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(all(s.startswith('INSERT INTO user_task_counter') and 'ON CONFLICT' in s for s in statements))
+
+    def add_history(self, q, n):
+        for i in range(n):
+            db.session.add(Comment(query_id=q.id, user_id=self.employee.id, content=f'comment {i}'))
+            db.session.add(AuditTrail(query_id=q.id, action='comment', detail=f'entry {i}',
+                                      user_id=self.employee.id, target_user_id=self.manager.id))
+        db.session.commit()
+
+    def test_view_query_is_bounded_and_query_count_is_constant(self):
+        self.app.config['DETAIL_PAGE_SIZE'] = 4
+        self.app.extensions.pop('fragments', None)  # measure rendering, not cache hits
+        q = self.make_queries(1)[0]
+        self.add_history(q, 2)
+        self.login('aud')
+        _, small = self.count_selects(lambda: self.client.get(f'/query/{q.id}'))
+        self.add_history(q, 30)
+        resp, large = self.count_selects(lambda: self.client.get(f'/query/{q.id}'))
+        self.assertEqual(len(small), len(large))
+        html = resp.get_data(as_text=True)
+        self.assertIn('comment 29', html)
+        self.assertNotIn('comment 25', html)
+        cursor = re.search(r'/comments\?cursor=([\w-]+)', html).group(1)
+        older = self.client.get(f'/query/{q.id}/comments?cursor={cursor}').get_data(as_text=True)
+        self.assertIn('comment 25', older)
+        self.assertNotIn('comment 29', older)
+        self.assertIn('load-older', older)
+
+    def test_reference_data_is_cached_and_invalidated(self):
+        db.session.add(SubCategory(name='Sub A', category_id=self.cat.id))
+        db.session.commit()
+        self.login('aud')
+        self.client.get('/query/new')
+        _, statements = self.count_selects(lambda: self.client.get('/query/new'))
+        reference_tables = ('FROM category', 'FROM sub_category', 'FROM query_template', 'FROM cache_version')
+        self.assertFalse([s for s in statements if any(t in s for t in reference_tables)])
+
+        resp = self.client.get(f'/subcategories/{self.cat.id}')
+        self.assertEqual([s['name'] for s in resp.get_json()], ['Sub A'])
+        self.assertIn('private', resp.headers['Cache-Control'])
+        etag = resp.headers['ETag']
+        resp = self.client.get(f'/subcategories/{self.cat.id}', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        before = current_version(REFERENCE)
+        db.session.add(SubCategory(name='Sub B', category_id=self.cat.id))
+        db.session.commit()
+        self.assertEqual(current_version(REFERENCE), before + 1)
+        resp = self.client.get(f'/subcategories/{self.cat.id}', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([s['name'] for s in resp.get_json()], ['Sub A', 'Sub B'])
+
+    def test_bulk_close_is_one_update_and_reports_skips(self):
+        approved = self.make_queries(5, status=QueryStatus.MANAGER_APPROVED.value)
+        draft = self.make_queries(1, status=QueryStatus.DRAFT.value)[0]
+        other = User(username='aud2', password_hash=generate_password_hash('pw'), role='auditor')
+        db.session.add(other)
+        db.session.flush()
+        foreign = self.make_queries(1, status=QueryStatus.MANAGER_APPROVED.value, auditor_id=other.id)[0]
+        reconcile_counters()
+        self.login('aud')
+        ids = [q.id for q in approved] + [draft.id, foreign.id, 9999]
+        statements = []
+        def before(conn, cursor, statement, parameters, context, executemany):
+            statements.append(' '.join(statement.split()[:3]).upper())
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            resp = self.client.post('/queries/bulk/close', data={'query_ids': [str(i) for i in ids]},
+                                    headers={'Accept': 'application/json'})
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        body = resp.get_json()
+        self.assertEqual(body['updated'], sorted(q.id for q in approved))
+        self.assertEqual({s['id']: s['reason'] for s in body['skipped']},
+                         {draft.id: 'status is draft', foreign.id: 'not authorized', 9999: 'not found'})
+        self.assertEqual(statements.count('INSERT INTO AUDIT_TRAIL'), 1)
+        db.session.expire_all()
+        self.assertEqual({q.status for q in approved}, {'closed'})
+        self.assertEqual(db.session.query(AuditTrail).filter_by(action='closed').count(), 5)
+        live = self.counters()
+        reconcile_counters()
+        self.assertEqual(self.counters(), live)
+
+    def test_bulk_assign(self):
+        rows = self.make_queries(3, status=QueryStatus.DRAFT.value, assigned_employee_id=None)
+        self.login('aud')
+        self.client.post('/queries/bulk/assign', data={'query_ids': [str(q.id) for q in rows],
+                                                       'assigned_employee': str(self.employee.id)})
+        db.session.expire_all()
+        self.assertEqual({(q.status, q.assigned_employee_id) for q in rows}, {('assigned', self.employee.id)})
+        self.assertEqual(self.counters()['emp'], 3)
+
+    def test_audit_trail_export_streams_csv_and_jsonl(self):
+        q = self.make_queries(1)[0]
+        self.add_history(q, 3)
+        self.login('aud')
+        resp = self.client.get('/audit_trail/export?format=csv&gzip=1')
+        self.assertTrue(resp.is_streamed)
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(resp.get_data()).decode())))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual((rows[0]['actor_name'], rows[0]['target_name'], rows[0]['detail']), ('Emp', 'Mgr', 'entry 0'))
+        resp = self.client.get('/audit_trail/export?format=jsonl&date_from=2000-01-01&date_to=2000-01-02')
+        self.assertEqual(resp.get_data(), b'')
+        result = self.app.test_cli_runner().invoke(args=['audit', 'export', '--format', 'jsonl'])
+        records = [json.loads(line) for line in result.output.splitlines()]
+        self.assertEqual([r['detail'] for r in records], ['entry 0', 'entry 1', 'entry 2'])
+        self.login('emp')
+        self.assertEqual(self.client.get('/audit_trail/export?format=csv').status_code, 302)
+
+    def test_audit_messages_render_current_names(self):
+        self.login('aud')
+        self.client.post('/query/new', data={'category': self.cat.id, 'custom_text': 'x',
+                                             'assigned_employee': self.employee.id})
+        q = Query.query.one()
+        entry = db.session.query(AuditTrail).filter_by(action='assigned').one()
+        self.assertIsNone(entry.detail)
+        self.employee.full_name = 'Renamed'
+        db.session.commit()
+        html = self.client.get(f'/query/{q.id}/audit_trail').get_data(as_text=True)
+        self.assertIn(f'Assigned to employee (ID {self.employee.id}) Renamed', html)
+        self.assertIn(f'Query created by auditor (ID {self.auditor.id}) Aud', html)
+        records = [json.loads(line) for line in self.client.get('/audit_trail/export?format=jsonl').get_data(as_text=True).splitlines()]
+        self.assertEqual(records[-1]['detail'], f'Assigned to employee (ID {self.employee.id}) Renamed')
+
+    def search_ids(self, url):
+        html = self.client.get(url).get_data(as_text=True)
+        cursor = re.search(r'cursor=([\w-]+)', html)
+        return [int(x) for x in re.findall(r'/query/(\d+)"', html)], cursor.group(1) if cursor else None, html
+
+    def test_search_is_ranked_scoped_and_incremental(self):
+        self.app.config['SEARCH_PAGE_SIZE'] = 2
+        template = QueryTemplate(category_id=self.cat.id, text='Provide the vendor reconciliation')
+        db.session.add(template)
+        db.session.flush()
+        rows = self.make_queries(4)
+        rows[0].custom_text = 'vendor invoices vendor payments vendor'
+        rows[1].template_id = template.id
+        db.session.add(Comment(query_id=rows[2].id, user_id=self.employee.id, content='Attached the vendor <list>'))
+        other = User(username='aud2', password_hash=generate_password_hash('pw'), role='auditor')
+        db.session.add(other)
+        db.session.flush()
+        foreign = self.make_queries(1, auditor_id=other.id, custom_text='vendor')[0]
+        self.login('aud')
+        ids, cursor, html = self.search_ids('/search?q=vendors')
+        self.assertEqual(ids[0], rows[0].id)
+        self.assertIn('<mark>vendor</mark>', html)
+        more, cursor, html = self.search_ids(f'/search?q=vendors&cursor={cursor}')
+        self.assertIsNone(cursor)
+        self.assertEqual(sorted(ids + more), [rows[0].id, rows[1].id, rows[2].id])
+        self.assertIn('&lt;list&gt;', html)
+        self.assertNotIn(foreign.id, ids + more)
+
+        db.session.add(Attachment(query_id=rows[3].id, filename='x', original_name='ledger.xlsx',
+                                  uploaded_by_id=self.employee.id))
+        template.text = 'Provide the bank statements'
+        db.session.delete(db.session.query(Comment).one())
+        db.session.commit()
+        ids, _, _ = self.search_ids('/search?q=ledger')
+        self.assertEqual(ids, [rows[3].id])
+        ids, _, _ = self.search_ids('/search?q=vendor')
+        self.assertEqual(ids, [rows[0].id])
+        self.assertEqual(self.search_ids('/search?q=%22%20OR%20*')[0], [])
+
+        templated = rows[1].id
+        db.session.query(SearchDocument).delete()
+        db.session.commit()
+        self.app.test_cli_runner().invoke(args=['backfill', 'run', 'search-index'])
+        self.login('aud')  # the backfill expunged the session, including the logged-in user
+        ids, _, _ = self.search_ids('/search?q=bank+statements')
+        self.assertEqual(ids, [templated])
+
+if __name__ == '__main__':
+    unittest.main()
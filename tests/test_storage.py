@@ -0,0 +1,157 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+from app import create_app, db
+from app.models import User, Query, Category, Attachment, StoredBlob, QueryStatus
+from app.storage import add_reference, blob_relpath, collect_garbage, migrate_legacy_files, store_stream
+from werkzeug.security import generate_password_hash
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.upload_dir = tempfile.mkdtemp()
+        config = type('StorageTestConfig', (__import__('config').TestConfig,), {'UPLOAD_FOLDER': self.upload_dir})
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.auditor = User(username='aud', password_hash=generate_password_hash('pw'), role='auditor')
+        self.employee = User(username='emp', password_hash=generate_password_hash('pw'), role='employee')
+        self.manager = User(username='mgr', password_hash=generate_password_hash('pw'), role='manager')
+        self.cat = Category(name='TestCat')
+        db.session.add_all([self.auditor, self.employee, self.manager, self.cat])
+        db.session.flush()
+        self.q = Query(category_id=self.cat.id, auditor_id=self.auditor.id, assigned_employee_id=self.employee.id,
+                       status=QueryStatus.ASSIGNED.value)
+        db.session.add(self.q)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/login', data={'username': 'emp', 'password': 'pw'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+        shutil.rmtree(self.upload_dir)
+
+    def submit(self, content, name):
+        return self.client.post(f'/query/{self.q.id}/employee_submit', content_type='multipart/form-data',
+                                data={'manager_id': str(self.manager.id), 'attachments': (io.BytesIO(content), name)})
+
+    def test_resubmitted_file_is_stored_once(self):
+        content = b'evidence,amount\n' * 10000
+        self.submit(content, 'evidence.csv')
+        self.submit(content, 'evidence.csv')
+        atts = db.session.query(Attachment).all()
+        self.assertEqual(len(atts), 2)
+        self.assertEqual(atts[0].filename, atts[1].filename)
+        blob = db.session.get(StoredBlob, atts[0].sha256)
+        self.assertEqual((blob.ref_count, blob.size), (2, len(content)))
+        with open(os.path.join(self.upload_dir, blob_relpath(blob.sha256)), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        resp = self.client.get(f'/attachments/{atts[0].id}')
+        self.assertEqual(resp.get_data(), content)
+        self.assertIn('evidence.csv', resp.headers['Content-Disposition'])
+        db.session.delete(atts[0])
+        db.session.commit()
+        self.assertEqual(db.session.get(StoredBlob, blob.sha256).ref_count, 1)
+
+    def test_gc_sweeps_files_of_rolled_back_uploads(self):
+        self.submit(b'kept', 'kept.txt')
+        kept = db.session.query(Attachment).one()
+        sha256, _ = store_stream(io.BytesIO(b'rolled back'))
+        add_reference(sha256, 11)
+        add_reference(sha256, 11)
+        self.assertEqual(db.session.get(StoredBlob, sha256).ref_count, 2)
+        db.session.rollback()
+        orphan = os.path.join(self.upload_dir, blob_relpath(sha256))
+        self.assertTrue(os.path.exists(orphan))
+        self.assertEqual(collect_garbage(), 0)  # too young: could be an upload still in flight
+        os.utime(orphan, (0, 0))
+        os.utime(os.path.join(self.upload_dir, kept.filename), (0, 0))
+        self.assertEqual(collect_garbage(), 1)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(os.path.join(self.upload_dir, kept.filename)))
+
+    def test_download_supports_conditional_and_range_requests(self):
+        content = bytes(range(256)) * 100
+        self.submit(content, 'scan.pdf')
+        att = db.session.query(Attachment).one()
+        url = f'/attachments/{att.id}'
+        resp = self.client.get(url)
+        self.assertEqual(resp.headers['ETag'], f'"{att.sha256}"')
+        self.assertIn('private', resp.headers['Cache-Control'])
+        self.assertEqual(self.client.get(url, headers={'If-None-Match': f'"{att.sha256}"'}).status_code, 304)
+        resp = self.client.get(url, headers={'Range': 'bytes=100-199'})
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp.get_data(), content[100:200])
+
+    def test_download_offloaded_to_front_proxy(self):
+        self.submit(b'%PDF-1.4 offloaded', 'scan.pdf')
+        att = db.session.query(Attachment).one()
+        self.app.config['ATTACHMENT_OFFLOAD'] = 'x-accel-redirect'
+        resp = self.client.get(f'/attachments/{att.id}')
+        self.assertEqual(resp.get_data(), b'')
+        self.assertEqual(resp.headers['X-Accel-Redirect'], '/protected-uploads/' + att.filename)
+        self.assertNotIn('X-Sendfile', resp.headers)
+        self.assertIn('scan.pdf', resp.headers['Content-Disposition'])
+        resp = self.client.get(f'/attachments/{att.id}', headers={'If-None-Match': f'"{att.sha256}"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertNotIn('X-Accel-Redirect', resp.headers)
+        self.app.config['ATTACHMENT_OFFLOAD'] = 'x-sendfile'
+        resp = self.client.get(f'/attachments/{att.id}')
+        self.assertEqual(resp.headers['X-Sendfile'], os.path.join(self.upload_dir, att.filename))
+
+    def test_missing_file_is_not_found(self):
+        self.submit(b'%PDF-1.4 gone', 'scan.pdf')
+        att = db.session.query(Attachment).one()
+        os.remove(os.path.join(self.upload_dir, att.filename))
+        self.assertEqual(self.client.get(f'/attachments/{att.id}').status_code, 404)
+        self.app.config['ATTACHMENT_OFFLOAD'] = 'x-accel-redirect'
+        self.assertEqual(self.client.get(f'/attachments/{att.id}').status_code, 404)
+
+    def test_download_all_streams_a_zip(self):
+        sheet = b'PK fake xlsx ' * 5000
+        notes = b'plain text notes ' * 5000
+        self.submit(sheet, 'evidence.xlsx')
+        self.submit(notes, 'notes.txt')
+        self.submit(notes, 'notes.txt')
+        resp = self.client.get(f'/query/{self.q.id}/attachments.zip')
+        self.assertTrue(resp.is_streamed)
+        archive = zipfile.ZipFile(io.BytesIO(resp.get_data()))
+        self.assertEqual(archive.namelist(), ['evidence.xlsx', 'notes.txt', 'notes (2).txt'])
+        self.assertEqual(archive.getinfo('evidence.xlsx').compress_type, zipfile.ZIP_STORED)
+        self.assertEqual(archive.getinfo('notes.txt').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(archive.read('evidence.xlsx'), sheet)
+        self.assertEqual(archive.read('notes (2).txt'), notes)
+
+    def test_download_all_includes_legacy_files(self):
+        legacy = f'{self.q.id}_old.txt'
+        with open(os.path.join(self.upload_dir, legacy), 'wb') as f:
+            f.write(b'legacy bytes')
+        db.session.add(Attachment(query_id=self.q.id, filename=legacy, original_name='old.txt',
+                                  uploaded_by_id=self.employee.id))
+        db.session.commit()
+        resp = self.client.get(f'/query/{self.q.id}/attachments.zip')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(zipfile.ZipFile(io.BytesIO(resp.get_data())).read('old.txt'), b'legacy bytes')
+
+    def test_migrate_legacy_files(self):
+        legacy = f'{self.q.id}_old.txt'
+        with open(os.path.join(self.upload_dir, legacy), 'wb') as f:
+            f.write(b'legacy bytes')
+        for _ in range(2):
+            db.session.add(Attachment(query_id=self.q.id, filename=legacy, original_name='old.txt',
+                                      uploaded_by_id=self.employee.id))
+        db.session.commit()
+        self.assertEqual(migrate_legacy_files(batch_size=1), (2, 0))
+        atts = db.session.query(Attachment).all()
+        self.assertEqual({a.filename for a in atts}, {blob_relpath(atts[0].sha256)})
+        self.assertEqual(db.session.get(StoredBlob, atts[0].sha256).ref_count, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.upload_dir, legacy)))
+        self.assertEqual(self.client.get(f'/attachments/{atts[0].id}').get_data(), b'legacy bytes')
+
+if __name__ == '__main__':
+    unittest.main()
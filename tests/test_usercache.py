@@ -0,0 +1,87 @@
+import unittest
+from flask import g
+from sqlalchemy import event
+from app import create_app, db
+from app.models import User
+from app.refcache import current_version
+from app.usercache import USERS
+from werkzeug.security import generate_password_hash
+
+class UserCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_class=__import__('config').TestConfig)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.user = User(username='aud', password_hash=generate_password_hash('secret1'), role='auditor', full_name='Aud')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def get(self, client, url):
+        # Requests share the test's app context, so drop the user Flask-Login memoized in g
+        g.pop('_login_user', None)
+        return client.get(url)
+
+    def client(self, password='secret1'):
+        client = self.app.test_client()
+        client.post('/login', data={'username': 'aud', 'password': password})
+        return client
+
+    def user_selects(self, fn):
+        statements = []
+        def before(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT') and 'FROM user' in statement:
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            result = fn()
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        return result, statements
+
+    def test_cached_user_needs_no_query(self):
+        client = self.client()
+        self.get(client, '/api/v1/queries')
+        resp, statements = self.user_selects(lambda: self.get(client, '/api/v1/queries'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(statements, [])
+
+    def test_password_change_signs_out_other_sessions(self):
+        self.app.extensions['user_cache'].ttl = 0
+        mine, other = self.client(), self.client()
+        resp = mine.post('/change_password', data={'old_password': 'secret1', 'new_password': 'secret2',
+                                                   'confirm_password': 'secret2'})
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(self.get(mine, '/api/v1/queries').status_code, 200)
+        self.assertEqual(self.get(other, '/api/v1/queries').status_code, 401)
+        self.assertEqual(self.get(self.client('secret2'), '/api/v1/queries').status_code, 200)
+
+    def test_admin_edit_invalidates_cached_copy(self):
+        client = self.client()
+        self.assertIn('Logged in as Aud', self.get(client, '/change_password').get_data(as_text=True))
+        user = db.session.get(User, self.user.id)
+        user.role = 'manager'
+        db.session.commit()
+        self.assertEqual(user.auth_version, 1)
+        self.assertEqual(self.get(client, '/api/v1/queries').status_code, 401)
+
+    def test_profile_edit_keeps_sessions(self):
+        client = self.client()
+        self.get(client, '/api/v1/queries')
+        user = db.session.get(User, self.user.id)
+        user.full_name = 'Auditor Renamed'
+        user.email = 'aud@example.com'
+        db.session.commit()
+        self.assertEqual(user.auth_version, 0)
+        self.assertEqual(current_version(USERS), 1)
+        page = self.get(client, '/change_password')
+        self.assertEqual(page.status_code, 200)
+        self.assertIn('Logged in as Auditor Renamed', page.get_data(as_text=True))
+
+if __name__ == '__main__':
+    unittest.main()
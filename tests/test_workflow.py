@@ -0,0 +1,113 @@
+import re
+import unittest
+from flask import g
+from sqlalchemy import event
+from app import create_app, db, workflow
+from app.models import User, Query, Category, QueryStatus, AuditTrail
+from app.counters import pending_count, reconcile_counters
+from werkzeug.security import generate_password_hash
+
+class WorkflowTestCase(unittest.TestCase):
+    def setUp(self):
+        config = __import__('config').TestConfig
+        self.app = create_app(config_class=config)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        db.create_all()
+        self.auditor = User(username='aud', password_hash=generate_password_hash('pw'), role='auditor')
+        self.employee = User(username='emp', password_hash=generate_password_hash('pw'), role='employee')
+        self.manager = User(username='mgr', password_hash=generate_password_hash('pw'), role='manager')
+        cat = Category(name='Cat')
+        db.session.add_all([self.auditor, self.employee, self.manager, cat])
+        db.session.commit()
+        self.q = Query(category_id=cat.id, auditor_id=self.auditor.id, assigned_employee_id=self.employee.id,
+                       manager_id=self.manager.id, status=QueryStatus.EMPLOYEE_SUBMITTED.value)
+        db.session.add(self.q)
+        db.session.commit()
+        reconcile_counters()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.ctx.pop()
+
+    def login(self, username):
+        g.pop('_login_user', None)
+        return self.client.post('/login', data={'username': username, 'password': 'pw'})
+
+    def form_state(self):
+        """Hidden expected-state fields of the first transition form on the detail page."""
+        html = self.client.get(f'/query/{self.q.id}').get_data(as_text=True)
+        return dict(re.findall(r'name="(expected_\w+)" value="([^"]*)"', html))
+
+    def state(self):
+        db.session.expire_all()
+        q = db.session.get(Query, self.q.id)
+        actions = [a for (a,) in db.session.query(AuditTrail.action).filter_by(query_id=q.id)]
+        counts = {u.username: pending_count(u.id) for u in (self.auditor, self.employee, self.manager)}
+        return q.status, q.version, actions, counts
+
+    def test_stale_form_is_refused_and_writes_nothing(self):
+        self.login('mgr')
+        stale = self.form_state()
+        self.assertEqual(stale['expected_version'], '0')
+        # The employee re-submits (to the same manager) while the manager has the page open
+        self.login('emp')
+        self.client.post(f'/query/{self.q.id}/employee_submit', data={'manager_id': self.manager.id})
+        before = self.state()
+        self.assertEqual(before[1], 1)
+
+        self.login('mgr')
+        resp = self.client.post(f'/query/{self.q.id}/manager_decide', data=dict(stale, decision='approve'),
+                                follow_redirects=True)
+        self.assertIn('changed by someone else', resp.get_data(as_text=True))
+        self.assertEqual(self.state(), before)
+
+        fresh = self.form_state()
+        self.client.post(f'/query/{self.q.id}/manager_decide', data=dict(fresh, decision='approve'))
+        status, version, actions, counts = self.state()
+        self.assertEqual((status, version), (QueryStatus.MANAGER_APPROVED.value, 2))
+        self.assertEqual(actions[-1], 'manager_approved')
+        self.assertEqual(counts, {'aud': 1, 'emp': 0, 'mgr': 0})
+
+    def test_only_the_first_of_two_concurrent_transitions_applies(self):
+        db.session.query(Query).update({'status': QueryStatus.MANAGER_APPROVED.value})
+        db.session.commit()
+        reconcile_counters()
+        seen = workflow.current_state(self.q.id)
+        workflow.apply('close', self.q.id, self.auditor, expected=seen)
+        db.session.commit()
+        before = self.state()
+        with self.assertRaises(workflow.TransitionError):
+            workflow.apply('reopen', self.q.id, self.auditor, expected=seen)
+        db.session.rollback()
+        self.assertEqual(self.state(), before)
+        self.assertEqual(before[0], QueryStatus.CLOSED.value)
+
+    def test_form_post_writes_without_reading_the_query_first(self):
+        self.login('mgr')
+        expected = self.form_state()
+        statements = []
+        def before(conn, cursor, statement, parameters, context, executemany):
+            statements.append(' '.join(statement.split()))
+        event.listen(db.engine, 'before_cursor_execute', before)
+        try:
+            self.client.post(f'/query/{self.q.id}/manager_decide', data=dict(expected, decision='reject'))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before)
+        first_write = next(i for i, s in enumerate(statements) if s.startswith('UPDATE "query"'))
+        self.assertFalse([s for s in statements[:first_write] if 'FROM "query"' in s])
+        self.assertEqual(self.state()[0], QueryStatus.MANAGER_REJECTED.value)
+
+    def test_transition_from_a_disallowed_status_is_refused(self):
+        db.session.query(Query).update({'status': QueryStatus.CLOSED.value})
+        db.session.commit()
+        self.login('emp')
+        resp = self.client.post(f'/query/{self.q.id}/employee_submit', data={'manager_id': self.manager.id},
+                                follow_redirects=True)
+        self.assertIn('Not possible while the query is closed', resp.get_data(as_text=True))
+        self.assertEqual(self.state()[:3], (QueryStatus.CLOSED.value, 0, []))
+
+if __name__ == '__main__':
+    unittest.main()